@@ -1,21 +1,50 @@
 import torch
 from torch import nn
 import torch.nn.functional as F
+from contextlib import contextmanager
+from torch.utils.checkpoint import checkpoint
+
+
+@contextmanager
+def frozen_bn_stats(module):
+    # keep the running statistics of BatchNorm unchanged while a block is recomputed
+    bn_layers = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm)]
+    momentums = [m.momentum for m in bn_layers]
+    for m in bn_layers:
+        m.momentum = 0.0
+    try:
+        yield
+    finally:
+        for m, momentum in zip(bn_layers, momentums):
+            m.momentum = momentum
+
+def checkpoint_block(block, *inputs):
+    # the first call is the forward pass, any later one is the recomputation during backward
+    calls = []
+
+    def run(*inputs):
+        calls.append(1)
+        if len(calls) > 1:
+            with frozen_bn_stats(block):
+                return block(*inputs)
+        return block(*inputs)
+
+    return checkpoint(run, *inputs, use_reentrant=False)
 
 
 class UNetConvBlock(nn.Module):
 
-    def __init__(self, in_size, out_size, padding, batch_norm):
+    def __init__(self, in_size, out_size, padding, batch_norm, inplace=False):
         super(UNetConvBlock, self).__init__()
         block = []
         block.append(nn.Conv2d(in_size, out_size, kernel_size=3, padding=int(padding)))
-        block.append(nn.ReLU())
+        block.append(nn.ReLU(inplace=inplace))  # the convolution output is not needed by its backward
 
         if batch_norm:
             block.append(nn.BatchNorm2d(out_size))
 
         block.append(nn.Conv2d(out_size, out_size, kernel_size=3, padding=int(padding)))
-        block.append(nn.ReLU())
+        block.append(nn.ReLU(inplace=inplace))
 
         self.block = nn.Sequential(*block)  # the elements in the list are seen as independent params due to *
 
@@ -24,7 +53,7 @@ class UNetConvBlock(nn.Module):
         return out
 
 class UNetUpBlock(nn.Module):
-    def __init__(self, in_size, out_size, up_mode, padding, batch_norm):
+    def __init__(self, in_size, out_size, up_mode, padding, batch_norm, inplace=False):
         super(UNetUpBlock, self).__init__()
 
         # select the upsampling mode
@@ -35,7 +64,7 @@ class UNetUpBlock(nn.Module):
                 nn.Upsample(mode='bilinear', scale_factor=2),
                 nn.Conv2d(in_size, out_size, kernel_size=1),)
 
-        self.conv_block = UNetConvBlock(in_size, out_size, padding, batch_norm)
+        self.conv_block = UNetConvBlock(in_size, out_size, padding, batch_norm, inplace)
 
     def center_crop(self, layer, target_size):
         _, _, layer_height, layer_width = layer.size()
@@ -54,34 +83,41 @@ class UNetUpBlock(nn.Module):
 
 class get_module(nn.Module):
 
-    def __init__(self, in_channels=1, n_classes=2, depth=5, wf=6, padding=False, batch_norm=False, up_mode='upconv'):
+    def __init__(self, in_channels=1, n_classes=2, depth=5, wf=6, padding=False, batch_norm=False, up_mode='upconv', memory_efficient=False):
         super(get_module, self).__init__()
         assert up_mode in ('upconv', 'upsample')
         self.padding = padding
         self.depth = depth
+        # checkpoint every block during training and use in-place ReLUs
+        self.memory_efficient = memory_efficient
         prev_channels = in_channels
 
         self.down_path = nn.ModuleList()
         for i in range(depth):
-            self.down_path.append(UNetConvBlock(prev_channels, 2 ** (wf + i), padding, batch_norm))
+            self.down_path.append(UNetConvBlock(prev_channels, 2 ** (wf + i), padding, batch_norm, memory_efficient))
             prev_channels = 2 ** (wf + i)
 
         self.up_path = nn.ModuleList()
         for i in reversed(range(depth - 1)):
-            self.up_path.append(UNetUpBlock(prev_channels, 2 ** (wf + i), up_mode, padding, batch_norm))
+            self.up_path.append(UNetUpBlock(prev_channels, 2 ** (wf + i), up_mode, padding, batch_norm, memory_efficient))
             prev_channels = 2 ** (wf + i)
 
         self.last = nn.Conv2d(prev_channels, n_classes, kernel_size=1)
 
+    def run_block(self, block, *inputs):
+        if self.memory_efficient and self.training and torch.is_grad_enabled():
+            return checkpoint_block(block, *inputs)
+        return block(*inputs)
+
     def forward(self, x):
         blocks = []
         for i, down in enumerate(self.down_path):
-            x = down(x)
+            x = self.run_block(down, x)
             if i != len(self.down_path) - 1:
                 blocks.append(x)
                 x = F.max_pool2d(x, 2)
 
         for i, up in enumerate(self.up_path):
-            x = up(x, blocks[-i - 1])
+            x = self.run_block(up, x, blocks[-i - 1])
 
         return self.last(x)
@@ -0,0 +1,96 @@
+import math
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torch.utils.data.dataloader import default_collate
+from transformations import center_crop_tensor
+
+# ranges of the iaa.Affine of AugmentDataset: scale, translate x and y (fraction of the size), rotate and shear (degrees)
+AFFINE_LOW = np.array([0.9, -0.05, -0.05, -360.0, -20.0])
+AFFINE_HIGH = np.array([1.1, 0.05, 0.05, 360.0, 20.0])
+
+
+def sample_affine_params(aug_seeds, seed):
+    """(len(aug_seeds), 5) affine parameters, each row drawn from its own counter-based Philox stream.
+
+    The key is the run seed and the sample seed sits in the high words of the counter, so a
+    sample draws the same parameters whatever its batch, loader worker or device.
+    """
+    params = np.zeros((len(aug_seeds), len(AFFINE_LOW)))
+    for i, aug_seed in enumerate(aug_seeds):
+        rng = np.random.Generator(np.random.Philox(key=seed, counter=[0, 0, int(aug_seed), 0]))
+        params[i] = rng.uniform(AFFINE_LOW, AFFINE_HIGH)
+    return params
+
+def get_affine_theta(params):
+    # (batch_size, 2, 3) output-to-input matrices for affine_grid, in normalized coordinates
+    scale, trans_x, trans_y, rotate, shear = [torch.from_numpy(item) for item in params.T]
+    rotate, shear = rotate * math.pi / 180, shear * math.pi / 180
+
+    forward = torch.zeros(len(params), 2, 2, dtype=torch.float64)
+    forward[:, 0, 0] = scale * torch.cos(rotate)
+    forward[:, 0, 1] = scale * (torch.cos(rotate) * torch.tan(shear) - torch.sin(rotate))
+    forward[:, 1, 0] = scale * torch.sin(rotate)
+    forward[:, 1, 1] = scale * (torch.sin(rotate) * torch.tan(shear) + torch.cos(rotate))
+    translate = torch.stack([trans_x, trans_y], dim=1) * 2  # the normalized image spans 2
+
+    inverse = torch.linalg.inv(forward)
+    return torch.cat([inverse, -torch.bmm(inverse, translate.unsqueeze(2))], dim=2)
+
+def augment_batch(img, mask, aug_seeds, seed, mask_fill=0):
+    """Random affine of the samples of a (batch_size, C, H, W) batch with aug_seeds >= 0, in one grid_sample.
+
+    The image is sampled bilinearly with edge padding and the mask with nearest neighbour,
+    filled with mask_fill outside the image, like the imgaug pipeline of AugmentDataset. mask
+    may be None. Samples with a negative aug_seed are left untouched.
+    """
+    aug_seeds = np.asarray(aug_seeds)
+    selected = np.nonzero(aug_seeds >= 0)[0]
+    if len(selected) == 0:
+        return img, mask
+
+    dtype = img.dtype if img.is_floating_point() else torch.float32
+    theta = get_affine_theta(sample_affine_params(aug_seeds[selected], seed)).to(img.device, dtype)
+    index = torch.from_numpy(selected).to(img.device)
+    grid = F.affine_grid(theta, [len(selected)] + list(img.shape[1:]), align_corners=False)
+
+    img = img.clone()
+    img[index] = F.grid_sample(img[index].to(dtype), grid, mode='bilinear', padding_mode='border', align_corners=False).to(img.dtype)
+
+    if mask is not None:
+        mask = mask.clone()
+        warped = F.grid_sample(mask[index].to(dtype), grid, mode='nearest', padding_mode='zeros', align_corners=False)
+        inside = (grid.abs() <= 1).all(-1).unsqueeze(1)
+        mask[index] = torch.where(inside, warped, torch.full_like(warped, mask_fill)).to(mask.dtype)
+
+    return img, mask
+
+
+class AugmentCollate(object):
+    """collate_fn applying augment_batch to the samples of AugmentDataset carrying an 'aug_seed'.
+
+    Samples of other datasets get an aug_seed of -1. In a loader worker (on_device False) the
+    batch is augmented in the collate, otherwise 'aug_seed' is kept in the batch and
+    train_mean_teacher augments it once it is on the device.
+    """
+    def __init__(self, seed, on_device=False):
+        self.seed = seed
+        self.on_device = on_device
+
+    def __call__(self, samples):
+        for sample in samples:
+            sample.setdefault('aug_seed', -1)
+        batch = default_collate(samples)
+        if self.on_device:
+            return batch
+
+        # samples are (H, W, C), grid_sample wants (C, H, W)
+        aug_seeds = batch.pop('aug_seed').numpy()
+        mask = batch['mask'].permute(0, 3, 1, 2) if 'mask' in batch else None
+        if mask is not None:  # the masks of --adaptive_crop samples are not cropped to their ROI
+            mask = center_crop_tensor(mask, batch['img'].shape[1])
+        img, mask = augment_batch(batch['img'].permute(0, 3, 1, 2), mask, aug_seeds, self.seed)
+        batch['img'] = img.permute(0, 2, 3, 1)
+        if mask is not None:
+            batch['mask'] = mask.permute(0, 2, 3, 1)
+        return batch
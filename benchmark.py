@@ -0,0 +1,328 @@
+import sys
+import copy
+import contextlib
+import time
+import argparse
+import subprocess
+import torch
+import torch.nn.functional as F
+from Vnet import get_module
+from losses import FocalLoss, DiceLossMulticlass_CW, FocalDiceLoss, ConsistencyLoss, softmax_mse_loss
+from fast_math import FastMath
+from augmentation import augment_batch
+from branch_inference import BranchPredictor
+from teacher_pipeline import TeacherPipeline
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Benchmark')
+    parser.add_argument('--task', type=str, default='losses', help='benchmark to run: losses, consistency, model, startup, fast_math, augmentation, branch_inference, pipeline_teacher')
+    parser.add_argument('--batch_size', type=int, default=64, help='Batch Size used by the benchmarks')
+    parser.add_argument('--crop_size', type=int, default=64, help='size for square patch')
+    parser.add_argument('--slices', type=int, default=7, help='slices used in the 2.5D mode')
+    parser.add_argument('--n_classes', type=int, default=3, help='classes for segmentation')
+    parser.add_argument('--ignore_index', type=int, default=3, help="ignore the given label index [default: 3(backgroud)]")
+    parser.add_argument('--consistency_threshold', type=float, default=0.8, help='teacher confidence kept by the masked consistency criteria')
+    parser.add_argument('--depth_list', type=int, nargs='+', default=[3, 4, 5], help='Vnet depths swept by the model benchmark')
+    parser.add_argument('--wf_list', type=int, nargs='+', default=[4, 5], help='Vnet widths swept by the model benchmark')
+    parser.add_argument('--amp_dtype', type=str, default='bfloat16', help='autocast dtype of the fast_math benchmark: bfloat16 or float16 (cuda only)')
+    parser.add_argument('--compile_mode', type=str, default='default', help='torch.compile mode of the fast_math benchmark')
+    parser.add_argument('--parity_steps', type=int, default=50, help='training steps of the fast_math dice parity check')
+    parser.add_argument('--branch_length', type=int, default=300, help='slices of the synthetic branch of the branch_inference benchmark')
+    parser.add_argument('--main_args', type=str, default='', help='arguments of the main.py --dry_run timed by the startup benchmark')
+    parser.add_argument('--repeat', type=int, default=20, help='timed repetitions of every case')
+    parser.add_argument('--device', type=str, default=None, help='set device type')
+    return parser.parse_args()
+
+def measure(fn, device, repeat):
+    # returns (bytes, seconds per call); bytes is the peak on cuda and the total allocated on cpu
+    fn()  # warm up
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+        torch.cuda.reset_peak_memory_stats()
+        base = torch.cuda.memory_allocated()
+        fn()
+        torch.cuda.synchronize()
+        memory = torch.cuda.max_memory_allocated() - base
+    else:
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+            fn()
+        memory = sum([max(item.self_cpu_memory_usage, 0) for item in prof.key_averages()])
+
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return memory, (time.perf_counter() - start) / repeat
+
+def report(name, baseline, candidate):
+    base_memory, base_time = baseline
+    memory, seconds = candidate
+    print('%-24s %10.1f MB -> %8.1f MB  %8.2f ms -> %8.2f ms  (x%.2f)' % (
+        name, base_memory / 2 ** 20, memory / 2 ** 20, base_time * 1e3, seconds * 1e3, base_time / max(seconds, 1e-12)))
+
+def bench_losses(args):
+    n_pixels = args.crop_size * args.crop_size
+    weights = torch.tensor([1.0000, 4.9928, 9.7400, 21.6221])[:args.n_classes].to(args.device)
+    logits = torch.randn(args.batch_size, args.n_classes, n_pixels, device=args.device, requires_grad=True)
+    # the focal target contains ignored background, the reference dice can only take in-range labels
+    focal_target = torch.randint(0, args.n_classes + 1, (args.batch_size, 1, n_pixels), device=args.device)
+    dice_target = torch.randint(0, args.n_classes, (args.batch_size, 1, n_pixels), device=args.device)
+
+    focal, dice = FocalLoss(args.ignore_index), DiceLossMulticlass_CW()
+    cases = [
+        ('focal', lambda: focal(logits, focal_target, args.n_classes, weights),
+         FocalDiceLoss(args.ignore_index), focal_target),
+        ('dice', lambda: dice(logits, dice_target, args.n_classes, weights),
+         FocalDiceLoss(args.ignore_index, focal_weight=0.0, dice_weight=1.0), dice_target),
+        ('focal + dice', lambda: focal(logits, dice_target, args.n_classes, weights) + dice(logits, dice_target, args.n_classes, weights),
+         FocalDiceLoss(args.ignore_index, dice_weight=1.0), dice_target),
+    ]
+
+    print('loss (batch %d, crop %d)    memory                      time per step' % (args.batch_size, args.crop_size))
+    for name, reference, fused, target in cases:
+        def step(loss_fn):
+            logits.grad = None
+            loss = loss_fn()
+            loss.backward()
+            return loss.detach()
+
+        report(name, measure(lambda: step(reference), args.device, args.repeat),
+               measure(lambda: step(lambda: fused(logits, target, args.n_classes, weights)), args.device, args.repeat))
+
+def naive_consistency(consistency_type, threshold, stu_logits, ema_logits):
+    # per-pixel reference implementations, materializing the full error map
+    ema_prob = F.softmax(ema_logits, dim=1)
+    if consistency_type.endswith('mse'):
+        pixel_loss = softmax_mse_loss(stu_logits, ema_logits).mean(1)
+    else:
+        pixel_loss = (ema_prob * (torch.log(ema_prob) - F.log_softmax(stu_logits, dim=1))).sum(1)
+
+    if consistency_type.startswith('masked'):
+        keep = (ema_prob.max(1)[0] >= threshold).float()
+        return (pixel_loss * keep).sum() / keep.sum()
+    return pixel_loss.mean()
+
+def bench_consistency(args):
+    shape = (args.batch_size, args.n_classes, args.crop_size, args.crop_size)
+    stu_logits = torch.randn(shape, device=args.device, requires_grad=True)
+    ema_logits = 3 * torch.randn(shape, device=args.device)
+
+    print('consistency (batch %d, crop %d)  memory                      time per step' % (args.batch_size, args.crop_size))
+    for consistency_type in ('mse', 'kl', 'masked_mse', 'masked_kl'):
+        criterion = ConsistencyLoss(consistency_type, args.consistency_threshold)
+
+        def step(loss_fn):
+            stu_logits.grad = None
+            loss = loss_fn()
+            loss.backward()
+            return loss.detach()
+
+        reference = lambda: naive_consistency(consistency_type, args.consistency_threshold, stu_logits, ema_logits)
+        fused = lambda: criterion(stu_logits, ema_logits)
+
+        report(consistency_type, measure(lambda: step(reference), args.device, args.repeat),
+               measure(lambda: step(fused), args.device, args.repeat))
+
+
+def bench_model(args):
+    inputs = torch.randn(args.batch_size, args.slices, args.crop_size, args.crop_size, device=args.device)
+    target = torch.randint(0, args.n_classes, (args.batch_size, args.crop_size, args.crop_size), device=args.device)
+
+    print('model (batch %d, crop %d)        memory                      time per step' % (args.batch_size, args.crop_size))
+    for depth in args.depth_list:
+        for wf in args.wf_list:
+            results = []
+            for memory_efficient in (False, True):
+                model = get_module(args.slices, args.n_classes, depth, wf, True, True, memory_efficient=memory_efficient).to(args.device)
+                model.train()
+
+                def step():
+                    model.zero_grad()
+                    F.cross_entropy(model(inputs), target).backward()
+
+                results.append(measure(step, args.device, args.repeat))
+            report('depth %d, wf %d' % (depth, wf), *results)
+
+
+def time_command(command, repeat):
+    # best wall-clock time of a command run in a fresh interpreter
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def get_dice(preds, target, n_classes, ignore_index):
+    valid = target != ignore_index
+    dice = []
+    for l in range(n_classes):
+        inter = ((preds == l) & (target == l) & valid).sum().item()
+        total = ((preds == l) & valid).sum().item() + ((target == l) & valid).sum().item()
+        dice.append(2.0 * inter / max(total, 1))
+    return torch.tensor(dice)
+
+def bench_fast_math(args):
+    inputs = torch.randn(args.batch_size, args.slices, args.crop_size, args.crop_size, device=args.device)
+    target = torch.randint(0, args.n_classes + 1, (args.batch_size, 1, args.crop_size * args.crop_size), device=args.device)
+    weights = torch.tensor([1.0000, 4.9928, 9.7400, 21.6221])[:args.n_classes].to(args.device)
+
+    model = get_module(args.slices, args.n_classes, 4, 4, True, True).to(args.device)
+    fast_model = copy.deepcopy(model)
+    engines = []
+    for item in (model, fast_model):
+        optimizer = torch.optim.Adam(item.parameters(), lr=1e-3)
+        engines.append((item, optimizer, FastMath(args, item, copy.deepcopy(item), FocalLoss(args.ignore_index),
+                                                  ConsistencyLoss('mse'), enabled=item is fast_model)))
+
+    def step(engine):
+        model, optimizer, fast_math = engine
+        model.train()
+        optimizer.zero_grad()
+        with fast_math.autocast():
+            logits = fast_math.stu_model(fast_math.prepare(inputs))
+            loss = fast_math.criterion(logits.view(logits.size(0), args.n_classes, -1), target, args.n_classes, weights)
+        fast_math.backward(loss, optimizer)
+
+    # dice parity: fit the same batch from the same weights, evaluate both in eager float32
+    for _ in range(args.parity_steps):
+        for engine in engines:
+            step(engine)
+    dice = []
+    with torch.no_grad():
+        for item in (model, fast_model):
+            item.eval()
+            dice.append(get_dice(item(inputs).argmax(1).view(args.batch_size, 1, -1), target, args.n_classes, args.ignore_index))
+    print('dice after %d steps: eager float32 %s, fast_math %s, max abs difference %.4f' % (
+        args.parity_steps, dice[0].numpy().round(4), dice[1].numpy().round(4), (dice[0] - dice[1]).abs().max().item()))
+
+    print('fast_math %s (batch %d, crop %d)  memory                      time per step' % (args.amp_dtype, args.batch_size, args.crop_size))
+    report('train step', measure(lambda: step(engines[0]), args.device, args.repeat),
+           measure(lambda: step(engines[1]), args.device, args.repeat))
+
+def bench_augmentation(args):
+    img = torch.randn(args.batch_size, args.slices, args.crop_size, args.crop_size, device=args.device) * 300
+    mask = torch.randint(0, 4, (args.batch_size, 1, args.crop_size, args.crop_size), device=args.device).int()
+    aug_seeds = list(range(args.batch_size))
+
+    def per_sample():
+        import imgaug as ia
+        import imgaug.augmenters as iaa
+        from imgaug.augmentables.segmaps import SegmentationMapsOnImage
+
+        for idx in aug_seeds:
+            probe_img, probe_mask = img[idx].permute(1, 2, 0).cpu().numpy(), mask[idx].permute(1, 2, 0).cpu().numpy()
+            ia.seed(idx + 1)
+            seg_map = SegmentationMapsOnImage(probe_mask, shape=probe_img.shape)
+            aug_affine = iaa.Affine(scale=(0.9, 1.1), translate_percent=(-0.05, 0.05), rotate=(-360, 360), shear=(-20, 20), mode='edge')
+            aug_affine(image=probe_img, segmentation_maps=seg_map)
+
+    print('augmentation (batch %d, crop %d)  memory                      time per batch' % (args.batch_size, args.crop_size))
+    batched = measure(lambda: augment_batch(img, mask, aug_seeds, 0), args.device, args.repeat)
+    try:
+        report('imgaug -> augment_batch', measure(per_sample, torch.device('cpu'), args.repeat), batched)
+    except ImportError:
+        report('augment_batch', batched, batched)
+
+def bench_branch_inference(args):
+    volume = (torch.randn(args.branch_length, args.crop_size, args.crop_size) * 300).round().short().numpy()
+    slice_ids = list(range(args.branch_length))
+
+    print('branch inference (%d slices, batch %d, crop %d)' % (args.branch_length, args.batch_size, args.crop_size))
+    for depth in args.depth_list:
+        for wf in args.wf_list:
+            model = get_module(args.slices, args.n_classes, depth, wf, True, True).to(args.device)
+            predictor = BranchPredictor(model, args.slices, args.crop_size)
+
+            # equivalence of the logits, then of the masks of the whole branch
+            with torch.no_grad():
+                ids = slice_ids[:args.batch_size]
+                naive, cached = predictor.forward_stacks(volume, ids), predictor.forward_cached(volume, ids)
+            assert torch.allclose(naive, cached, rtol=1e-4, atol=1e-3), (naive - cached).abs().max()
+            agreement = (predictor.segment_branch(volume, slice_ids, args.batch_size, cached=False) ==
+                         predictor.segment_branch(volume, slice_ids, args.batch_size, cached=True)).mean()
+            print('depth %d, wf %d: max abs logit difference %.2e, mask agreement %.6f' % (depth, wf, (naive - cached).abs().max().item(), agreement))
+
+            report('depth %d, wf %d' % (depth, wf),
+                   measure(lambda: predictor.segment_branch(volume, slice_ids, args.batch_size, cached=False), args.device, args.repeat),
+                   measure(lambda: predictor.segment_branch(volume, slice_ids, args.batch_size, cached=True), args.device, args.repeat))
+
+def bench_pipeline_teacher(args):
+    from learning import predict_teacher, update_ema_variables
+
+    steps = args.repeat
+    batches = [torch.randn(args.batch_size, args.slices, args.crop_size, args.crop_size, device=args.device) for _ in range(steps + 1)]
+    model = get_module(args.slices, args.n_classes, 4, 4, True, True).to(args.device)
+    ema_model = copy.deepcopy(model)
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    criterion = ConsistencyLoss('mse')
+    model.train()
+    ema_model.train()
+
+    def student_step(inputs, outputs_ema):
+        optimizer.zero_grad()
+        criterion(model(inputs), outputs_ema).backward()
+        optimizer.step()
+
+    def sequential():
+        for step in range(steps):
+            student_step(batches[step], predict_teacher(ema_model, batches[step]))
+            update_ema_variables(model, ema_model, 0.999, step)
+
+    def pipelined():
+        pipeline = TeacherPipeline(lambda x: predict_teacher(ema_model, x), args.device, contextlib.nullcontext)
+        pipeline.submit(batches[0])
+        outputs_ema = pipeline.result()
+        for step in range(steps):
+            pipeline.submit(batches[step + 1])
+            student_step(batches[step], outputs_ema)
+            outputs_ema = pipeline.result()
+            update_ema_variables(model, ema_model, 0.999, step)
+        pipeline.close()
+
+    print('pipeline_teacher (batch %d, crop %d, %d steps)  memory                      time per iteration' % (args.batch_size, args.crop_size, steps))
+    sequential_result, pipelined_result = measure(sequential, args.device, 1), measure(pipelined, args.device, 1)
+    report('sequential -> pipelined', (sequential_result[0], sequential_result[1] / steps), (pipelined_result[0], pipelined_result[1] / steps))
+
+def bench_startup(args):
+    repeat = max(1, min(args.repeat, 5))
+    print('startup (best of %d runs)' % repeat)
+    baseline = time_command([sys.executable, '-c', 'pass'], repeat)
+    print('%-32s %8.2f s' % ('interpreter', baseline))
+    for module in ('torch', 'numpy', 'pandas', 'SimpleITK', 'cv2', 'imgaug', 'tensorboardX', 'initialization', 'main', 'runtime'):
+        try:
+            seconds = time_command([sys.executable, '-c', 'import %s' % module], repeat)
+        except subprocess.CalledProcessError:
+            print('%-32s not installed' % ('import ' + module))
+            continue
+        print('%-32s %8.2f s' % ('import ' + module, seconds - baseline))
+    seconds = time_command([sys.executable, 'main.py', '--dry_run'] + args.main_args.split(), repeat)
+    print('%-32s %8.2f s' % ('main.py --dry_run', seconds))
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    args.device = torch.device(args.device if args.device else ("cuda" if torch.cuda.is_available() else "cpu"))
+    torch.manual_seed(0)
+
+    if args.task == 'losses':
+        bench_losses(args)
+    elif args.task == 'consistency':
+        bench_consistency(args)
+    elif args.task == 'model':
+        bench_model(args)
+    elif args.task == 'startup':
+        bench_startup(args)
+    elif args.task == 'fast_math':
+        bench_fast_math(args)
+    elif args.task == 'augmentation':
+        bench_augmentation(args)
+    elif args.task == 'branch_inference':
+        bench_branch_inference(args)
+    elif args.task == 'pipeline_teacher':
+        bench_pipeline_teacher(args)
+    else:
+        raise NotImplementedError(args.task)
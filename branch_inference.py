@@ -0,0 +1,91 @@
+"""Whole-branch 2.5D inference with the first convolution computed per slice.
+
+The first Conv2d of get_module is linear in its input channels. Its output for a stack is
+therefore the bias plus the sum, over the channels, of the channel's slice convolved with the
+channel's filters. In the channel order of get_stack_index, a channel always sits at the same
+offset from the centre slice. Channels that share an offset, such as the centre slice that
+appears three times in a stack of 7, read the same slice in every stack, clamped at the branch
+ends included, so their filters are summed into one. Each slice of the volume is convolved once
+with the filters of every distinct offset. The first activation of a stack is then a gather and
+a sum of these cached slices, and the rest of the network runs from there. The stacks of slices
+are never built.
+"""
+import numpy as np
+import torch
+import torch.nn.functional as F
+from dataset import get_stack_index, crop_volume
+
+
+def get_stack_offsets(slices):
+    # offset from the centre slice of every channel of a stack, away from the branch ends
+    length = 2 * slices * slices + 1
+    return [i - length // 2 for i in get_stack_index(length // 2, length, slices)]
+
+def forward_from_stem(model, x):
+    # get_module.forward given the output of the first convolution of the first block
+    blocks = []
+    for i, down in enumerate(model.down_path):
+        x = down.block[1:](x) if i == 0 else down(x)
+        if i != len(model.down_path) - 1:
+            blocks.append(x)
+            x = F.max_pool2d(x, 2)
+
+    for i, up in enumerate(model.up_path):
+        x = up(x, blocks[-i - 1])
+
+    return model.last(x)
+
+
+class BranchPredictor(object):
+    def __init__(self, model, slices, crop_size):
+        self.model = model.eval()
+        self.slices = slices
+        self.crop_size = crop_size
+        self.stem = model.down_path[0].block[0]
+        assert self.stem.in_channels == slices, 'the model takes %d slices' % self.stem.in_channels
+
+        # summed filters of the channels sharing an offset: (len(offsets), out_channels, 1, k, k)
+        channel_offsets = get_stack_offsets(slices)
+        self.offsets = sorted(set(channel_offsets))
+        weight = self.stem.weight.detach()
+        self.weight = torch.stack([weight[:, [c for c, item in enumerate(channel_offsets) if item == offset]].sum(1, keepdim=True)
+                                   for offset in self.offsets])
+
+    def device(self):
+        return self.stem.weight.device
+
+    def slice_features(self, volume, slice_ids):
+        # (len(slice_ids), len(offsets), out_channels, H', W') convolutions of the given slices
+        inputs = torch.from_numpy(np.ascontiguousarray(volume[slice_ids], dtype=np.float32)).to(self.device())
+        weight = self.weight.reshape(-1, 1, *self.weight.shape[-2:])
+        features = F.conv2d(inputs.unsqueeze(1), weight, padding=self.stem.padding)
+        return features.view(len(slice_ids), len(self.offsets), -1, *features.shape[-2:])
+
+    def forward_cached(self, volume, pt_ids):
+        # logits of the stacks centred on pt_ids, each needed slice convolved once
+        index = np.clip(np.array(pt_ids)[:, None] + np.array(self.offsets)[None], 0, len(volume) - 1)
+        needed, position = np.unique(index, return_inverse=True)
+        features = self.slice_features(volume, needed)
+        position = torch.from_numpy(position.reshape(index.shape)).to(features.device)
+        stem = features[position, torch.arange(len(self.offsets), device=features.device)].sum(1)
+        stem = stem + self.stem.bias.view(1, -1, 1, 1)
+        return forward_from_stem(self.model, stem)
+
+    def forward_stacks(self, volume, pt_ids):
+        # logits of the stacks centred on pt_ids, built as the datasets build them
+        stacks = np.stack([volume[get_stack_index(pt_idx, len(volume), self.slices)] for pt_idx in pt_ids]).astype(np.float32)
+        return self.model(torch.from_numpy(stacks).to(self.device()))
+
+    def segment_branch(self, volume, slice_ids=None, batch_size=64, cached=True):
+        # masks of the given slices of a (depth, H, W) branch volume, every slice by default
+        volume = crop_volume(volume, self.crop_size)
+        if slice_ids is None:
+            slice_ids = list(range(len(volume)))
+        forward = self.forward_cached if cached else self.forward_stacks
+
+        masks = []
+        with torch.no_grad():
+            for start in range(0, len(slice_ids), batch_size):
+                logits = forward(volume, slice_ids[start:start + batch_size])
+                masks.append(logits.argmax(1).to(torch.uint8).cpu().numpy())
+        return np.concatenate(masks) if masks else np.zeros((0, self.crop_size, self.crop_size), dtype=np.uint8)
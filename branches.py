@@ -0,0 +1,53 @@
+"""Folders and files of the annotated branches.
+
+Only os is imported here, so that planning.py and main.py --dry_run can list the splits
+without importing torch. dataset.py imports these names too.
+"""
+import os
+
+
+def get_branch_paths(args, case_dirs):
+    # annotated branch folders of the given case folders
+    if args.dataset_mode == 'main_branch':
+        name_list = ['1', '13', '20']
+    elif args.dataset_mode == 'all_branch':
+        name_list = [str(i) for i in range(25)]
+
+    tar_set = []
+    for path in case_dirs:
+        for tar_name in name_list:
+            if os.path.exists(os.path.join(path, tar_name, 'mask_refine_checked.nii.gz')):
+                tar_set.append(os.path.join(path, tar_name))
+            elif os.path.exists(os.path.join(path, tar_name, 'mask_refine.nii.gz')):
+                tar_set.append(os.path.join(path, tar_name))
+            elif os.path.exists(os.path.join(path, tar_name, 'mask.nii.gz')):
+                tar_set.append(os.path.join(path, tar_name))
+    return tar_set
+
+def split_dataset(args):
+    # get the path list of all annotated data -----------------------------------
+    target_paths = [os.path.join(args.data_dir, str(i)) for i in range(150)]
+
+    # split the dataset -----------------------------------
+    unlabeled_dirs = target_paths[:args.unlabeled_num]
+    labeled_dirs = target_paths[args.unlabeled_num:args.unlabeled_num + args.labeled_num]
+    val_dirs = target_paths[args.unlabeled_num + args.labeled_num:]
+
+    return get_branch_paths(args, unlabeled_dirs), get_branch_paths(args, labeled_dirs), get_branch_paths(args, val_dirs)
+
+def get_mpr_path(file_path):
+    if os.path.exists(os.path.join(file_path, 'mpr_100.nii.gz')):
+        return os.path.join(file_path, 'mpr_100.nii.gz')
+    return os.path.join(file_path, 'mpr.nii.gz')
+
+def get_mask_path(file_path):
+    # prefer the most refined annotation of the branch
+    for mask_name in ('mask_refine_checked.nii.gz', 'mask_refine.nii.gz'):
+        if os.path.exists(os.path.join(file_path, mask_name)):
+            return os.path.join(file_path, mask_name)
+    return os.path.join(file_path, 'mask.nii.gz')
+
+def get_branch_key(file_path):
+    # (case_id, branch_id) of a branch folder, as recorded in plaque_info.csv
+    case_path, branch_id = os.path.split(os.path.normpath(file_path))
+    return os.path.basename(case_path), branch_id
@@ -1,12 +1,15 @@
 import os
 import random
-import pandas as pd
-import SimpleITK as sitk
 import numpy as np
-from torch.utils.data import Dataset
+import torch
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from branches import get_branch_paths, split_dataset, get_mpr_path, get_mask_path, get_branch_key
 
 
 def record_dataset(args):
+    import pandas as pd
+    import SimpleITK as sitk
+
     target_paths = [os.path.join(args.data_dir, str(i)) for i in range(150)]
 
     if args.dataset_mode == 'main_branch':
@@ -56,6 +59,8 @@ def record_dataset(args):
 
 
 def count_dataset(args):
+    import SimpleITK as sitk
+
     target_paths = [os.path.join(args.data_dir, str(i)) for i in range(150)]
 
     if args.dataset_mode == 'main_branch':
@@ -116,37 +121,102 @@ def count_dataset(args):
     print("Slice num of each class in the whole dataset is: {}".format(total_list))
 
 
-def split_dataset(args):
-    # get the path list of all annotated data -----------------------------------
-    target_paths = [os.path.join(args.data_dir, str(i)) for i in range(150)]
+def remap_mask(mask_vol):
+    # remove anchor voxels
+    mask_vol[mask_vol>3] = 0
+
+    # change label index: artery, hard, soft, background
+    mask_vol = mask_vol.astype(np.int16)
+    mask_vol = mask_vol - 1
+    mask_vol[mask_vol == -1] = 3
+    return mask_vol
+
+def get_centerline_index(mask_vol):
+    # index of the slices used for training, selected on the remapped mask by its center voxel
+    center = mask_vol[:, int((mask_vol.shape[1] - 1) / 2), int((mask_vol.shape[2] - 1) / 2)]
+    return np.nonzero(center != 0)[0].tolist()
+
+def get_stack_index(pt_idx, length, slices):
+    # slice indices of a 2.5D stack, in the channel order used by the datasets
+    stack_index = [pt_idx]
+    step = int((slices - 1) / 2)
+    for i in range(step):
+        s_idx = max(pt_idx - sum([i for i in range(i+1)]), 0)
+        e_idx = min(pt_idx + sum([i for i in range(i+1)]), length - 1)
+        stack_index.insert(0, s_idx)
+        stack_index.insert(-1, e_idx)
+    return stack_index
+
+def record_centerline(data_paths, save_path):
+    # precompute the centerline slice list so that the masks need not be decoded again
+    import pandas as pd
+    import SimpleITK as sitk
+
+    if os.path.exists(save_path):
+        df = pd.read_csv(save_path, dtype=str)
+        recorded = set(zip(df['case_id'], df['branch_id']))
+    else:
+        df = pd.DataFrame({'case_id': [], 'branch_id': [], 'slice_id': []}, dtype=str)
+        recorded = set()
+
+    case_list, branch_list, slice_list = [], [], []
+    for file_path in data_paths:
+        case_id, branch_id = get_branch_key(file_path)
+        if (case_id, branch_id) in recorded:
+            continue
 
-    # split the dataset -----------------------------------
-    unlabeled_dirs = target_paths[:args.unlabeled_num]
-    labeled_dirs = target_paths[args.unlabeled_num:args.unlabeled_num + args.labeled_num]
-    val_dirs = target_paths[args.unlabeled_num + args.labeled_num:]
+        mask_vol = remap_mask(sitk.GetArrayFromImage(sitk.ReadImage(get_mask_path(file_path))))
+        for i in get_centerline_index(mask_vol):
+            case_list.append(case_id)
+            branch_list.append(branch_id)
+            slice_list.append(str(i))
 
-    if args.dataset_mode == 'main_branch':
-        name_list = ['1', '13', '20']
-    elif args.dataset_mode == 'all_branch':
-        name_list = [str(i) for i in range(25)]
-
-    unlabeled_set, labeled_set, val_set = [], [], []
-    for item in zip((unlabeled_set, labeled_set, val_set), (unlabeled_dirs, labeled_dirs, val_dirs)):
-        tar_set, tar_dirs = item
-        for path in tar_dirs:
-            for tar_name in name_list:
-                if os.path.exists(os.path.join(path, tar_name, 'mask_refine_checked.nii.gz')):
-                    tar_set.append(os.path.join(path, tar_name))
-                elif os.path.exists(os.path.join(path, tar_name, 'mask_refine.nii.gz')):
-                    tar_set.append(os.path.join(path, tar_name))
-                elif os.path.exists(os.path.join(path, tar_name, 'mask.nii.gz')):
-                    tar_set.append(os.path.join(path, tar_name))
+    if case_list or not os.path.exists(save_path):
+        df = pd.concat([df, pd.DataFrame({'case_id': case_list, 'branch_id': branch_list, 'slice_id': slice_list})])
+        df.to_csv(save_path, index=False)
 
-    return unlabeled_set, labeled_set, val_set
+    return df
 
+def get_stack(img_vol, pt_idx, slices):
+    img_stack_list = [img_vol[i].astype(np.float32) for i in get_stack_index(pt_idx, len(img_vol), slices)]
+    return np.stack(img_stack_list, axis=-1)
 
-def prepare_data(data_paths, n_classes):
+def crop_volume(vol, crop_size):
+    # crop the in-plane dimensions once, with the same offsets as center_crop
+    _, width, height = np.shape(vol)
+    assert width >= crop_size, "crop_size should be smaller than img size"
 
+    gap_w, gap_h = int((width - crop_size) / 2), int((height - crop_size) / 2)
+    return np.ascontiguousarray(vol[:, gap_w:gap_w + crop_size, gap_h:gap_h + crop_size])
+
+def compact_image(img_vol):
+    # store HU as int16 whenever the cast is lossless, so samples stay bit-identical
+    img_int16 = img_vol.astype(np.int16)
+    if np.array_equal(img_int16, img_vol):
+        return img_int16
+    return img_vol
+
+def get_resident_bytes(dataset):
+    # bytes of decoded volumes held by a dataset, ConcatDataset included
+    if hasattr(dataset, 'datasets'):
+        return sum([get_resident_bytes(item) for item in dataset.datasets])
+    if not hasattr(dataset, 'env_dict'):
+        return 0
+    return sum([item.nbytes for env in dataset.env_dict.values() for item in env.values()])
+
+def get_branch_meta(shape, img_itemsize, unique, counts, mask_path, num_slices):
+    # metadata of a decoded branch, cached so that a dry run needs not decode it again
+    label_counts = np.zeros(4, dtype=np.int64)
+    label_counts[unique] = counts
+    return {
+        'shape': [int(item) for item in shape],
+        'img_itemsize': int(img_itemsize),
+        'num_slices': int(num_slices),
+        'label_counts': label_counts.tolist(),
+        'mask_name': os.path.basename(mask_path),
+    }
+
+def prepare_data(data_paths, n_classes, crop_size, meta_dict=None, store_dir=None, slices=1):
     all_idx_list = []
     env_dict = {}
     env_count = 0
@@ -154,38 +224,46 @@ def prepare_data(data_paths, n_classes):
 
     for file_path in data_paths:
 
-        if os.path.exists(os.path.join(file_path, 'mpr_100.nii.gz')):
-            mpr_path = os.path.join(file_path, 'mpr_100.nii.gz')
-        else:
-            mpr_path = os.path.join(file_path, 'mpr.nii.gz')
-
-        if os.path.exists(os.path.join(file_path, 'mask_refine_checked.nii.gz')):
-            mask_path = os.path.join(file_path, 'mask_refine_checked.nii.gz')
-        elif os.path.exists(os.path.join(file_path, 'mask_refine.nii.gz')):
-            mask_path = os.path.join(file_path, 'mask_refine.nii.gz')
+        if store_dir is not None:
+            # chunked store, see volume_store.py: the image is only read at the slices of the stacks
+            from volume_store import read_store_branch
+            mpr_vol, mask_vol, mask_path, store_index = read_store_branch(store_dir, file_path, slices)
         else:
-            mask_path = os.path.join(file_path, 'mask.nii.gz')
-
-        mpr_itk = sitk.ReadImage(mpr_path)
-        mask_itk = sitk.ReadImage(mask_path)
-        mpr_vol = sitk.GetArrayFromImage(mpr_itk)
-        mask_vol = sitk.GetArrayFromImage(mask_itk)
+            store_index = None
+            import SimpleITK as sitk
+
+            mask_path = get_mask_path(file_path)
+            mpr_itk = sitk.ReadImage(get_mpr_path(file_path))
+            mask_itk = sitk.ReadImage(mask_path)
+            mpr_vol = sitk.GetArrayFromImage(mpr_itk)
+            mask_vol = sitk.GetArrayFromImage(mask_itk)
         assert mpr_vol.shape == mask_vol.shape, print('Wrong shape')
 
-        # remove anchor voxels
-        mask_vol[mask_vol>3] = 0
-
-        # change label index: artery, hard, soft, background
-        mask_vol = mask_vol.astype(np.int16)
-        mask_vol = mask_vol - 1
-        mask_vol[mask_vol == -1] = 3
+        mask_vol = remap_mask(mask_vol)
 
-        unique, counts = np.unique(mask_vol, return_counts=True)
+        if store_index is None:
+            unique, counts = np.unique(mask_vol, return_counts=True)
+            full_shape = mpr_vol.shape
+        else:
+            # the store may hold a crop only, its index has the counts and shape of the whole volume
+            label_counts = np.array(store_index['label_counts'])
+            unique = np.nonzero(label_counts)[0]
+            counts = label_counts[unique]
+            full_shape = tuple(store_index['full_shape'])
         labelweights[unique] += counts
 
-        for i in range(mask_vol.shape[0]):
-            if mask_vol[i, int((mask_vol.shape[1] - 1) / 2), int((mask_vol.shape[2] - 1) / 2)] != 0:
-                all_idx_list.append((i, env_count))
+        centerline_index = get_centerline_index(mask_vol)
+        for i in centerline_index:
+            all_idx_list.append((i, env_count))
+
+        if store_index is None:
+            mpr_vol = compact_image(crop_volume(mpr_vol, crop_size))
+        else:
+            mpr_vol = mpr_vol.apply(lambda vol: compact_image(crop_volume(vol, crop_size)))
+        mask_vol = crop_volume(mask_vol, crop_size).astype(np.uint8)
+
+        if meta_dict is not None:
+            meta_dict['/'.join(get_branch_key(file_path))] = get_branch_meta(full_shape, mpr_vol.itemsize, unique, counts, mask_path, len(centerline_index))
 
         env_dict[env_count] = {'img': mpr_vol, 'mask': mask_vol}
         env_count += 1
@@ -198,6 +276,52 @@ def prepare_data(data_paths, n_classes):
 
     return all_idx_list, env_dict, labelweights
 
+def get_extent(foreground):
+    # largest in-plane distance of the foreground from the centre of each (H, W) slice, inf if empty
+    _, height, width = foreground.shape
+    rows = np.abs(np.arange(height) - (height - 1) / 2.0)
+    cols = np.abs(np.arange(width) - (width - 1) / 2.0)
+    distance = np.maximum(rows[:, None], cols[None, :])
+    extent = np.where(foreground, distance[None], -1).reshape(len(foreground), -1).max(1)
+    return np.where(extent < 0, np.inf, extent)
+
+def snap_roi_size(extent, buckets):
+    # smallest bucket whose centred crop holds the extent, the last (largest) bucket otherwise
+    buckets = np.array(buckets)
+    fits = (buckets[None] - 1) / 2.0 >= extent[:, None]
+    return np.where(fits.any(1), buckets[fits.argmax(1)], buckets[-1])
+
+def get_roi_sizes(idx_list, env_dict, args, with_labels=True):
+    # size of the centred crop of every sample with --adaptive_crop: the extent of the pixels above
+    # args.roi_hu, the same rule for every split, widened on labeled data to hold the extent of the
+    # labels too, plus args.roi_margin
+    buckets = sorted(set([item for item in args.roi_buckets if item < args.crop_size])) + [args.crop_size]
+    roi_sizes = np.full(len(idx_list), args.crop_size)
+    env_samples = {}
+    for i, (_, env_idx) in enumerate(idx_list):
+        env_samples.setdefault(env_idx, []).append(i)
+
+    for env_idx, samples in env_samples.items():
+        pt_ids = [idx_list[i][0] for i in samples]
+        extent = get_extent(env_dict[env_idx]['img'][pt_ids] >= args.roi_hu)
+        if with_labels:
+            label_extent = get_extent(env_dict[env_idx]['mask'][pt_ids] != 3)
+            extent = np.maximum(extent, np.where(np.isinf(label_extent), 0, label_extent))
+        roi_sizes[samples] = snap_roi_size(extent + args.roi_margin, buckets)
+    return roi_sizes.tolist()
+
+def get_roi_coverage(dataset):
+    # (plaque pixels inside the ROIs, all plaque pixels, slices with plaque outside their ROI) of a Probe_Dataset
+    inside, total, missed = 0, 0, 0
+    for (pt_idx, env_idx), roi_size in zip(dataset.idx_list, dataset.roi_sizes):
+        plaque = np.isin(dataset.env_dict[env_idx]['mask'][pt_idx], (1, 2))
+        plaque_num = int(plaque.sum())
+        if plaque_num == 0:
+            continue
+        kept = int(crop_volume(plaque[None], roi_size).sum())
+        inside, total, missed = inside + kept, total + plaque_num, missed + int(kept < plaque_num)
+    return inside, total, missed
+
 def center_crop(img, mask, crop_size):
     width, height, channel = np.shape(img)
     assert width >= crop_size, "crop_size should be smaller than img size"
@@ -220,11 +344,16 @@ def normalize(img):
     return img
 
 class Probe_Dataset(Dataset):
-    def __init__(self, data_paths, args):
+    def __init__(self, data_paths, args, roi_with_labels=True):
         self.data_paths = data_paths
         self.args = args
         # labelweights is used in the main function to alleviate unbalance problem
-        self.idx_list, self.env_dict, self.labelweights = prepare_data(self.data_paths, args.n_classes)
+        self.meta = {}
+        slices = args.slices if args.data_mode == '2.5D' else 1
+        self.idx_list, self.env_dict, self.labelweights = prepare_data(self.data_paths, args.n_classes, args.crop_size, self.meta,
+                                                                       args.volume_store, slices)
+        # with --adaptive_crop the images are cropped to a per-sample ROI, the masks stay whole
+        self.roi_sizes = get_roi_sizes(self.idx_list, self.env_dict, args, roi_with_labels) if args.adaptive_crop else None
 
     def __len__(self):
         length = len(self.idx_list)
@@ -235,28 +364,21 @@ class Probe_Dataset(Dataset):
         pt_idx, env_idx = self.idx_list[idx]
 
         if self.args.data_mode == '2D':
-            probe_img = self.env_dict[env_idx]['img'][pt_idx].astype(np.float)
-            probe_mask = self.env_dict[env_idx]['mask'][pt_idx].astype(np.float)
+            probe_img = self.env_dict[env_idx]['img'][pt_idx].astype(np.float32)
+            probe_mask = self.env_dict[env_idx]['mask'][pt_idx].astype(np.float32)
             probe_img = np.expand_dims(probe_img, axis=-1)
             probe_mask = np.expand_dims(probe_mask, axis=-1)
         elif self.args.data_mode == '2.5D':
-            img_stack_list = []
-            img_stack_list.append(self.env_dict[env_idx]['img'][pt_idx].astype(np.float))
-            step = int((self.args.slices - 1) / 2)
-            for i in range(step):
-                s_idx = max(pt_idx - sum([i for i in range(i+1)]), 0)
-                e_idx = min(pt_idx + sum([i for i in range(i+1)]), len(self.env_dict[env_idx]['img']) - 1)
-                img_stack_list.insert(0, self.env_dict[env_idx]['img'][s_idx].astype(np.float))
-                img_stack_list.insert(-1, self.env_dict[env_idx]['img'][e_idx].astype(np.float))
-
-            probe_img = np.stack(img_stack_list, axis=-1)
-            probe_mask = self.env_dict[env_idx]['mask'][pt_idx].astype(np.float)
+            probe_img = get_stack(self.env_dict[env_idx]['img'], pt_idx, self.args.slices)
+            probe_mask = self.env_dict[env_idx]['mask'][pt_idx].astype(np.float32)
             probe_mask = np.expand_dims(probe_mask, axis=-1)
         else:
             print(self.args.data_mode + " is not implemented.")
             raise NotImplementedError
 
         probe_img, probe_mask = center_crop(probe_img, probe_mask, self.args.crop_size)
+        if self.roi_sizes is not None:
+            probe_img = center_crop(probe_img, probe_img, self.roi_sizes[idx])[0]
         probe_mask = probe_mask.astype(np.int32)
         # probe_img = normalize(probe_img)
         sample = {'img': probe_img, 'mask': probe_mask}
@@ -264,6 +386,96 @@ class Probe_Dataset(Dataset):
         return sample
 
 
+class Stream_Dataset(IterableDataset):
+    """Stream the images of unlabeled branches through a rolling window.
+
+    Only ``args.stream_window`` branch images are resident per worker. Stacks drawn from the
+    window go through a shuffle buffer of ``args.shuffle_buffer`` samples, so memory is bounded
+    by the window and the buffer instead of by the size of the split. Masks are never loaded:
+    the slices to draw come from the centerline list recorded by ``record_centerline``.
+    """
+    def __init__(self, data_paths, args):
+        self.data_paths = data_paths
+        self.args = args
+
+        df = record_centerline(data_paths, args.centerline_list_dir)
+        slice_table = {}
+        for case_id, branch_id, slice_id in zip(df['case_id'], df['branch_id'], df['slice_id']):
+            slice_table.setdefault((str(case_id), str(branch_id)), []).append(int(slice_id))
+
+        # every slice gets a stable index, offset + position in the slice list of its branch
+        self.branches = []
+        self.num_slices = 0
+        for file_path in data_paths:
+            slice_ids = slice_table.get(get_branch_key(file_path), [])
+            if len(slice_ids) > 0:
+                self.branches.append((file_path, slice_ids, self.num_slices))
+                self.num_slices += len(slice_ids)
+
+    def __len__(self):
+        return self.num_slices
+
+    def load_branch(self, file_path):
+        import SimpleITK as sitk
+
+        img_vol = sitk.GetArrayFromImage(sitk.ReadImage(get_mpr_path(file_path)))
+        return compact_image(crop_volume(img_vol, self.args.crop_size))
+
+    def get_sample(self, img_vol, pt_idx, idx):
+        if self.args.data_mode == '2D':
+            probe_img = np.expand_dims(img_vol[pt_idx].astype(np.float32), axis=-1)
+        elif self.args.data_mode == '2.5D':
+            probe_img = get_stack(img_vol, pt_idx, self.args.slices)
+        else:
+            print(self.args.data_mode + " is not implemented.")
+            raise NotImplementedError
+
+        probe_img, _ = center_crop(probe_img, probe_img, self.args.crop_size)
+        return {'img': probe_img, 'idx': idx}
+
+    def __iter__(self):
+        # the branch order is shared by all workers of an epoch, each worker takes its own share
+        worker_info = get_worker_info()
+        if worker_info is None:
+            seed, worker_id, num_workers = int(torch.empty((), dtype=torch.int64).random_().item()), 0, 1
+        else:
+            seed, worker_id, num_workers = worker_info.seed - worker_info.id, worker_info.id, worker_info.num_workers
+
+        branches = list(self.branches)
+        random.Random(seed).shuffle(branches)
+        pending = iter(branches[worker_id::num_workers])
+        rng = random.Random(seed + worker_id + 1)
+
+        window, buffer = [], []
+        while True:
+            while len(window) < self.args.stream_window:
+                branch = next(pending, None)
+                if branch is None:
+                    break
+                file_path, slice_ids, offset = branch
+                positions = list(range(len(slice_ids)))
+                rng.shuffle(positions)
+                window.append((self.load_branch(file_path), slice_ids, offset, positions))
+
+            if len(window) == 0:
+                break
+
+            pick = rng.randrange(len(window))
+            img_vol, slice_ids, offset, positions = window[pick]
+            position = positions.pop()
+            buffer.append(self.get_sample(img_vol, slice_ids[position], offset + position))
+            if len(positions) == 0:
+                window.pop(pick)
+
+            if len(buffer) >= self.args.shuffle_buffer:
+                j = rng.randrange(len(buffer))
+                buffer[j], buffer[-1] = buffer[-1], buffer[j]
+                yield buffer.pop()
+
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield sample
+
 # if __name__ == "__main__":
 #     args = parse_args()
 #     args.data_dir = "/Users/gaoyibo/plaques/all_subset"
@@ -0,0 +1,71 @@
+import os
+import json
+import torch
+from main import get_parser
+from initialization import get_in_channels, load_inference_model
+
+
+def get_metadata(args, checkpoint_path):
+    # the 2.5D input contract, read back by runtime.py
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    return {
+        'data_mode': args.data_mode,
+        'slices': get_in_channels(args),
+        'crop_size': args.crop_size,
+        'n_classes': args.n_classes,
+        'labels': ['artery', 'hard plaque', 'soft plaque', 'background'][:args.n_classes],
+        'input': 'float32 NCHW stacks of raw HU, slices ordered as dataset.get_stack_index',
+        'output': 'float32 NCHW logits',
+        'weights': args.weights,
+        'epoch': int(checkpoint.get('epoch', -1)),
+        'checkpoint': os.path.abspath(checkpoint_path),
+    }
+
+def export_torchscript(model, example, metadata, path):
+    with torch.no_grad():
+        traced = torch.jit.trace(model, example)
+    torch.jit.save(traced, path, _extra_files={'metadata.json': json.dumps(metadata)})
+
+def export_onnx(model, example, metadata, path, opset):
+    torch.onnx.export(model, example, path, input_names=['img'], output_names=['logits'], opset_version=opset,
+                      dynamic_axes={'img': {0: 'batch_size'}, 'logits': {0: 'batch_size'}})
+
+    # embed the contract when the onnx package is there, the sidecar json is always written
+    try:
+        import onnx
+    except ImportError:
+        onnx = None
+    if onnx is not None:
+        onnx_model = onnx.load(path)
+        for key, value in metadata.items():
+            onnx_model.metadata_props.add(key=key, value=json.dumps(value))
+        onnx.save(onnx_model, path)
+
+    with open(os.path.splitext(path)[0] + '.json', 'w') as f:
+        json.dump(metadata, f, indent=1)
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument('--checkpoint', type=str, default=None, help='checkpoint to export [default: best_model.pth of the experiment]')
+    parser.add_argument('--weights', type=str, default='teacher', help='weights of the checkpoint: student or teacher')
+    parser.add_argument('--format', type=str, default='both', help='torchscript, onnx or both')
+    parser.add_argument('--output_dir', type=str, default=None, help='folder of the exported model [default: log dir of the experiment]')
+    parser.add_argument('--opset', type=int, default=13, help='onnx opset version')
+    args = parser.parse_args()
+
+    log_dir = os.path.join('./log', args.experiment_name)
+    checkpoint_path = args.checkpoint if args.checkpoint else os.path.join(log_dir, 'best_model.pth')
+    output_dir = args.output_dir if args.output_dir else log_dir
+    os.makedirs(output_dir, exist_ok=True)
+
+    model = load_inference_model(args, checkpoint_path, args.weights)
+    example = torch.randn(1, get_in_channels(args), args.crop_size, args.crop_size)
+    metadata = get_metadata(args, checkpoint_path)
+
+    if args.format in ('torchscript', 'both'):
+        export_torchscript(model, example, metadata, os.path.join(output_dir, 'model.pt'))
+        print('Saved %s' % os.path.join(output_dir, 'model.pt'))
+    if args.format in ('onnx', 'both'):
+        export_onnx(model, example, metadata, os.path.join(output_dir, 'model.onnx'), args.opset)
+        print('Saved %s' % os.path.join(output_dir, 'model.onnx'))
@@ -0,0 +1,53 @@
+import torch
+
+
+def get_amp_dtype(name):
+    if name == 'bfloat16':
+        return torch.bfloat16
+    elif name == 'float16':
+        return torch.float16
+    raise NotImplementedError(name)
+
+
+class FastMath(object):
+    """Forward, loss and optimizer step of train_mean_teacher, compiled and in mixed precision when enabled.
+
+    With --fast_math the student and teacher run as torch.compile'd modules in channels_last under
+    autocast, and the supervised and consistency losses are compiled as well. The compiled modules
+    share their parameters and buffers with model and ema_model, which stay float32: autocast only
+    casts the operands of each op, so the optimizer, the EMA update and the checkpoints all see
+    the float32 master weights. float16 needs gradient scaling and cuda, bfloat16 also runs on cpu.
+    Disabled, every member is the plain eager float32 counterpart.
+    """
+    def __init__(self, args, model, ema_model, criterion, consistency_criterion, enabled=True):
+        self.enabled = enabled
+        self.device_type = args.device.type
+        self.dtype = get_amp_dtype(args.amp_dtype)
+        assert not (enabled and self.dtype == torch.float16 and self.device_type != 'cuda'), 'float16 autocast needs cuda, use bfloat16 on cpu'
+
+        if enabled:
+            model.to(memory_format=torch.channels_last)
+            ema_model.to(memory_format=torch.channels_last)
+            self.stu_model = torch.compile(model, mode=args.compile_mode)
+            self.ema_model = torch.compile(ema_model, mode=args.compile_mode)
+            self.criterion = torch.compile(criterion, mode=args.compile_mode)
+            self.consistency_criterion = torch.compile(consistency_criterion, mode=args.compile_mode)
+        else:
+            self.stu_model, self.ema_model = model, ema_model
+            self.criterion, self.consistency_criterion = criterion, consistency_criterion
+
+        # a disabled scaler passes the loss through and calls optimizer.step() as is
+        self.scaler = torch.cuda.amp.GradScaler(enabled=enabled and self.dtype == torch.float16)
+
+    def autocast(self):
+        return torch.autocast(self.device_type, dtype=self.dtype, enabled=self.enabled)
+
+    def prepare(self, inputs):
+        if self.enabled:
+            return inputs.contiguous(memory_format=torch.channels_last)
+        return inputs
+
+    def backward(self, loss, optimizer):
+        self.scaler.scale(loss).backward()
+        self.scaler.step(optimizer)
+        self.scaler.update()
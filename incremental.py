@@ -0,0 +1,107 @@
+"""Incremental fine-tuning of a trained mean teacher on newly refined annotations.
+
+The branches whose masks changed since --init_checkpoint was trained are found from the
+annotations.json that main.py writes next to its checkpoints: the mask file in use, its size and
+its modification time. For a checkpoint without it, a branch counts as changed when the mask
+recorded in --meta_cache is not the one get_mask_path picks now, or when its mask was written
+after the checkpoint. The student and the teacher are warm-started from the checkpoint and
+fine-tuned over a short schedule. The labeled slices are drawn by ReplaySampler:
+--changed_fraction of every epoch comes from the changed branches, and the rest replays the
+unchanged ones so the old labels are not forgotten. The iterations, and an estimate of the
+time, saved against a full retrain are reported at the end.
+"""
+import os
+import time
+import math
+import numpy as np
+import torch
+from dataset import split_dataset, get_branch_key, Probe_Dataset
+from planning import load_meta_cache, save_meta_cache, save_annotations, get_annotation_state
+from sampler import ReplaySampler
+from main import get_parser, set_seed, make_dir_log, check_args, train_model
+
+
+def get_changed_branches(args, data_paths):
+    # branches of data_paths whose mask changed since the checkpoint was trained
+    manifest_path = os.path.join(os.path.dirname(args.init_checkpoint), 'annotations.json')
+    if os.path.exists(manifest_path):
+        manifest = load_meta_cache(manifest_path)
+        return [file_path for file_path in data_paths if manifest.get('/'.join(get_branch_key(file_path))) != get_annotation_state(file_path)]
+
+    args.log_string('No annotations.json next to %s, comparing with %s and the checkpoint time' % (args.init_checkpoint, args.meta_cache))
+    meta = load_meta_cache(args.meta_cache)
+    checkpoint_time = os.path.getmtime(args.init_checkpoint)
+    changed = []
+    for file_path in data_paths:
+        state = get_annotation_state(file_path)
+        branch_meta = meta.get('/'.join(get_branch_key(file_path)))
+        if state['mtime'] > checkpoint_time or (branch_meta is not None and branch_meta['mask_name'] != state['mask_name']):
+            changed.append(file_path)
+    return changed
+
+def get_iterations_per_epoch(args, labeled_num, unlabeled_num):
+    # iterations of an epoch of train_mean_teacher for the given numbers of slices
+    labeled_batches = math.ceil(labeled_num / args.batch_size)
+    if args.baseline:
+        return labeled_batches
+    return max(labeled_batches, math.ceil(unlabeled_num / args.batch_size))
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    full_epochs = parser.get_default('epoch')
+    parser.add_argument('--changed_fraction', type=float, default=0.5, help='share of every epoch drawn from the slices of the changed branches')
+    # a short schedule at a low rate, with the consistency of the trained teacher at full weight from the start
+    parser.set_defaults(experiment_name='incremental', epoch=20, learning_rate=1e-4, step_size=10, consistency_rampup=0.0)
+    args = parser.parse_args()
+    assert args.init_checkpoint is not None, 'the checkpoint to fine-tune is given by --init_checkpoint'
+    assert not args.over_sample, 'the over-sampled copies are not tracked by the replay sampler'
+    assert not args.stream_unlabeled, 'the streamed unlabeled split can not be cut to the short epochs'
+    assert not args.adaptive_crop, 'the replay sampler does not batch by ROI size'
+    assert not args.resume, '--resume continues a run, the fine-tuning warm-starts a new one'
+    if args.all_label:
+        args.labeled_num = args.labeled_num + args.unlabeled_num
+        args.unlabeled_num = 0
+    check_args(args)
+    set_seed(args)
+    make_dir_log(args)
+    args.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    # find the changed branches ---------------------------------------------------
+    unlabeled_dir, labeled_dir, val_dir = split_dataset(args)
+    changed_dir = get_changed_branches(args, labeled_dir + val_dir)
+    changed_labeled = set(changed_dir).intersection(labeled_dir)
+    args.log_string('%d changed labeled branches, %d changed validation branches' % (len(changed_labeled), len(changed_dir) - len(changed_labeled)))
+    for file_path in changed_dir:
+        args.log_string('Changed: %s (%s)' % ('/'.join(get_branch_key(file_path)), get_annotation_state(file_path)['mask_name']))
+    if not changed_labeled:
+        args.log_string('No labeled branch changed, nothing to fine-tune')
+        raise SystemExit(0)
+
+    # datasets with the current masks ----------------------------------------------
+    unlabeled_set = Probe_Dataset(unlabeled_dir, args)
+    labeled_set = Probe_Dataset(labeled_dir, args)
+    val_set = Probe_Dataset(val_dir, args)
+    save_meta_cache(args.meta_cache, {key: value for item in (unlabeled_set, labeled_set, val_set) for key, value in getattr(item, 'meta', {}).items()})
+    save_annotations(os.path.join(str(args.log_dir), 'annotations.json'), labeled_dir + val_dir)
+
+    changed_env = set([env_idx for env_idx, file_path in enumerate(labeled_dir) if file_path in changed_labeled])
+    changed = np.array([env_idx in changed_env for _, env_idx in labeled_set.idx_list])
+    labeled_sampler = ReplaySampler(changed, args.epoch_length, args.changed_fraction)
+    args.log_string('%d of %d labeled slices changed, %d slices drawn per epoch' % (changed.sum(), len(changed), len(labeled_sampler)))
+
+    # fine-tune ---------------------------------------------------------------------
+    start_time = time.time()
+    best_dice, best_metric = train_model(args, unlabeled_set, labeled_set, val_set, labeled_sampler)
+    elapsed = time.time() - start_time
+
+    # compute saved against a full retrain --------------------------------------------
+    unlabeled_num = len(labeled_set) if args.all_label else len(unlabeled_set)
+    iterations = args.epoch * get_iterations_per_epoch(args, len(labeled_sampler), min(len(labeled_sampler), unlabeled_num))
+    full_iterations = full_epochs * get_iterations_per_epoch(args, len(labeled_set), unlabeled_num)
+    args.log_string('Incremental result -----------------------------------------')
+    args.log_string('Best mean dice: {}'.format(best_dice))
+    args.log_string('Best class dice: {}'.format(best_metric))
+    args.log_string('Fine-tuned %d iterations in %.1f minutes, a full retrain of %d epochs is %d iterations (about %.1f minutes at this speed)' % (
+        iterations, elapsed / 60, full_epochs, full_iterations, elapsed / max(iterations, 1) * full_iterations / 60))
+    args.log_string('Saved %.1f%% of the training iterations' % (100.0 * (1 - iterations / full_iterations)))
@@ -1,22 +1,36 @@
 import os
 import importlib
 import torch
-from losses import CrossEntropy, DiceLossMulticlass_CW, FocalLoss
-from tensorboardX import SummaryWriter
-
-def initialization(args):
-    MODEL = importlib.import_module(args.model)
+from losses import CrossEntropy, DiceLossMulticlass_CW, FocalLoss, FocalDiceLoss
 
+def get_in_channels(args):
     # decide the input channel of the network according to the data_mode
     if args.data_mode == '2D':
-        initial_channel = 1
+        return 1
     elif args.data_mode == '2.5D':
-        initial_channel = args.slices
+        return args.slices
     else:
         raise NotImplementedError
 
-    model = MODEL.get_module(initial_channel, args.n_classes, 4, 4, True, True).to(args.device)
-    ema_model = MODEL.get_module(initial_channel, args.n_classes, 4, 4, True, True).to(args.device)
+def load_inference_model(args, checkpoint_path, weights='teacher'):
+    # build the network and load the student or teacher weights of a checkpoint for inference
+    MODEL = importlib.import_module(args.model)
+    model = MODEL.get_module(get_in_channels(args), args.n_classes, args.depth, args.wf, True, True)
+
+    checkpoint = torch.load(checkpoint_path, map_location='cpu')
+    if weights == 'teacher' and 'ema_model_state_dict' in checkpoint:
+        model.load_state_dict(checkpoint['ema_model_state_dict'])
+    else:
+        model.load_state_dict(checkpoint['model_state_dict'])
+
+    return model.eval()
+
+def initialization(args):
+    MODEL = importlib.import_module(args.model)
+    initial_channel = get_in_channels(args)
+
+    model = MODEL.get_module(initial_channel, args.n_classes, args.depth, args.wf, True, True, memory_efficient=args.memory_efficient).to(args.device)
+    ema_model = MODEL.get_module(initial_channel, args.n_classes, args.depth, args.wf, True, True, memory_efficient=args.memory_efficient).to(args.device)
 
     def weights_init(m):
         classname = m.__class__.__name__
@@ -34,6 +48,13 @@ def initialization(args):
         if not args.baseline:
             ema_model.load_state_dict(checkpoint['ema_model_state_dict'])
         args.log_string('Use pretrain model')
+    elif args.init_checkpoint is not None:
+        # warm start: the weights only, the epochs and the optimizer start anew
+        checkpoint = torch.load(args.init_checkpoint, map_location='cpu')
+        start_epoch = 0
+        model.load_state_dict(checkpoint['model_state_dict'])
+        ema_model.load_state_dict(checkpoint.get('ema_model_state_dict', checkpoint['model_state_dict']))
+        args.log_string('Warm start from %s' % args.init_checkpoint)
     else:
         args.log_string('No existing model, starting training from scratch...')
         model = model.apply(weights_init)
@@ -53,10 +74,17 @@ def initialization(args):
         criterion = CrossEntropy()
     elif args.loss_func == 'focal_loss':
         criterion = FocalLoss(args.ignore_index)
+    elif args.loss_func == 'fused_focal':
+        criterion = FocalDiceLoss(args.ignore_index)
+    elif args.loss_func == 'fused_dice':
+        criterion = FocalDiceLoss(args.ignore_index, focal_weight=0.0, dice_weight=1.0)
+    elif args.loss_func == 'focal_dice':
+        criterion = FocalDiceLoss(args.ignore_index, dice_weight=args.dice_weight)
     else:
         print('unknown loss function:{}'.format(args.loss_func))
 
     # writer initializtion ---------------------------------------------
+    from tensorboardX import SummaryWriter
     writer = SummaryWriter(os.path.join(args.log_dir, args.experiment_name))
 
     return model, ema_model, optimizer, criterion, start_epoch, writer
@@ -0,0 +1,149 @@
+"""k-fold cross-validation of the mean teacher.
+
+The labeled and validation cases of split_dataset form the pool that is cut into folds, at case
+level, seeded and stratified by the presence of soft plaque. The unlabeled cases stay unlabeled
+in every fold. The volumes are decoded once in the parent process; the folds run as forked
+worker processes that share these pages copy-on-write instead of decoding them again. The best
+per-class Dice of every fold is aggregated into a mean and a standard deviation.
+"""
+import os
+import json
+import logging
+import time
+import queue
+import numpy as np
+import torch
+import multiprocessing
+from dataset import get_branch_paths, get_branch_key, get_roi_sizes, Probe_Dataset, Stream_Dataset
+from planning import get_labelweights
+from main import get_parser, set_seed, make_dir_log, check_args, train_model
+
+# decoded datasets, set before the folds are forked so that they are inherited and never pickled
+STORE = {}
+
+
+def get_case_folds(args, pool_cases, soft_cases):
+    # case ids of every fold, cases with and without soft plaque are dealt out in turn
+    rng = np.random.RandomState(args.fold_seed)
+    with_soft = [case for case in pool_cases if case in soft_cases]
+    without_soft = [case for case in pool_cases if case not in soft_cases]
+    rng.shuffle(with_soft)
+    rng.shuffle(without_soft)
+
+    folds = [[] for _ in range(args.folds)]
+    for i, case in enumerate(with_soft + without_soft):
+        folds[i % args.folds].append(case)
+    return folds
+
+def get_soft_cases(meta):
+    # cases with at least one soft plaque voxel, label 2 once remapped
+    return set([key.split('/')[0] for key, value in meta.items() if value['label_counts'][2] > 0])
+
+def subset_dataset(dataset, data_paths, args, roi_with_labels=True):
+    # Probe_Dataset over some branches of a decoded one, sharing its volumes
+    env_map = {}
+    positions = dict([(path, i) for i, path in enumerate(dataset.data_paths)])
+    for path in data_paths:
+        env_map[positions[path]] = len(env_map)
+
+    subset = Probe_Dataset.__new__(Probe_Dataset)
+    subset.data_paths = data_paths
+    subset.args = args
+    subset.meta = dict([('/'.join(get_branch_key(path)), dataset.meta['/'.join(get_branch_key(path))]) for path in data_paths])
+    subset.idx_list = [(pt_idx, env_map[env_idx]) for pt_idx, env_idx in dataset.idx_list if env_idx in env_map]
+    subset.env_dict = dict([(env_map[env_idx], dataset.env_dict[env_idx]) for env_idx in env_map])
+    subset.labelweights = get_labelweights([item['label_counts'] for item in subset.meta.values()], args.n_classes)
+    subset.roi_sizes = get_roi_sizes(subset.idx_list, subset.env_dict, args, roi_with_labels) if args.adaptive_crop else None
+    return subset
+
+def run_fold(args, fold, labeled_paths, val_paths, results):
+    args.experiment_name = '%s_fold%d' % (args.experiment_name, fold)
+    set_seed(args)
+    # the forked child inherits the handler of the parent log, the fold logs only to its own
+    logger = logging.getLogger("Model")
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    make_dir_log(args)
+    if torch.cuda.is_available():
+        args.device = torch.device('cuda:%d' % (fold % torch.cuda.device_count()))
+    else:
+        args.device = torch.device('cpu')
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // args.fold_workers))
+
+    labeled_set = subset_dataset(STORE['pool'], labeled_paths, args)
+    val_set = subset_dataset(STORE['pool'], val_paths, args, roi_with_labels=False)
+    best_dice, best_metric = train_model(args, STORE['unlabeled'], labeled_set, val_set)
+    results.put((fold, float(best_dice), [float(item) for item in best_metric]))
+
+def wait_fold(running, results, fold_results):
+    # block until a running fold reports, failing if one died without reporting
+    while True:
+        try:
+            fold, best_dice, class_dice = results.get(timeout=10)
+        except queue.Empty:
+            for fold, process in running.items():
+                if not process.is_alive() and process.exitcode != 0:
+                    raise RuntimeError('fold %d exited with code %d' % (fold, process.exitcode))
+            continue
+        running.pop(fold).join()
+        fold_results[fold] = (best_dice, class_dice)
+        return
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument('--folds', type=int, default=5, help='number of folds')
+    parser.add_argument('--fold_seed', type=int, default=0, help='seed of the case split into folds')
+    parser.add_argument('--fold_workers', type=int, default=2, help='folds trained at the same time')
+    args = parser.parse_args()
+    assert not args.over_sample, 'the over-sampled slices are chosen by case range, which folds do not follow'
+    assert not args.all_label, 'the folds need the unlabeled and pool cases apart'
+    check_args(args)
+    set_seed(args)
+    make_dir_log(args)
+    args.device = torch.device('cpu')  # cuda is only initialized in the forked folds
+
+    # decode the volumes once ------------------------------------------------------
+    case_dirs = [os.path.join(args.data_dir, str(i)) for i in range(150)]
+    unlabeled_dir = get_branch_paths(args, case_dirs[:args.unlabeled_num])
+    pool_dir = get_branch_paths(args, case_dirs[args.unlabeled_num:])
+    STORE['unlabeled'] = Stream_Dataset(unlabeled_dir, args) if args.stream_unlabeled else Probe_Dataset(unlabeled_dir, args, roi_with_labels=False)
+    STORE['pool'] = Probe_Dataset(pool_dir, args)
+
+    pool_cases = sorted(set([get_branch_key(path)[0] for path in pool_dir]), key=int)
+    soft_cases = get_soft_cases(STORE['pool'].meta)
+    case_folds = get_case_folds(args, pool_cases, soft_cases)
+    for fold, cases in enumerate(case_folds):
+        args.log_string('Fold %d: %d cases, %d with soft plaque: %s' % (fold, len(cases), len([case for case in cases if case in soft_cases]), sorted(cases, key=int)))
+
+    # train the folds in forked processes ----------------------------------------------
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    running, fold_results = {}, {}
+    start_time = time.time()
+    for fold, cases in enumerate(case_folds):
+        while len(running) >= args.fold_workers:
+            wait_fold(running, results, fold_results)
+        val_paths = [path for path in pool_dir if get_branch_key(path)[0] in cases]
+        labeled_paths = [path for path in pool_dir if get_branch_key(path)[0] not in cases]
+        process = context.Process(target=run_fold, args=(args, fold, labeled_paths, val_paths, results))
+        process.start()
+        running[fold] = process
+    while running:
+        wait_fold(running, results, fold_results)
+
+    # aggregate ---------------------------------------------------------------------
+    mean_dice = np.array([fold_results[fold][0] for fold in range(args.folds)])
+    class_dice = np.array([fold_results[fold][1] for fold in range(args.folds)])
+    args.log_string('Cross-validation result -----------------------------------------')
+    for fold in range(args.folds):
+        args.log_string('Fold %d mean dice %.4f, class dice %s' % (fold, mean_dice[fold], np.around(class_dice[fold], 4)))
+    args.log_string('Mean dice %.4f +- %.4f' % (mean_dice.mean(), mean_dice.std()))
+    args.log_string('Class dice mean %s' % np.around(class_dice.mean(0), 4))
+    args.log_string('Class dice std %s' % np.around(class_dice.std(0), 4))
+    args.log_string('%d folds trained in %.1f minutes' % (args.folds, (time.time() - start_time) / 60))
+
+    with open(os.path.join(str(args.log_dir), 'kfold.json'), 'w') as f:
+        json.dump({'folds': [sorted(cases, key=int) for cases in case_folds],
+                   'mean_dice': mean_dice.tolist(), 'class_dice': class_dice.tolist(),
+                   'class_dice_mean': class_dice.mean(0).tolist(), 'class_dice_std': class_dice.std(0).tolist()}, f, indent=1)
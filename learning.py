@@ -1,9 +1,12 @@
+import time
 import torch
 import torch.nn.functional as F
 from tqdm import tqdm
 import numpy as np
-from losses import softmax_mse_loss
+from sampler import HardSliceSampler
 from transformations import *
+from augmentation import augment_batch
+from teacher_pipeline import TeacherPipeline
 
 
 def sigmoid_rampup(current, rampup_length):
@@ -17,11 +20,45 @@ def sigmoid_rampup(current, rampup_length):
 def get_current_consistency_weight(args, epoch):
     return args.consistency * sigmoid_rampup(epoch, args.consistency_rampup)
 
+def get_train_crop_size(args, epoch):
+    # progressive resolution: progressive_crops[i] is trained on until epoch progressive_epochs[i]
+    for crop_size, until_epoch in zip(args.progressive_crops, args.progressive_epochs):
+        if epoch < until_epoch:
+            return crop_size
+    return args.crop_size
+
+def check_budget(args, elapsed_time, iter_count):
+    # returns the compute budget that is used up, or None
+    if args.time_budget is not None and elapsed_time >= args.time_budget * 60:
+        return 'time budget of %.1f minutes used' % args.time_budget
+    if args.iter_budget is not None and iter_count >= args.iter_budget:
+        return 'iteration budget of %d iterations used' % args.iter_budget
+    return None
+
 def update_ema_variables(model, ema_model, alpha, global_step):
     alpha = min(1 - 1 / (global_step + 1), alpha)
     for ema_param, param in zip(ema_model.parameters(), model.parameters()):
         ema_param.data.mul_(alpha).add_(param.data, alpha=1 - alpha)  # add_(other， alpha)为torch.add()的in-place版， 直接替换，加上other * alpha
 
+def cycle(loader):
+    # endless iterator over a loader, restarted whenever it is exhausted
+    while True:
+        for data in loader:
+            yield data
+
+def load_unlabeled_batch(args, unlabeled_train_iter, fast_math):
+    # (inputs, batch, seconds waited for data) of the next unlabeled batch, ready for the models
+    start = time.perf_counter()
+    data = next(unlabeled_train_iter)
+    inputs_stu = data['img']
+    if args.prefetchers is None:
+        inputs_stu = inputs_stu.permute(0, 3, 1, 2).to(args.device).float()  # (12, 1, 96, 96)
+    wait = time.perf_counter() - start
+
+    if 'aug_seed' in data:
+        inputs_stu, _ = augment_batch(inputs_stu, None, data['aug_seed'].numpy(), args.seed)
+    return fast_math.prepare(center_crop_tensor(inputs_stu, min(args.train_crop_size, inputs_stu.shape[-1]))), data, wait
+
 def train(args, global_epoch, train_loader, model, optimizer, criterion, writer):
 
     model.train()
@@ -92,15 +129,18 @@ def validate(args, global_epoch, val_loader, model, optimizer, criterion, writer
             mask = mask.permute(0,3,1,2).to(args.device)
 
             output = model(img)
+            # with --adaptive_crop the loss is taken over the ROI, the predictions are pasted back
+            # into the whole crop where every pixel outside the ROI belongs to no class
+            roi_mask = center_crop_tensor(mask, output.shape[-1])
+            preds = F.softmax(output, dim=1).data.max(1, keepdim=True)[1]
+            preds = paste_center_tensor(preds, mask.shape[-1], args.n_classes).view(preds.size(0), -1)
             output = output.contiguous().view(output.size(0), args.n_classes, -1)  # (batch_size, 4, 96 * 96)
-            mask = mask.contiguous().view(mask.size(0), 1, -1)  # (batch_size, 1, 96 * 96)
+            roi_mask = roi_mask.contiguous().view(roi_mask.size(0), 1, -1)  # (batch_size, 1, 96 * 96)
+            mask = mask.contiguous().view(mask.size(0), -1)
 
-            loss = criterion(output, mask, args.n_classes, weights=args.n_weights)
+            loss = criterion(output, roi_mask, args.n_classes, weights=args.n_weights)
             loss_sum += loss.item()
 
-            preds = F.softmax(output, dim=1).data.max(1)[1]
-            mask = torch.squeeze(mask, 1)
-
             preds = preds.cpu().numpy()
             mask = mask.cpu().numpy()
 
@@ -127,6 +167,25 @@ def validate(args, global_epoch, val_loader, model, optimizer, criterion, writer
 
     return (mean_dice, dice_classes, mean_loss)
 
+def predict_teacher(ema_model, inputs):
+    # teacher logits on a randomly transformed copy, brought back to the frame of the inputs
+    inputs_ema = torch.clone(inputs)
+
+    with torch.no_grad():
+        # trans_inputs_u2 = transforms_for_noise(inputs_u2)  # noise transform
+        trans_inputs_ema, rot_mask = transforms_for_rot(inputs_ema)  # rotation transform
+        trans_inputs_ema, flip_mask = transforms_for_flip(trans_inputs_ema)  # flip transform
+        trans_inputs_ema, scale_mask = transforms_for_scale(trans_inputs_ema)  # scale transform
+
+        outputs_ema = ema_model(trans_inputs_ema).float()  # the inverse transforms go through numpy
+
+        # undo the transforms in reverse order to align the teacher with the student
+        outputs_ema = transforms_back_scale(outputs_ema, scale_mask)
+        outputs_ema = transforms_back_flip(outputs_ema, flip_mask)
+        outputs_ema = transforms_back_rot(outputs_ema, rot_mask)
+
+    return outputs_ema
+
 def train_mean_teacher(args, global_epoch, labeled_loader, unlabeled_loader, stu_model, ema_model, optimizer, criterion, writer):
 
     total_inter_class = [0 for _ in range(args.n_classes)]
@@ -143,70 +202,127 @@ def train_mean_teacher(args, global_epoch, labeled_loader, unlabeled_loader, stu
     stu_model.train()
     ema_model.train()
 
+    # compiled mixed-precision counterparts with --fast_math, the eager float32 modules otherwise
+    fast_math = args.fast_math_step
+    stu_forward, ema_forward = fast_math.stu_model, fast_math.ema_model
+    consistency_criterion = fast_math.consistency_criterion
+
+    # refresh the whole teacher cache in a separate pass
+    if args.teacher_cache is not None:
+        args.teacher_cache.reset_counts()
+    if args.teacher_cache is not None and args.teacher_cache_refresh > 0 and global_epoch % args.teacher_cache_refresh == 0:
+        with fast_math.autocast():
+            args.teacher_cache.refresh(unlabeled_loader, lambda x: predict_teacher(ema_forward, fast_math.prepare(x)), global_epoch * num_iteration_per_epoch,
+                                       args.device, args.train_crop_size, args.seed)
+
+    # with --prefetch the batches come on the device already, in the (batch_size, C, H, W) layout
+    if args.prefetchers is not None:
+        labeled_train_iter, unlabeled_train_iter = args.prefetchers['labeled'], args.prefetchers.get('unlabeled')
+    else:
+        labeled_train_iter, unlabeled_train_iter = cycle(labeled_loader), cycle(unlabeled_loader)
+    data_wait = 0.0
+
+    # with --pipeline_teacher the teacher of batch i+1 runs on a thread during the student step i
+    pipeline, pending = None, None
+    if args.pipeline_teacher and not args.baseline:
+        pipeline = TeacherPipeline(lambda x: predict_teacher(ema_forward, x), args.device, fast_math.autocast)
+    epoch_start = time.perf_counter()
+    processed_slices, processed_pixels = 0, 0
+    num_iterations = 0
+
     for batch_idx in tqdm(range(num_iteration_per_epoch)):
 
         total_inter_class_tmp = [0 for _ in range(args.n_classes)]
         total_union_class_tmp = [0 for _ in range(args.n_classes)]
+        iter_num = batch_idx + global_epoch * num_iteration_per_epoch
 
-        try:
-            data = labeled_train_iter.next()
-        except:
-            labeled_train_iter = iter(labeled_loader)
-            data = labeled_train_iter.next()
-        
+        start = time.perf_counter()
+        data = next(labeled_train_iter)
         inputs_x, targets_x = data['img'], data['mask']
-        inputs_x = inputs_x.permute(0,3,1,2).to(args.device).float()
-        targets_x = targets_x.permute(0,3,1,2).to(args.device)
-
-        inputs_x, targets_x = inputs_x.to(args.device), targets_x.to(args.device)
+        idx_x = data.get('idx')
+        if args.prefetchers is None:
+            inputs_x = inputs_x.permute(0,3,1,2).to(args.device).float()
+            targets_x = targets_x.permute(0,3,1,2).to(args.device)
+        data_wait += time.perf_counter() - start
+
+        # with --adaptive_crop the images come cropped to their ROI, the targets are cut to match
+        targets_x = center_crop_tensor(targets_x, inputs_x.shape[-1])
+        if 'aug_seed' in data:  # --augmentation device
+            inputs_x, targets_x = augment_batch(inputs_x, targets_x, data['aug_seed'].numpy(), args.seed)
+        inputs_x = center_crop_tensor(inputs_x, min(args.train_crop_size, inputs_x.shape[-1]))
+        targets_x = center_crop_tensor(targets_x, inputs_x.shape[-1])
+        inputs_x = fast_math.prepare(inputs_x)
 
         if not args.baseline:
-            try:
-                data = unlabeled_train_iter.next()
-            except:
-                unlabeled_train_iter = iter(unlabeled_loader)
-                data = unlabeled_train_iter.next()
-            
-            inputs_stu = data['img']
-            inputs_stu = inputs_stu.permute(0, 3, 1, 2).to(args.device).float()  # (12, 1, 96, 96)
-            inputs_ema = torch.clone(inputs_stu)
-            
+            if pipeline is None:
+                inputs_stu, data, wait = load_unlabeled_batch(args, unlabeled_train_iter, fast_math)
+                data_wait += wait
+                with fast_math.autocast():
+                    if args.teacher_cache is None:
+                        outputs_ema = predict_teacher(ema_forward, inputs_stu)
+                    else:
+                        outputs_ema = args.teacher_cache.lookup(data['idx'], inputs_stu, lambda x: predict_teacher(ema_forward, x), iter_num)
+            else:
+                # the teacher of this batch ran during the previous step, start the one of the next batch
+                if pending is None:
+                    inputs_stu, _, wait = load_unlabeled_batch(args, unlabeled_train_iter, fast_math)
+                    data_wait += wait
+                    pipeline.submit(inputs_stu)
+                    pending = (inputs_stu, pipeline.result())
+                inputs_stu, outputs_ema = pending
+                pending = None
+                if batch_idx + 1 < num_iteration_per_epoch:
+                    inputs_next, _, wait = load_unlabeled_batch(args, unlabeled_train_iter, fast_math)
+                    data_wait += wait
+                    pipeline.submit(inputs_next)
+
+            with fast_math.autocast():
+                outputs_stu = stu_forward(inputs_stu)
+
+        for item in ((inputs_x, inputs_stu) if not args.baseline else (inputs_x,)):
+            processed_slices += item.shape[0]
+            processed_pixels += item.shape[0] * item.shape[-2] * item.shape[-1]
+
+        with fast_math.autocast():
+            logits_x = stu_forward(inputs_x)
+            logits_x = logits_x.contiguous().view(logits_x.size(0), args.n_classes, -1)  # (batch_size, 4, 96 * 96)
+            targets_x = targets_x.contiguous().view(targets_x.size(0), 1, -1)  # (batch_size, 1, 96 * 96)
+
+            Lx = fast_math.criterion(logits_x, targets_x.long(), args.n_classes, args.n_weights)
+
+        # feed the per-slice loss back to the hard-slice sampler
+        if isinstance(labeled_loader.sampler, HardSliceSampler):
             with torch.no_grad():
-                # trans_inputs_u2 = transforms_for_noise(inputs_u2)  # noise transform
-                trans_inputs_ema, rot_mask = transforms_for_rot(inputs_ema)  # rotation transform
-                trans_inputs_ema, flip_mask = transforms_for_flip(trans_inputs_ema)  # flip transform
-                trans_inputs_ema, scale_mask = transforms_for_scale(trans_inputs_ema)  # scale transform
-
-                outputs_ema = ema_model(trans_inputs_ema)
-                outputs_stu = stu_model(inputs_stu)
-
-                trans_outputs_stu = transforms_back_scale(outputs_stu, scale_mask)
-                trans_outputs_stu = transforms_back_flip(trans_outputs_stu, flip_mask)
-                trans_outputs_stu = transforms_back_rot(trans_outputs_stu, rot_mask)
-        
-        iter_num = batch_idx + global_epoch * num_iteration_per_epoch
-
-        logits_x = stu_model(inputs_x)
-        logits_x = logits_x.contiguous().view(logits_x.size(0), args.n_classes, -1)  # (batch_size, 4, 96 * 96)
-        targets_x = targets_x.contiguous().view(targets_x.size(0), 1, -1)  # (batch_size, 1, 96 * 96)
-
-        Lx = criterion(logits_x, targets_x.long(), args.n_classes, args.n_weights)
+                targets_flat = torch.squeeze(targets_x, 1).long()
+                pixel_loss = F.cross_entropy(logits_x.detach().float(), targets_flat, ignore_index=args.ignore_index, reduction='none')
+                valid_num = (targets_flat != args.ignore_index).sum(1).clamp(min=1)
+                sample_loss = pixel_loss.sum(1) / valid_num
+            labeled_loader.sampler.update(idx_x.numpy(), sample_loss.cpu().numpy())
 
         if not args.baseline:
             consistency_weight = get_current_consistency_weight(args, global_epoch)
-            consistency_dist = softmax_mse_loss(outputs_ema, trans_outputs_stu).mean()
+            with fast_math.autocast():
+                consistency_dist = consistency_criterion(outputs_stu, outputs_ema)
             Lu = consistency_weight * consistency_dist
             loss = Lx + Lu
         else:
             loss = Lx
 
         optimizer.zero_grad()
-        loss.backward()
-        optimizer.step()
+        fast_math.backward(loss, optimizer)
+
+        # the teacher of the next batch must be done before the teacher weights change
+        if pipeline is not None and pipeline.future is not None:
+            pending = (inputs_next, pipeline.result())
 
         if not args.baseline:
-            update_ema_variables(stu_model, ema_model, args.ema_decay, iter_num)
+            # a warm-started teacher is averaged at the full decay from the first step
+            ema_step = iter_num if args.init_checkpoint is None else float('inf')
+            update_ema_variables(stu_model, ema_model, args.ema_decay, ema_step)
         
+        if args.memory_report_interval > 0 and (iter_num + 1) % args.memory_report_interval == 0:
+            args.memory_monitor.report()
+
         writer.add_scalar('loss/train_loss', loss, iter_num)
         writer.add_scalar('loss/train_loss_supervised', Lx, iter_num)
         if not args.baseline:
@@ -225,7 +341,36 @@ def train_mean_teacher(args, global_epoch, labeled_loader, unlabeled_loader, stu
             total_inter_class[l] += total_inter_class_tmp[l]
             total_union_class[l] += total_union_class_tmp[l]
 
+        # a used budget ends the epoch here, train_model then stops after validating
+        num_iterations = batch_idx + 1
+        if check_budget(args, time.time() - args.train_start_time, args.train_iter_count + num_iterations) is not None:
+            args.log_string('Compute budget used after %d of %d iterations of the epoch' % (num_iterations, num_iteration_per_epoch))
+            break
+
+    iteration_time = (time.perf_counter() - epoch_start) / num_iterations
+    if pipeline is not None:
+        args.log_string('Teacher wait per step: %.2f ms' % (1e3 * pipeline.wait_time / num_iterations))
+        pipeline.close()
+
     dice_classes = (np.array(total_inter_class) * 2) / (np.array(total_inter_class) + np.array(total_union_class))
 
     args.log_string('Training class dice %s:' %(np.around(dice_classes, 4)))
     args.log_string('Training mean dice %s:' %(np.around(np.mean(dice_classes), 4)))
+    args.log_string('Data wait per step: %.2f ms' % (1e3 * data_wait / num_iterations))
+    writer.add_scalar('misc/data_wait_ms', 1e3 * data_wait / num_iterations, global_epoch)
+    args.log_string('Time per iteration: %.2f ms' % (1e3 * iteration_time))
+    args.log_string('Pixels per epoch: %.1f M, throughput %.1f slices/s' % (processed_pixels / 1e6, processed_slices / (iteration_time * num_iterations)))
+    writer.add_scalar('misc/pixels_per_epoch', processed_pixels, global_epoch)
+    writer.add_scalar('misc/slices_per_second', processed_slices / (iteration_time * num_iterations), global_epoch)
+    writer.add_scalar('misc/iteration_ms', 1e3 * iteration_time, global_epoch)
+
+    if args.teacher_cache is not None:
+        args.log_string('Teacher cache hit rate: %f' % args.teacher_cache.get_hit_rate())
+        writer.add_scalar('misc/teacher_cache_hit_rate', args.teacher_cache.get_hit_rate(), global_epoch)
+        audit_dice = args.teacher_cache.get_audit_dice()
+        if audit_dice is not None:
+            args.log_string('Teacher cache dice of the cached against fresh predictions (staleness %d): class %s, mean %f' % (
+                args.teacher_cache_staleness, np.around(audit_dice, 4), np.mean(audit_dice)))
+            writer.add_scalar('misc/teacher_cache_dice', np.mean(audit_dice), global_epoch)
+
+    return num_iterations
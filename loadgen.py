@@ -0,0 +1,71 @@
+"""Load generator for server.py.
+
+Runs --concurrency clients, each sending per-branch requests of a random number of stacks, and
+prints the client side throughput and latency next to the metrics reported by the server.
+"""
+import io
+import json
+import time
+import argparse
+import threading
+import numpy as np
+from urllib.request import Request, urlopen
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Loadgen')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8080', help='address of the server')
+    parser.add_argument('--concurrency', type=int, default=8, help='clients sending requests at the same time')
+    parser.add_argument('--requests', type=int, default=200, help='requests sent by each client')
+    parser.add_argument('--min_stacks', type=int, default=1, help='min number of stacks in a request')
+    parser.add_argument('--max_stacks', type=int, default=16, help='max number of stacks in a request')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the requests')
+    return parser.parse_args()
+
+
+def get_metrics(url):
+    with urlopen(url + '/metrics') as response:
+        return json.loads(response.read())
+
+def send(url, stacks):
+    body = io.BytesIO()
+    np.save(body, stacks)
+    request = Request(url + '/predict', data=body.getvalue(), headers={'Content-Type': 'application/octet-stream'})
+    with urlopen(request) as response:
+        return np.load(io.BytesIO(response.read()), allow_pickle=False)
+
+def client(args, contract, seed, latencies, num_stacks):
+    rng = np.random.RandomState(seed)
+    shape = (contract['slices'], contract['crop_size'], contract['crop_size'])
+    for _ in range(args.requests):
+        n = rng.randint(args.min_stacks, args.max_stacks + 1)
+        stacks = rng.randint(-1024, 1024, size=(n,) + shape).astype(np.int16)
+        start = time.perf_counter()
+        masks = send(args.url, stacks)
+        latencies.append(time.perf_counter() - start)
+        assert masks.shape == (n, contract['crop_size'], contract['crop_size'])
+        num_stacks.append(n)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    contract = get_metrics(args.url)
+
+    latencies, num_stacks = [], []
+    threads = [threading.Thread(target=client, args=(args, contract, args.seed + i, latencies, num_stacks)) for i in range(args.concurrency)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = np.array(latencies) * 1e3
+    print('client: %d requests, %d stacks in %.1f s, %.1f requests/s, %.1f stacks/s' % (
+        len(latencies), sum(num_stacks), elapsed, len(latencies) / elapsed, sum(num_stacks) / elapsed))
+    print('client: latency p50 %.1f ms, p99 %.1f ms' % (np.percentile(latencies, 50), np.percentile(latencies, 99)))
+
+    metrics = get_metrics(args.url)
+    print('server: %d batches, mean batch size %.1f, fill rate %.2f, queue depth %d' % (
+        metrics['batches'], metrics['mean_batch_size'], metrics['batch_fill_rate'], metrics['queue_depth']))
+    print('server: latency p50 %.1f ms, p99 %.1f ms' % (metrics['latency_p50_ms'], metrics['latency_p99_ms']))
@@ -95,6 +95,80 @@ class FocalLoss_Pixel(nn.Module):
 
         return self.balanced_param * wf
 
+class MaskedProbSum(torch.autograd.Function):
+    """Per-class sum of exp(log_probs) over the valid pixels, computed one class at a time.
+
+    log_probs is (batch_size, n_classes, pixels) and valid is (batch_size, pixels). The backward
+    recomputes the probabilities of a class from log_probs, which log_softmax already keeps for
+    its own backward, so no full-size probability map is built or saved.
+    """
+
+    @staticmethod
+    def forward(ctx, log_probs, valid):
+        ctx.save_for_backward(log_probs, valid)
+        return torch.stack([log_probs[:, c][valid].exp().sum() for c in range(log_probs.size(1))])
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        log_probs, valid = ctx.saved_tensors
+        grad_input = torch.zeros_like(log_probs)
+        for c in range(log_probs.size(1)):
+            grad_input[:, c][valid] = log_probs[:, c][valid].exp() * grad_output[c]
+        return grad_input, None
+
+class FocalDiceLoss(nn.Module):
+    """Focal loss, Dice loss or their weighted sum from a single log_softmax.
+
+    The focal term matches FocalLoss and the Dice term matches the class-weighted
+    DiceLossMulticlass_CW, but the target log-probabilities are gathered once and the Dice
+    intersections are accumulated per class with index_add instead of a dense one-hot. The
+    class-weighted Dice takes the probability sums from MaskedProbSum, one class at a time.
+    Pixels labelled ignore_index are left out of both terms.
+    """
+
+    def __init__(self, ignore_index, focusing_param=2, focal_weight=1.0, dice_weight=0.0):
+        super(FocalDiceLoss, self).__init__()
+
+        self.ignore_index = ignore_index
+        self.focusing_param = focusing_param
+        self.focal_weight = focal_weight
+        self.dice_weight = dice_weight
+        self.smooth = 1e-5
+
+    def forward(self, output, target, n_classes, weights=None):
+
+        target = torch.squeeze(target, 1).long()  # (batch_size, 96 * 96)
+        output = F.log_softmax(output, 1)  # (batch_size, n_classes, 96 * 96)
+
+        valid = target != self.ignore_index
+        logpt = output.gather(1, torch.where(valid, target, torch.zeros_like(target)).unsqueeze(1)).squeeze(1)
+        logpt, target = logpt[valid], target[valid]
+
+        loss = output.new_zeros(())
+
+        if self.focal_weight != 0:
+            mean_logpt = logpt.mean()
+            pt = torch.exp(mean_logpt)
+            if weights is not None:
+                pixel_weights = weights.type_as(logpt)[target]
+                mean_logpt = (pixel_weights * logpt).sum() / pixel_weights.sum()
+            loss = loss + self.focal_weight * -((1 - pt) ** self.focusing_param) * mean_logpt
+
+        if self.dice_weight != 0:
+            intersection = output.new_zeros(output.size(1)).index_add(0, target, torch.exp(logpt))
+            if weights is None:
+                # the softmax of every valid pixel sums to one
+                summ = valid.sum() + target.numel()
+                dice_loss = 1 - ((2. * intersection.sum()) / (summ + self.smooth))
+            else:
+                prob_sum = MaskedProbSum.apply(output, valid)
+                summ = prob_sum + torch.bincount(target, minlength=output.size(1)).type_as(output)
+                dice_loss = 1 - ((2. * intersection) / (summ + self.smooth))
+                dice_loss = (dice_loss * (weights / weights.sum()).type_as(output)).mean()
+            loss = loss + self.dice_weight * dice_loss
+
+        return loss
+
 def softmax_mse_loss(input_logits, target_logits):
     assert input_logits.size() == target_logits.size()
     input_softmax = F.softmax(input_logits, dim=1)
@@ -106,4 +180,41 @@ def softmax_kl_loss(input_logits, target_logits):
     assert input_logits.size() == target_logits.size()
     input_log_softmax = F.log_softmax(input_logits, dim=1)
     target_softmax = F.softmax(target_logits, dim=1)
-    return F.kl_divider(input_log_softmax, target_softmax, size_average=False)
\ No newline at end of file
+    return F.kl_div(input_log_softmax, target_softmax, reduction='sum')
+
+class ConsistencyLoss(nn.Module):
+    """Mean-teacher consistency between student and teacher logits, reduced to a scalar.
+
+    consistency_type is mse, kl, masked_mse or masked_kl. Both terms are averaged over pixels
+    (and classes for mse), like softmax_mse_loss(...).mean(). The masked variants only keep the
+    pixels where the teacher is at least threshold confident; their logits are selected before
+    the softmax so no full-size student probability map is built.
+    """
+
+    def __init__(self, consistency_type='mse', threshold=0.8):
+        super(ConsistencyLoss, self).__init__()
+        if consistency_type not in ('mse', 'kl', 'masked_mse', 'masked_kl'):
+            print('unknown consistency type:{}'.format(consistency_type))
+            raise NotImplementedError
+
+        self.consistency_type = consistency_type
+        self.threshold = threshold
+
+    def forward(self, stu_logits, ema_logits):
+        assert stu_logits.size() == ema_logits.size()
+        ema_logits = ema_logits.detach()
+
+        if self.consistency_type.startswith('masked'):
+            confidence = F.softmax(ema_logits, dim=1).max(1)[0]  # (batch_size, 96, 96)
+            keep = confidence >= self.threshold
+            # (kept_pixels, n_classes), the masked pixels never reach the softmax
+            stu_logits = stu_logits.permute(0, 2, 3, 1)[keep]
+            ema_logits = ema_logits.permute(0, 2, 3, 1)[keep]
+            if stu_logits.size(0) == 0:
+                return stu_logits.sum()
+        n_pixels = stu_logits.numel() // stu_logits.size(1)
+
+        if self.consistency_type.endswith('mse'):
+            return F.mse_loss(F.softmax(stu_logits, dim=1), F.softmax(ema_logits, dim=1), reduction='sum') / stu_logits.numel()
+        else:
+            return F.kl_div(F.log_softmax(stu_logits, dim=1), F.log_softmax(ema_logits, dim=1), reduction='sum', log_target=True) / n_pixels
\ No newline at end of file
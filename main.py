@@ -1,21 +1,25 @@
-import torch
+import os
+import time
 import random
 import logging
-import numpy as np
 import argparse
+import numpy as np
 from pathlib import Path
-from dataset import split_dataset, Probe_Dataset
-from torch.utils.data import DataLoader, ConcatDataset
-from initialization import initialization
-from learning import validate, train_mean_teacher
-from over_sample import AugmentDataset
+from planning import dry_run, save_meta_cache, save_annotations
+# torch and the training modules are imported where they are used, so that --dry_run stays light
 # from dataset import count_dataset, record_dataset
 
 
-def parse_args():
+def get_parser():
     parser = argparse.ArgumentParser('Model')
     parser.add_argument('--experiment_name', type=str, default='experiment', help='unique name for each experiment')
     parser.add_argument('--model', type=str, default='Vnet', help='model architecture: Vnet, cosnet')
+    parser.add_argument('--depth', type=int, default=4, help='depth of the Vnet')
+    parser.add_argument('--wf', type=int, default=4, help='the first layer of the Vnet has 2**wf filters')
+    parser.add_argument('--memory_efficient', action='store_true', help='checkpoint the Vnet blocks and use in-place ReLUs')
+    parser.add_argument('--fast_math', action='store_true', help='train with compiled models and losses, autocast and channels_last')
+    parser.add_argument('--amp_dtype', type=str, default='bfloat16', help='autocast dtype of --fast_math: bfloat16 or float16 (cuda only)')
+    parser.add_argument('--compile_mode', type=str, default='default', help='torch.compile mode of --fast_math')
     parser.add_argument('--data_mode', type=str, default='2.5D', help='data mode')
     parser.add_argument('--dataset_mode', type=str, default='all_branch', help='dataset mode be to used: main_branch or all_branch')
     parser.add_argument('--slices', type=int, default=7, help='slices used in the 2.5D mode')
@@ -30,28 +34,53 @@ def parse_args():
     parser.add_argument('--lr_decay', type=float, default=0.8, help='Decay rate for lr decay [default: 0.7]')
     parser.add_argument('--lr_clip', type=float, default=1e-4, help='learning rate clip')
     parser.add_argument('--optimizer', type=str, default='Adam', help='Adam or SGD [default: Adam]')
-    parser.add_argument('--loss_func', type=str, default='focal_loss', help='Loss function used for training [default: dice]')
+    parser.add_argument('--loss_func', type=str, default='focal_loss', help='Loss function used for training: dice, cross_entropy, focal_loss, fused_focal, fused_dice or focal_dice')
+    parser.add_argument('--dice_weight', type=float, default=1.0, help='weight of the dice term of the focal_dice loss')
     parser.add_argument('--step_size', type=int, default=50, help='Decay step')
+    parser.add_argument('--adaptive_crop', action='store_true', help='crop every slice to the smallest bucket holding its vessel, batched per bucket')
+    parser.add_argument('--roi_buckets', type=int, nargs='+', default=[32, 48], help='crop sizes of --adaptive_crop below crop_size, the largest bucket')
+    parser.add_argument('--roi_margin', type=int, default=4, help='pixels kept around the labels or the bright lumen by --adaptive_crop')
+    parser.add_argument('--roi_hu', type=int, default=150, help='HU above which a pixel of an unlabeled or validation slice belongs to the lumen')
+    parser.add_argument('--progressive_crops', type=int, nargs='*', default=[], help='smaller crop sizes trained on first, e.g. 32 48')
+    parser.add_argument('--progressive_epochs', type=int, nargs='*', default=[], help='epoch until which each progressive crop is used, e.g. 50 100')
+    parser.add_argument('--patience', type=int, default=None, help='stop after this many epochs without improvement of the monitored dice')
+    parser.add_argument('--min_delta', type=float, default=0.0, help='smallest dice gain counted as an improvement')
+    parser.add_argument('--monitor', type=str, default='best', help='dice monitored for early stopping: student, teacher or best of both')
+    parser.add_argument('--time_budget', type=float, default=None, help='stop after this many minutes of training')
+    parser.add_argument('--iter_budget', type=int, default=None, help='stop after this many training iterations')
+    parser.add_argument('--target_dice', type=float, default=None, help='log the wall-clock time until the validation dice reaches it')
     parser.add_argument('--ignore_index', type=int, default=3, help="ignore the given label index [default: 3(backgroud)]")
 
     # do not change following flags
     parser.add_argument('--n_weights', type=int, default=None, help='Weights for classes of segmentation or classification')
     parser.add_argument('--resume', action="store_true", help='whether to resume from the checkpoint')
+    parser.add_argument('--init_checkpoint', type=str, default=None, help='warm-start the student and teacher weights from this checkpoint')
     parser.add_argument('--log_string', type=str, default=None, help='log string wrapper [default: None]')
     parser.add_argument('--device', type=str, default=None, help='set device type')
+    parser.add_argument('--memory_budget', type=float, default=None, help='memory budget in GB, a warning is emitted near it and training stops with a MemoryError past it')
+    parser.add_argument('--memory_report_interval', type=int, default=500, help='iterations between memory reports, 0 to disable')
 
     # path configurations
     parser.add_argument('--log_dir', type=str, default=None, help='Log path [default: None]')
     parser.add_argument('--aug_list_dir', default='./plaque_info.csv', type=str)
+    parser.add_argument('--meta_cache', default='./meta_info.json', type=str, help='metadata of decoded branches, used by --dry_run')
+    parser.add_argument('--dry_run', action='store_true', help='print the split sizes, slice counts, class weights and memory without decoding')
     parser.add_argument('--data_dir', default='/Users/gaoyibo/Datasets/plaques/all_subset_v3', help='folder name for training set')
+    parser.add_argument('--volume_store', default=None, type=str, help='chunked store written by volume_store.py, read instead of the .nii.gz files')
     # parser.add_argument('--data_dir', default='/mnt/lustre/wanghuan3/gaoyibo/all_subset_v3', help='folder name for training set')
 
     # mean-teacher learning configurations
     parser.add_argument('--baseline', action='store_true')
-    parser.add_argument('--consistency-type', type=str, default='mse', help='select the type of consistency criterion')
+    parser.add_argument('--consistency-type', type=str, default='mse', help='select the type of consistency criterion: mse, kl, masked_mse or masked_kl')
+    parser.add_argument('--consistency_threshold', type=float, default=0.8, help='teacher confidence kept by the masked consistency criteria')
     parser.add_argument('--consistency', type=float, default=10.0)
     parser.add_argument('--consistency_rampup', type=float, default=200.0)
     parser.add_argument('--ema-decay', type=float, default=0.999)
+    parser.add_argument('--pipeline_teacher', action='store_true', help='run the teacher of the next unlabeled batch on a thread during the student step, one EMA update behind')
+    parser.add_argument('--cache_teacher', action='store_true', help='cache the teacher predictions of the unlabeled slices')
+    parser.add_argument('--teacher_cache_staleness', type=int, default=200, help='iterations after which a cached teacher prediction is recomputed')
+    parser.add_argument('--teacher_cache_refresh', type=int, default=0, help='refresh the whole teacher cache every this many epochs, 0 to disable')
+    parser.add_argument('--teacher_cache_audit', type=int, default=50, help='iterations between comparisons of cached and fresh teacher predictions, 0 to disable')
 
     # mean-teacher data configurations
     parser.add_argument('--case_num', type=int, default=150, help='the num of total case')
@@ -60,10 +89,28 @@ def parse_args():
     parser.add_argument('--all_label', action='store_true', help='full supervised configuration if set true')
     parser.add_argument('--over_sample', action="store_true")
     parser.add_argument('--times', default=5, type=int)
+    parser.add_argument('--augmentation', type=str, default='none', help='affine augmentation of the over-sampled slices: none, imgaug, worker or device')
+    parser.add_argument('--hard_sampler', action='store_true', help='draw labeled slices with a probability rising with their loss')
+    parser.add_argument('--sampler_floor', default=0.1, type=float, help='probability mass spread uniformly by the hard-slice sampler')
+    parser.add_argument('--sampler_momentum', default=0.9, type=float, help='momentum of the running per-slice loss')
+    parser.add_argument('--epoch_length', default=None, type=int, help='labeled slices drawn per epoch by the hard-slice sampler, the epoch then lasts as many batches')
+
+    # unlabeled streaming configurations
+    parser.add_argument('--stream_unlabeled', action='store_true', help='stream the unlabeled split instead of loading it into memory')
+    parser.add_argument('--stream_window', default=8, type=int, help='branches resident per loader worker when streaming')
+    parser.add_argument('--shuffle_buffer', default=2048, type=int, help='samples in the shuffle buffer when streaming')
+    parser.add_argument('--prefetch', action='store_true', help='prepare the next training batches on a background thread, sent as int16 and uint8')
+    parser.add_argument('--prefetch_depth', default=2, type=int, help='batches prepared ahead by each prefetcher')
+    parser.add_argument('--centerline_list_dir', default='./centerline_info.csv', type=str, help='precomputed centerline slice list')
     
-    return parser.parse_args()
+    return parser
+
+def parse_args():
+    return get_parser().parse_args()
 
 def set_seed(args):
+    import torch
+
     torch.manual_seed(args.seed)
     torch.cuda.manual_seed_all(args.seed)
     torch.cuda.manual_seed(args.seed)
@@ -94,9 +141,54 @@ def make_dir_log(args):
     logger.addHandler(file_handler)
     log_string(args)
 
+def save_checkpoint(args, epoch, model, ema_model, optimizer, name):
+    import torch
+
+    savepath = str(args.log_dir) + '/' + name
+    args.log_string('Saving at %s' % savepath)
+    state = {
+        'epoch': epoch,
+        'model_state_dict': model.state_dict(),
+        'optimizer_state_dict': optimizer.state_dict(),
+    }
+
+    if not args.baseline:
+        state['ema_model_state_dict'] = ema_model.state_dict()
+
+    torch.save(state, savepath)
+
+def check_stop(args, epochs_without_improvement, elapsed_time, iter_count):
+    # returns the reason to stop training early, or None
+    from learning import check_budget
+
+    if args.patience is not None and epochs_without_improvement >= args.patience:
+        return 'no improvement of the %s dice for %d epochs' % (args.monitor, epochs_without_improvement)
+    return check_budget(args, elapsed_time, iter_count)
+
+def check_args(args):
+    assert args.monitor in ('student', 'teacher', 'best'), "unknown monitor: %s" % args.monitor
+    assert not (args.baseline and args.monitor == 'teacher'), "the baseline has no teacher to monitor"
+    assert not (args.pipeline_teacher and args.cache_teacher), "the pipelined teacher does not go through the teacher cache"
+    assert not (args.hard_sampler and args.epoch_length is not None and args.stream_unlabeled), "the streamed unlabeled split can not be cut to --epoch_length"
+
+    # check the progressive resolution schedule ---------------------------
+    assert len(args.progressive_crops) == len(args.progressive_epochs), "every progressive crop needs an epoch"
+    for crop_size in args.progressive_crops + [args.crop_size] + (args.roi_buckets if args.adaptive_crop else []):
+        assert crop_size % 2 ** (args.depth - 1) == 0, "crop size %d is not divisible by 2**(depth-1)" % crop_size
+
+    # the per-sample crops of --adaptive_crop need batches of one size ---------
+    if args.adaptive_crop:
+        assert not args.hard_sampler, "the hard-slice sampler does not batch by ROI size"
+        assert not args.stream_unlabeled, "the streamed unlabeled split has no ROI sizes"
+        assert not args.cache_teacher, "the teacher cache holds predictions of the whole crop"
+
 def main(args):
+    import torch
+    from dataset import split_dataset, Probe_Dataset, Stream_Dataset
+
     # set device used -----------------------------------------------
     args.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    check_args(args)
 
     # print dataset information ------------------------------------
     # record_dataset(args)
@@ -105,35 +197,131 @@ def main(args):
     # prepare dataset --------------------------------------------
     unlabeled_dir, labeled_dir, val_dir = split_dataset(args)
 
-    unlabeled_set = Probe_Dataset(unlabeled_dir, args)
+    # the ROIs come from the image for every split, the labels only widen the ones of the labeled split
+    if args.stream_unlabeled:
+        unlabeled_set = Stream_Dataset(unlabeled_dir, args)
+    else:
+        unlabeled_set = Probe_Dataset(unlabeled_dir, args, roi_with_labels=False)
     labeled_set = Probe_Dataset(labeled_dir, args)
-    val_set = Probe_Dataset(val_dir, args)
+    val_set = Probe_Dataset(val_dir, args, roi_with_labels=False)
+
+    save_meta_cache(args.meta_cache, {key: value for item in (unlabeled_set, labeled_set, val_set) for key, value in getattr(item, 'meta', {}).items()})
+    save_annotations(os.path.join(str(args.log_dir), 'annotations.json'), labeled_dir + val_dir)
+
+    return train_model(args, unlabeled_set, labeled_set, val_set)
+
+def train_model(args, unlabeled_set, labeled_set, val_set, labeled_sampler=None):
+    # train the mean teacher on decoded datasets, returns the best (mean dice, class dice)
+    # a labeled_sampler sets the epoch length, the unlabeled slices are then drawn to match it
+    import torch
+    from torch.utils.data import DataLoader, ConcatDataset, RandomSampler
+    from dataset import get_resident_bytes, get_roi_coverage
+    from initialization import initialization
+    from learning import validate, train_mean_teacher, get_train_crop_size
+    from sampler import HardSliceSampler, IndexedDataset, BucketBatchSampler, get_dataset_roi_sizes
+    from teacher_cache import TeacherCache
+    from memory import MemoryMonitor
+    from losses import ConsistencyLoss
+    from fast_math import FastMath
+    from augmentation import AugmentCollate
+    from prefetcher import CompactCollate, Prefetcher
 
     args.n_weights = torch.tensor(labeled_set.labelweights).float().to(args.device)
     args.log_string("Weights for classes:{}".format(args.n_weights))
 
     if args.over_sample:
-        unlabeled_set = ConcatDataset([AugmentDataset(args, 'unlabel'), unlabeled_set])
-        labeled_set = ConcatDataset([AugmentDataset(args, 'label'), labeled_set])
+        from over_sample import AugmentDataset  # imgaug and pandas are only needed here
+
+        if not args.stream_unlabeled:  # an IterableDataset can not be concatenated
+            unlabeled_set = ConcatDataset([AugmentDataset(args, 'unlabel', args.augmentation), unlabeled_set])
+        labeled_set = ConcatDataset([AugmentDataset(args, 'label', args.augmentation), labeled_set])
         # labeled_set = AugmentDataset(args, 'label')
 
+    # batched affine augmentation of the over-sampled slices, in the loader workers or on the device
+    collate_fn = None
+    if args.over_sample and args.augmentation in ('worker', 'device'):
+        collate_fn = AugmentCollate(args.seed, on_device=args.augmentation == 'device')
+    if args.prefetch:
+        collate_fn = CompactCollate(collate_fn)
+    if labeled_sampler is None and args.hard_sampler and args.epoch_length is not None:
+        # --epoch_length labeled slices make an epoch, the unlabeled loader is cut to match
+        labeled_sampler = HardSliceSampler(labeled_set, args.epoch_length, args.sampler_momentum, args.sampler_floor)
+
     try:
-        labeled_loader = DataLoader(labeled_set, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
-        val_loader = DataLoader(val_set, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
-        unlabeled_loader = DataLoader(unlabeled_set, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
+        # training batches carry the index of their samples, see IndexedDataset
+        if args.adaptive_crop:
+            # the per-sample crops are batched per ROI size, see BucketBatchSampler
+            labeled_batches = BucketBatchSampler(get_dataset_roi_sizes(labeled_set, args.crop_size), args.batch_size)
+            unlabeled_batches = BucketBatchSampler(get_dataset_roi_sizes(unlabeled_set, args.crop_size), args.batch_size)
+            labeled_loader = DataLoader(IndexedDataset(labeled_set), batch_sampler=labeled_batches, num_workers=args.num_workers, collate_fn=collate_fn)
+            val_loader = DataLoader(val_set, batch_sampler=BucketBatchSampler(val_set.roi_sizes, args.batch_size), num_workers=args.num_workers)
+            unlabeled_loader = DataLoader(IndexedDataset(unlabeled_set), batch_sampler=unlabeled_batches, num_workers=args.num_workers, collate_fn=collate_fn)
+        else:
+            if labeled_sampler is not None:
+                labeled_loader = DataLoader(IndexedDataset(labeled_set), batch_size=args.batch_size, sampler=labeled_sampler, num_workers=args.num_workers, collate_fn=collate_fn)
+            elif args.hard_sampler:
+                hard_sampler = HardSliceSampler(labeled_set, args.epoch_length, args.sampler_momentum, args.sampler_floor)
+                labeled_loader = DataLoader(IndexedDataset(labeled_set), batch_size=args.batch_size, sampler=hard_sampler, num_workers=args.num_workers, collate_fn=collate_fn)
+            else:
+                labeled_loader = DataLoader(IndexedDataset(labeled_set), batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, collate_fn=collate_fn)
+            val_loader = DataLoader(val_set, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
+            if args.stream_unlabeled:
+                unlabeled_loader = DataLoader(unlabeled_set, batch_size=args.batch_size, num_workers=args.num_workers, collate_fn=collate_fn)
+            elif labeled_sampler is not None:
+                unlabeled_sampler = RandomSampler(unlabeled_set, num_samples=min(len(labeled_sampler), len(unlabeled_set)))
+                unlabeled_loader = DataLoader(IndexedDataset(unlabeled_set), batch_size=args.batch_size, sampler=unlabeled_sampler, num_workers=args.num_workers, collate_fn=collate_fn)
+            else:
+                unlabeled_loader = DataLoader(IndexedDataset(unlabeled_set), batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers, collate_fn=collate_fn)
     except:
         print("Empty unlabel_set")
 
     args.log_string("The number of unlabeled data is %d" % len(unlabeled_set))
     args.log_string("The number of labeled data is %d" % len(labeled_set))
     args.log_string("The number of validation data is %d" % len(val_set))
+    for split_name, split_set in zip(('unlabeled', 'labeled', 'validation'), (unlabeled_set, labeled_set, val_set)):
+        args.log_string("Resident bytes of the %s data: %.1f MB" % (split_name, get_resident_bytes(split_set) / 2 ** 20))
+        if args.adaptive_crop:
+            roi_sizes = np.array(get_dataset_roi_sizes(split_set, args.crop_size))
+            args.log_string("ROI sizes of the %s data: %s, %.1f%% of the pixels of whole crops" % (
+                split_name, dict(zip(*[item.tolist() for item in np.unique(roi_sizes, return_counts=True)])),
+                100.0 * np.sum(roi_sizes ** 2) / max(len(roi_sizes) * args.crop_size ** 2, 1)))
+    if args.adaptive_crop:
+        # the validation ROIs see no labels, the plaque outside them is predicted as no class
+        inside, total, missed = get_roi_coverage(val_set)
+        args.log_string("Validation ROIs hold %d of %d plaque pixels (%.2f%%), %d slices have plaque outside their ROI" % (
+            inside, total, 100.0 * inside / max(total, 1), missed))
+
+    # teacher cache, indexed like the loader used as unlabeled loader ------------
+    args.teacher_cache = None
+    if args.cache_teacher and not args.baseline:
+        teacher_set = labeled_set if args.all_label else unlabeled_set
+        args.teacher_cache = TeacherCache(str(args.log_dir) + '/teacher_cache.npy', len(teacher_set), args.n_classes, args.teacher_cache_staleness,
+                                          args.teacher_cache_audit)
+
+    # background prefetch of the training batches ------------------------------
+    args.prefetchers = None
+    if args.prefetch:
+        args.prefetchers = {'labeled': Prefetcher(labeled_loader, args.device, args.prefetch_depth)}
+        if not args.baseline:
+            args.prefetchers['unlabeled'] = Prefetcher(labeled_loader if args.all_label else unlabeled_loader, args.device, args.prefetch_depth)
 
     # initialization -----------------------------------------------------
     model, ema_model, optimizer, criterion, start_epoch, writer = initialization(args)
+    args.fast_math_step = FastMath(args, model, ema_model, criterion, ConsistencyLoss(args.consistency_type, args.consistency_threshold), enabled=args.fast_math)
+
+    args.memory_monitor = MemoryMonitor(args, {'unlabeled': unlabeled_set, 'labeled': labeled_set, 'validation': val_set},
+                                        {'student': model, 'teacher': ema_model}, args.memory_budget)
+    args.memory_monitor.report(full=True)
 
     global_epoch = 0
     best_epoch = 0
     best_dice = 0
+    start_time = time.time()
+    target_reached = False
+    best_monitor = 0
+    epochs_without_improvement = 0
+    iter_count = 0
+    stop_reason = None
 
     for epoch in range(start_epoch, args.epoch):
         args.log_string('**** Epoch %d (%d/%s) ****' % (global_epoch + 1, epoch + 1, args.epoch))
@@ -145,25 +333,19 @@ def main(args):
         for param_group in optimizer.param_groups:
             param_group['lr'] = lr
 
-        # train --------------------------------------------------------------
+        args.train_crop_size = get_train_crop_size(args, epoch)
+        writer.add_scalar('misc/train_crop_size', args.train_crop_size, epoch)
+        args.log_string('Training crop size:%d' % args.train_crop_size)
+
+        # train, the budgets are also checked at every iteration -------------------------------
+        args.train_start_time, args.train_iter_count = start_time, iter_count
         if args.all_label:
-            train_mean_teacher(args, global_epoch, labeled_loader, labeled_loader, model, ema_model, optimizer, criterion, writer)
+            iter_count += train_mean_teacher(args, global_epoch, labeled_loader, labeled_loader, model, ema_model, optimizer, criterion, writer)
         else:
-            train_mean_teacher(args, global_epoch, labeled_loader, unlabeled_loader, model, ema_model, optimizer, criterion, writer)
+            iter_count += train_mean_teacher(args, global_epoch, labeled_loader, unlabeled_loader, model, ema_model, optimizer, criterion, writer)
 
         if epoch % 5 == 0:
-            savepath = str(args.log_dir) + '/model.pth'
-            args.log_string('Saving at %s' %savepath)
-            state = {
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-            }
-
-            if not args.baseline:
-                state['ema_model_state_dict'] = ema_model.state_dict()
-            
-            torch.save(state, savepath)
+            save_checkpoint(args, epoch, model, ema_model, optimizer, 'model.pth')
 
         # validate student model ------------------------------------------------------------
         val_result = validate(args, global_epoch, val_loader, model, optimizer, criterion, writer, is_ema=False)
@@ -172,6 +354,8 @@ def main(args):
         args.log_string('Val class dice %s:' % (val_result[1]))
         args.log_string('Val mean dice %s:' % (val_result[0]))
         
+        monitor_dice = val_result[0]
+
         # validate teacher model ------------------------------------------------------------
         if not args.baseline:
             ema_val_result = validate(args, global_epoch, val_loader, ema_model, optimizer, criterion, writer, is_ema=True)
@@ -180,6 +364,11 @@ def main(args):
             args.log_string('Ema val class dice %s:' % (ema_val_result[1]))
             args.log_string('Ema val mean dice %s:' % (ema_val_result[0]))
             
+            if args.monitor == 'teacher':
+                monitor_dice = ema_val_result[0]
+            elif args.monitor == 'best':
+                monitor_dice = max(monitor_dice, ema_val_result[0])
+
             if ema_val_result[0] > val_result[0]:
                 val_result = ema_val_result
 
@@ -191,25 +380,45 @@ def main(args):
             best_dice = val_result[0]
             best_metric = val_result[1]
             best_epoch = epoch
+            save_checkpoint(args, epoch, model, ema_model, optimizer, 'best_model.pth')
 
-            savepath = str(args.log_dir) + '/best_model.pth'
-            args.log_string('Saving at %s' % savepath)
-            state = {
-                'epoch': epoch,
-                'model_state_dict': model.state_dict(),
-                'optimizer_state_dict': optimizer.state_dict(),
-            }
+        if monitor_dice > best_monitor + args.min_delta:
+            best_monitor = monitor_dice
+            epochs_without_improvement = 0
+        else:
+            epochs_without_improvement += 1
 
-            if not args.baseline:
-                state['ema_model_state_dict'] = ema_model.state_dict()
-            
-            torch.save(state, savepath)
+        if args.target_dice is not None and not target_reached and best_dice >= args.target_dice:
+            target_reached = True
+            args.log_string('Target dice %f reached at epoch %d after %.1f minutes' % (args.target_dice, epoch + 1, (time.time() - start_time) / 60))
 
         args.log_string('Current best result -----------------------------------------------')
         args.log_string('Best Epoch, Dice and Result: %d, %f, %s' %(best_epoch, best_dice, best_metric))
         
         global_epoch += 1
 
+        # early stopping and compute budget ---------------------------------------------------
+        stop_reason = check_stop(args, epochs_without_improvement, time.time() - start_time, iter_count)
+        if stop_reason is not None:
+            save_checkpoint(args, epoch, model, ema_model, optimizer, 'model.pth')
+            break
+
+    if args.teacher_cache is not None:
+        args.teacher_cache.close()
+    if args.prefetchers is not None:
+        for prefetcher in args.prefetchers.values():
+            prefetcher.close()
+
+    args.log_string('Training summary -----------------------------------------------')
+    args.log_string('Trained %d epochs (%d iterations) in %.1f minutes' % (global_epoch, iter_count, (time.time() - start_time) / 60))
+    if stop_reason is not None:
+        saved_epochs = args.epoch - start_epoch - global_epoch
+        args.log_string('Stopped early: %s' % stop_reason)
+        args.log_string('Saved %d of %d epochs (%.1f%%)' % (saved_epochs, args.epoch - start_epoch, 100.0 * saved_epochs / (args.epoch - start_epoch)))
+    if args.teacher_cache is not None:
+        # compare with the best dice of runs at other staleness settings or without the cache
+        args.log_string('Best dice with a teacher cache staleness of %d iterations: %f' % (args.teacher_cache_staleness, best_dice))
+
     return best_dice, best_metric
 
 
@@ -221,10 +430,13 @@ if __name__ == "__main__":
         args.labeled_num = args.labeled_num + args.unlabeled_num
         args.unlabeled_num = 0
 
-    set_seed(args)
-    make_dir_log(args)
-    best_mean_dice, best_class_dice = main(args)
+    if args.dry_run:
+        dry_run(args)
+    else:
+        set_seed(args)
+        make_dir_log(args)
+        best_mean_dice, best_class_dice = main(args)
 
-    args.log_string('Final result -----------------------------------------')
-    args.log_string('Best mean dice: {}'.format(best_mean_dice))
-    args.log_string('Best class dice: {}'.format(best_class_dice))
+        args.log_string('Final result -----------------------------------------')
+        args.log_string('Best mean dice: {}'.format(best_mean_dice))
+        args.log_string('Best class dice: {}'.format(best_class_dice))
@@ -0,0 +1,130 @@
+import os
+import sys
+import warnings
+import torch
+from dataset import get_resident_bytes
+
+
+def to_mb(n_bytes):
+    return n_bytes / 2 ** 20
+
+def get_idx_list_bytes(dataset):
+    # bytes of the idx_list of a dataset: the list, its tuples and their ints
+    if hasattr(dataset, 'datasets'):
+        return sum([get_idx_list_bytes(item) for item in dataset.datasets])
+    if not hasattr(dataset, 'idx_list'):
+        return 0
+
+    n_bytes = sys.getsizeof(dataset.idx_list)
+    for item in dataset.idx_list:
+        n_bytes += sys.getsizeof(item) + sum([sys.getsizeof(value) for value in item])
+    return n_bytes
+
+def get_idx_list_len(dataset):
+    if hasattr(dataset, 'datasets'):
+        return sum([get_idx_list_len(item) for item in dataset.datasets])
+    return len(getattr(dataset, 'idx_list', []))
+
+def read_process_memory(pid):
+    # (rss, pss) in bytes of a process, None where /proc is not available
+    values = {}
+    try:
+        with open('/proc/%d/smaps_rollup' % pid) as f:
+            for line in f:
+                key, value = line.split(':', 1)
+                if key in ('Rss', 'Pss'):
+                    values[key] = int(value.split()[0]) * 1024
+    except (IOError, OSError, ValueError):
+        return None
+    return values.get('Rss', 0), values.get('Pss', 0)
+
+def get_peak_rss():
+    # peak RSS in bytes of the training process, None where getrusage is not available
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024  # bytes on macOS, KB on Linux
+
+def get_child_pids(pid):
+    # the DataLoader workers are children of the training process
+    child_pids = []
+    try:
+        for tid in os.listdir('/proc/%d/task' % pid):
+            with open('/proc/%d/task/%s/children' % (pid, tid)) as f:
+                child_pids += [int(item) for item in f.read().split()]
+    except (IOError, OSError):
+        pass
+    return child_pids
+
+
+class MemoryMonitor(object):
+    """Log where the memory of a training run goes and warn before it exceeds a budget.
+
+    Reports the decoded volumes and idx_list of every dataset, the RSS and PSS of the training
+    process and of each of its DataLoader workers, and the peak memory of the models: the peak
+    of the cuda allocator, or on cpu the peak RSS of the training process. The budget, in GB, is
+    compared with the PSS summed over the training process and its workers, which does not count
+    twice the pages shared through fork. Near the budget a warning is emitted, past it a
+    MemoryError is raised.
+    """
+    def __init__(self, args, datasets, models, budget=None, warn_ratio=0.9):
+        self.args = args
+        self.datasets = datasets
+        self.models = models
+        self.budget = budget * 2 ** 30 if budget is not None else None
+        self.warn_ratio = warn_ratio
+
+    def report_datasets(self):
+        for name, dataset in self.datasets.items():
+            self.args.log_string('Memory of %s data: volumes %.1f MB, idx_list %d entries %.1f MB' % (
+                name, to_mb(get_resident_bytes(dataset)), get_idx_list_len(dataset), to_mb(get_idx_list_bytes(dataset))))
+
+    def report_model(self):
+        for name, model in self.models.items():
+            n_bytes = sum([item.numel() * item.element_size() for item in list(model.parameters()) + list(model.buffers())])
+            self.args.log_string('Memory of %s: weights %.1f MB' % (name, to_mb(n_bytes)))
+        if self.args.device.type == 'cuda':
+            self.args.log_string('Peak allocator memory: %.1f MB' % to_mb(torch.cuda.max_memory_allocated(self.args.device)))
+        else:
+            peak_rss = get_peak_rss()
+            if peak_rss is not None:
+                self.args.log_string('Peak RSS of the training process: %.1f MB' % to_mb(peak_rss))
+
+    def report_processes(self):
+        pid = os.getpid()
+        memory = read_process_memory(pid)
+        if memory is None:
+            self.args.log_string('Process memory is not available on this platform')
+            return None
+
+        self.args.log_string('Memory of the training process: RSS %.1f MB, PSS %.1f MB' % (to_mb(memory[0]), to_mb(memory[1])))
+        total_pss = memory[1]
+        for child_pid in get_child_pids(pid):
+            child_memory = read_process_memory(child_pid)
+            if child_memory is None:
+                continue
+            self.args.log_string('Memory of worker %d: RSS %.1f MB, PSS %.1f MB' % (child_pid, to_mb(child_memory[0]), to_mb(child_memory[1])))
+            total_pss += child_memory[1]
+
+        self.args.log_string('Total PSS: %.1f MB' % to_mb(total_pss))
+        return total_pss
+
+    def check_budget(self, total_pss):
+        if self.budget is None or total_pss is None:
+            return
+        message = 'memory use %.1f MB is %.0f%% of the %.1f MB budget' % (to_mb(total_pss), 100.0 * total_pss / self.budget, to_mb(self.budget))
+        if total_pss > self.budget:
+            self.args.log_string('Error: ' + message)
+            raise MemoryError(message)
+        if total_pss > self.warn_ratio * self.budget:
+            self.args.log_string('Warning: ' + message)
+            warnings.warn(message)
+
+    def report(self, full=False):
+        self.args.log_string('Memory report -----------------------------------------------')
+        if full:
+            self.report_datasets()
+        self.report_model()
+        self.check_budget(self.report_processes())
@@ -3,11 +3,8 @@ import argparse
 import numpy as np
 import pandas as pd
 import SimpleITK as sitk
-import imgaug as ia
-import imgaug.augmenters as iaa
 from torch.utils.data import Dataset
-from dataset import center_crop
-from imgaug.augmentables.segmaps import SegmentationMapsOnImage
+from dataset import center_crop, crop_volume, compact_image, get_stack, get_mpr_path, get_mask_path
 # from dataset import Probe_Dataset, split_dataset, normalize, center_crop, adjust_HU
 # from torch.utils.data import ConcatDataset, Dataset
 
@@ -35,7 +32,7 @@ def parse_args():
     
     return parser.parse_args()
 
-def prepare_data(data_paths, query_table, times):
+def prepare_data(data_paths, query_table, times, crop_size):
 
     all_idx_list = []
     env_dict = {}
@@ -47,20 +44,8 @@ def prepare_data(data_paths, query_table, times):
         branch_id = int(file_path.split('/')[7])
         slice_id = query_table['slice_id'].loc[(query_table['case_id'] == case_id) & (query_table['branch_id'] == branch_id)].tolist()  # 查找相应case和branch的切片id,并转化为列表
 
-        if os.path.exists(os.path.join(file_path, 'mpr_100.nii.gz')):
-            mpr_path = os.path.join(file_path, 'mpr_100.nii.gz')
-        else:
-            mpr_path = os.path.join(file_path, 'mpr.nii.gz')
-
-        if os.path.exists(os.path.join(file_path, 'mask_refine_checked.nii.gz')):
-            mask_path = os.path.join(file_path, 'mask_refine_checked.nii.gz')
-        elif os.path.exists(os.path.join(file_path, 'mask_refine.nii.gz')):
-            mask_path = os.path.join(file_path, 'mask_refine.nii.gz')
-        else:
-            mask_path = os.path.join(file_path, 'mask.nii.gz')
-
-        mpr_itk = sitk.ReadImage(mpr_path)
-        mask_itk = sitk.ReadImage(mask_path)
+        mpr_itk = sitk.ReadImage(get_mpr_path(file_path))
+        mask_itk = sitk.ReadImage(get_mask_path(file_path))
         mpr_vol = sitk.GetArrayFromImage(mpr_itk)
         mask_vol = sitk.GetArrayFromImage(mask_itk)
         assert mpr_vol.shape == mask_vol.shape, print('Wrong shape')
@@ -72,13 +57,16 @@ def prepare_data(data_paths, query_table, times):
                 for time in range(times):  # 重复times次，作为复制
                     all_idx_list.append((idx, env_count))
 
+        mpr_vol = compact_image(crop_volume(mpr_vol, crop_size))
+        mask_vol = crop_volume(mask_vol, crop_size).astype(np.uint8)
+
         env_dict[env_count] = {'img': mpr_vol, 'mask': mask_vol}
         env_count += 1
 
     return all_idx_list, env_dict
 
 class AugmentDataset(Dataset):
-    def __init__(self, args, type='unlabel', augmentation=False):
+    def __init__(self, args, type='unlabel', augmentation='none'):
         self.args = args
         self.augmentation = augmentation
         df = pd.read_csv(args.aug_list_dir)
@@ -93,31 +81,22 @@ class AugmentDataset(Dataset):
             self.dataset.append(os.path.join(args.data_dir, str(row['case_id']), str(row['branch_id'])))
         
         self.dataset = sorted(set(self.dataset), key=self.dataset.index)  # 去除重复元素并保留之前顺序
-        self.idx_list, self.env_dict = prepare_data(self.dataset, query_table, args.times)
+        self.idx_list, self.env_dict = prepare_data(self.dataset, query_table, args.times, args.crop_size)
 
     def __len__(self):
         return len(self.idx_list)
 
     def __getitem__(self, idx):
-        ia.seed(idx + 1)
         pt_idx, env_idx = self.idx_list[idx]
 
         if self.args.data_mode == '2D':
-            probe_img = self.env_dict[env_idx]['img'][pt_idx].astype(np.float)
-            probe_mask = self.env_dict[env_idx]['mask'][pt_idx].astype(np.float)
+            probe_img = self.env_dict[env_idx]['img'][pt_idx].astype(np.float32)
+            probe_mask = self.env_dict[env_idx]['mask'][pt_idx].astype(np.float32)
             probe_img = np.expand_dims(probe_img, axis=-1)
             probe_mask = np.expand_dims(probe_mask, axis=-1)
         elif self.args.data_mode == '2.5D':
-            img_stack_list = []
-            img_stack_list.append(self.env_dict[env_idx]['img'][pt_idx].astype(np.float))
-            step = int((self.args.slices - 1) / 2)
-            for i in range(step):
-                s_idx = max(pt_idx - sum([i for i in range(i+1)]), 0)
-                e_idx = min(pt_idx + sum([i for i in range(i+1)]), len(self.env_dict[env_idx]['img']) - 1)
-                img_stack_list.insert(0, self.env_dict[env_idx]['img'][s_idx].astype(np.float))
-                img_stack_list.insert(-1, self.env_dict[env_idx]['img'][e_idx].astype(np.float))
-            probe_img = np.stack(img_stack_list, axis=-1)
-            probe_mask = self.env_dict[env_idx]['mask'][pt_idx].astype(np.float)
+            probe_img = get_stack(self.env_dict[env_idx]['img'], pt_idx, self.args.slices)
+            probe_mask = self.env_dict[env_idx]['mask'][pt_idx].astype(np.float32)
             probe_mask = np.expand_dims(probe_mask, axis=-1)
         else:
             print(self.args.data_mode + " is not implemented.")
@@ -126,14 +105,22 @@ class AugmentDataset(Dataset):
         probe_img, probe_mask = center_crop(probe_img, probe_mask, self.args.crop_size)
         probe_mask = probe_mask.astype(np.int32)
 
-        # augmentation
-        if self.augmentation:
+        # augmentation: per sample with imgaug, or batched by augmentation.AugmentCollate from aug_seed
+        sample = {'img': probe_img, 'mask': probe_mask}
+        if self.augmentation in ('worker', 'device'):
+            sample['aug_seed'] = idx
+        elif self.augmentation == 'imgaug':
+            # imgaug is only imported when the augmentation is used
+            import imgaug as ia
+            import imgaug.augmenters as iaa
+            from imgaug.augmentables.segmaps import SegmentationMapsOnImage
+
+            ia.seed(idx + 1)
             seg_map = SegmentationMapsOnImage(probe_mask, shape=probe_img.shape)
             aug_affine = iaa.Affine(scale=(0.9, 1.1), translate_percent=(-0.05, 0.05), rotate=(-360, 360), shear=(-20, 20), mode='edge')
             probe_img, seg_map = aug_affine(image=probe_img, segmentation_maps=seg_map)
-            probe_mask = seg_map.get_arr()
+            sample = {'img': probe_img, 'mask': seg_map.get_arr()}
 
-        sample = {'img': probe_img, 'mask': probe_mask}
         return sample
 
 
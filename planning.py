@@ -0,0 +1,119 @@
+import os
+import csv
+import json
+import numpy as np
+from branches import split_dataset, get_branch_key, get_mpr_path, get_mask_path
+
+
+def load_meta_cache(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+def save_meta_cache(path, meta):
+    # merge the metadata of the decoded branches into the cache
+    cache = load_meta_cache(path)
+    cache.update(meta)
+    with open(path, 'w') as f:
+        json.dump(cache, f, indent=1, sort_keys=True)
+
+def get_annotation_state(file_path):
+    # which mask file a branch is trained on and when it was last written
+    mask_path = get_mask_path(file_path)
+    stat = os.stat(mask_path)
+    return {'mask_name': os.path.basename(mask_path), 'mtime': stat.st_mtime, 'size': stat.st_size}
+
+def save_annotations(path, data_paths):
+    # annotation state of the labeled branches, written next to the checkpoints of a run
+    with open(path, 'w') as f:
+        json.dump(dict([('/'.join(get_branch_key(file_path)), get_annotation_state(file_path)) for file_path in data_paths]), f, indent=1, sort_keys=True)
+
+def read_header_shape(file_path):
+    # shape of an uncached branch from the image header only, nothing is decoded
+    import SimpleITK as sitk
+
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(get_mpr_path(file_path))
+    reader.ReadImageInformation()
+    return list(reversed(reader.GetSize()))
+
+def get_labelweights(label_counts, n_classes):
+    # the class weights of prepare_data, from the cached label counts
+    labelweights = np.ones(4).astype(np.int64) + np.sum(label_counts, axis=0).astype(np.int64)
+    if n_classes == 3:
+        labelweights = labelweights[:-1]
+
+    labelweights = labelweights / np.sum(labelweights)
+    return np.power(np.amax(labelweights) / labelweights, 1 / 3.0)
+
+def get_branch_bytes(shape, img_itemsize, crop_size):
+    # resident bytes of a branch cropped at load: the image and its uint8 mask
+    return shape[0] * crop_size * crop_size * (img_itemsize + 1)
+
+def read_augment_table(args, case_range):
+    # (branch key, plaque slice count) of the over-sampled branches, read without pandas
+    rows = {}
+    with open(args.aug_list_dir) as f:
+        for row in csv.DictReader(f):
+            if int(row['case_id']) in case_range:
+                key = row['case_id'] + '/' + row['branch_id']
+                rows[key] = rows.get(key, 0) + 1
+    return rows
+
+def plan_split(args, name, data_paths, meta):
+    num_slices, n_bytes, label_counts, uncached = 0, 0, [], 0
+    for file_path in data_paths:
+        branch_meta = meta.get('/'.join(get_branch_key(file_path)))
+        if branch_meta is None:
+            uncached += 1
+            n_bytes += get_branch_bytes(read_header_shape(file_path), 2, args.crop_size)
+            continue
+        num_slices += branch_meta['num_slices']
+        n_bytes += get_branch_bytes(branch_meta['shape'], branch_meta['img_itemsize'], args.crop_size)
+        label_counts.append(branch_meta['label_counts'])
+
+    if name == 'unlabeled' and args.stream_unlabeled:
+        n_bytes = 0  # bounded by the streaming window, see Stream_Dataset
+
+    print('%-10s branches %5d  slices %7d  memory %8.1f MB%s' % (
+        name, len(data_paths), num_slices, n_bytes / 2 ** 20,
+        '  (%d branches not cached, slices unknown)' % uncached if uncached else ''))
+    return label_counts, n_bytes
+
+def plan_over_sample(args, name, case_range, meta):
+    num_slices, n_bytes = 0, 0
+    for key, plaque_slices in read_augment_table(args, case_range).items():
+        num_slices += plaque_slices * args.times
+        branch_meta = meta.get(key)
+        if branch_meta is not None:
+            n_bytes += get_branch_bytes(branch_meta['shape'], branch_meta['img_itemsize'], args.crop_size)
+        else:
+            n_bytes += get_branch_bytes(read_header_shape(os.path.join(args.data_dir, *key.split('/'))), 2, args.crop_size)
+
+    print('%-10s over-sampled slices %7d  memory %8.1f MB' % (name, num_slices, n_bytes / 2 ** 20))
+    return n_bytes
+
+def dry_run(args):
+    """Print the split sizes, slice counts, class weights and memory of a run without decoding volumes.
+
+    Slice counts and label counts come from the metadata cached by earlier runs in
+    args.meta_cache. Branches missing from the cache are sized from their image header only.
+    """
+    meta = load_meta_cache(args.meta_cache)
+    unlabeled_dir, labeled_dir, val_dir = split_dataset(args)
+
+    total_bytes = 0
+    for name, data_paths in zip(('unlabeled', 'labeled', 'validation'), (unlabeled_dir, labeled_dir, val_dir)):
+        label_counts, n_bytes = plan_split(args, name, data_paths, meta)
+        total_bytes += n_bytes
+        if name == 'labeled' and len(label_counts) > 0:
+            print('Weights for classes: {}'.format(np.around(get_labelweights(label_counts, args.n_classes), 4)))
+
+    if args.over_sample:
+        if not args.stream_unlabeled:
+            total_bytes += plan_over_sample(args, 'unlabeled', range(args.unlabeled_num), meta)
+        total_bytes += plan_over_sample(args, 'labeled', range(args.unlabeled_num, args.unlabeled_num + args.labeled_num), meta)
+
+    # every DataLoader worker is forked from the main process and shares its volumes
+    print('Estimated resident memory of the volumes: %.1f MB' % (total_bytes / 2 ** 20))
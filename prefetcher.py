@@ -0,0 +1,100 @@
+import queue
+import threading
+import torch
+from torch.utils.data.dataloader import default_collate
+
+
+def compact_image_tensor(img):
+    # int16 whenever the cast is lossless, as compact_image does for the stored volumes
+    img_int16 = img.to(torch.int16)
+    if torch.equal(img_int16.to(img.dtype), img):
+        return img_int16
+    return img.float()
+
+
+class CompactCollate(object):
+    # collate_fn handing over int16 images and uint8 masks instead of float64 and int32
+    def __init__(self, collate_fn=None):
+        self.collate_fn = collate_fn if collate_fn is not None else default_collate
+
+    def __call__(self, samples):
+        batch = self.collate_fn(samples)
+        batch['img'] = compact_image_tensor(batch['img'])
+        if 'mask' in batch:
+            batch['mask'] = batch['mask'].to(torch.uint8)
+        return batch
+
+
+class Prefetcher(object):
+    """Endless iterator over a DataLoader with the next batches already on the device.
+
+    A background thread draws batches, restarting the loader when it is exhausted, and copies
+    the compact images and masks of CompactCollate to the device, on a side stream with cuda.
+    The conversion to float and to the (batch_size, C, H, W) layout happens on the device when
+    a batch is taken. Other entries of the batch, as idx, stay on the host.
+    """
+    def __init__(self, loader, device, depth=2):
+        self.loader = loader
+        self.device = device
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.batches = queue.Queue(maxsize=depth)
+        self.stopped = False
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def copy(self, batch):
+        for key in ('img', 'mask'):
+            if key in batch:
+                if self.stream is not None:
+                    batch[key] = batch[key].pin_memory().to(self.device, non_blocking=True)
+                else:
+                    batch[key] = batch[key].to(self.device)
+        return batch
+
+    def put(self, item):
+        while not self.stopped:
+            try:
+                self.batches.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+
+    def run(self):
+        try:
+            while not self.stopped:
+                for batch in self.loader:
+                    if self.stopped:
+                        return
+                    event = None
+                    if self.stream is not None:
+                        with torch.cuda.stream(self.stream):
+                            batch = self.copy(batch)
+                            event = torch.cuda.Event()
+                            event.record(self.stream)
+                    else:
+                        batch = self.copy(batch)
+                    self.put((batch, event))
+        except Exception as e:
+            self.put((e, None))
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        batch, event = self.batches.get()
+        if isinstance(batch, Exception):
+            raise batch
+        if event is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_event(event)
+            for key in ('img', 'mask'):
+                if key in batch:
+                    batch[key].record_stream(current)
+
+        batch['img'] = batch['img'].permute(0, 3, 1, 2).float()
+        if 'mask' in batch:
+            batch['mask'] = batch['mask'].permute(0, 3, 1, 2)
+        return batch
+
+    def close(self):
+        self.stopped = True
@@ -0,0 +1,190 @@
+"""Cost of the get_module variants for 2.5D inputs.
+
+Sweeps depth, wf, padding, batch_norm, up_mode and the number of slices. For each setting it
+reports the parameter count, the forward FLOPs per slice, the activation memory saved for
+backward and the CPU forward and backward latency at every batch size. With --train_steps, each
+padded setting is also trained for a short supervised run and validated, for the Dice/cost
+frontier. Results are printed as a table and written to --output as json.
+"""
+import json
+import time
+import argparse
+import itertools
+import numpy as np
+import torch
+from torch.utils.flop_counter import FlopCounterMode
+from Vnet import get_module
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Profiler')
+    parser.add_argument('--depth_list', type=int, nargs='+', default=[3, 4, 5], help='Vnet depths')
+    parser.add_argument('--wf_list', type=int, nargs='+', default=[3, 4, 5], help='Vnet widths, the first layer has 2**wf filters')
+    parser.add_argument('--padding_list', type=int, nargs='+', default=[1, 0], help='1 for padded convolutions, 0 for valid ones')
+    parser.add_argument('--batch_norm_list', type=int, nargs='+', default=[1, 0], help='1 to use BatchNorm, 0 without')
+    parser.add_argument('--up_mode_list', type=str, nargs='+', default=['upconv', 'upsample'], help='upsampling modes')
+    parser.add_argument('--slices_list', type=int, nargs='+', default=[3, 5, 7], help='slices of the 2.5D stacks')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[16, 64], help='batch sizes of the latency and memory columns')
+    parser.add_argument('--crop_size', type=int, default=64, help='size for square patch')
+    parser.add_argument('--n_classes', type=int, default=3, help='classes for segmentation')
+    parser.add_argument('--repeat', type=int, default=5, help='timed repetitions, the median is reported')
+    parser.add_argument('--num_threads', type=int, default=None, help='cpu threads used by torch')
+    parser.add_argument('--train_steps', type=int, default=0, help='supervised steps of the optional training run, 0 to skip it')
+    parser.add_argument('--main_args', type=str, default='', help='main.py arguments of the data used by the training run')
+    parser.add_argument('--output', type=str, default='./profile.json', help='json file of the results')
+    return parser.parse_args()
+
+
+class NullWriter(object):
+    # stands in for the SummaryWriter that validate logs to
+    def add_scalar(self, *args):
+        pass
+
+
+def count_flops(model, inputs):
+    # forward FLOPs of one call, a multiply-add counts as two
+    with torch.no_grad(), FlopCounterMode(display=False) as counter:
+        model(inputs)
+    return counter.get_total_flops()
+
+def get_activation_bytes(model, inputs):
+    # bytes of the tensors autograd keeps for the backward pass, the weights excluded
+    weights = set([item.data_ptr() for item in model.parameters()])
+    saved = {}
+
+    def pack(tensor):
+        if tensor.data_ptr() not in weights:
+            saved[tensor.data_ptr()] = tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        output = model(inputs)
+    del output
+    return sum(saved.values())
+
+def measure_latency(model, inputs, repeat):
+    # median (forward, backward) seconds of a training step
+    forward_times, backward_times = [], []
+    for i in range(repeat + 1):
+        model.zero_grad()
+        start = time.perf_counter()
+        output = model(inputs)
+        middle = time.perf_counter()
+        output.float().mean().backward()
+        end = time.perf_counter()
+        if i > 0:  # warm up
+            forward_times.append(middle - start)
+            backward_times.append(end - middle)
+    return float(np.median(forward_times)), float(np.median(backward_times))
+
+def train_and_validate(args, model, train_args, labeled_loader, val_loader):
+    # short supervised run, returns the validation (mean dice, class dice)
+    from losses import FocalLoss
+    from learning import validate
+
+    criterion = FocalLoss(train_args.ignore_index)
+    optimizer = torch.optim.Adam(model.parameters(), lr=train_args.learning_rate, weight_decay=train_args.decay_rate)
+    model.train()
+    step = 0
+    while step < args.train_steps:
+        for data in labeled_loader:
+            inputs = data['img'].permute(0, 3, 1, 2).float()
+            targets = data['mask'].permute(0, 3, 1, 2)
+            logits = model(inputs)
+            loss = criterion(logits.view(logits.size(0), args.n_classes, -1), targets.reshape(targets.size(0), 1, -1).long(),
+                             args.n_classes, train_args.n_weights)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            step += 1
+            if step >= args.train_steps:
+                break
+
+    mean_dice, class_dice, _ = validate(train_args, 0, val_loader, model, None, criterion, NullWriter(), is_ema=False)
+    return float(mean_dice), [float(item) for item in class_dice]
+
+def get_train_data(args):
+    from torch.utils.data import DataLoader
+    from main import get_parser, set_seed
+    from dataset import split_dataset, Probe_Dataset
+
+    train_args = get_parser().parse_args(args.main_args.split())
+    train_args.crop_size = args.crop_size
+    train_args.n_classes = args.n_classes
+    train_args.device = torch.device('cpu')
+    train_args.log_string = print
+    set_seed(train_args)
+
+    # the stacks are built at __getitem__ from train_args.slices, so one decode serves every setting
+    _, labeled_dir, val_dir = split_dataset(train_args)
+    labeled_set = Probe_Dataset(labeled_dir, train_args)
+    val_set = Probe_Dataset(val_dir, train_args)
+    train_args.n_weights = torch.tensor(labeled_set.labelweights).float()
+    labeled_loader = DataLoader(labeled_set, batch_size=train_args.batch_size, shuffle=True, num_workers=0)
+    val_loader = DataLoader(val_set, batch_size=train_args.batch_size, shuffle=False, num_workers=0)
+    return train_args, labeled_loader, val_loader
+
+def profile_setting(args, setting, train_data):
+    depth, wf, padding, batch_norm, up_mode, slices = setting
+    model = get_module(slices, args.n_classes, depth, wf, bool(padding), bool(batch_norm), up_mode)
+    result = {'depth': depth, 'wf': wf, 'padding': bool(padding), 'batch_norm': bool(batch_norm), 'up_mode': up_mode, 'slices': slices,
+              'params': sum([item.numel() for item in model.parameters()])}
+
+    try:
+        sample = torch.randn(1, slices, args.crop_size, args.crop_size)
+        result['output_size'] = list(model.eval()(sample).shape[2:])
+        result['flops'] = count_flops(model, sample)
+        model.train()
+        for batch_size in args.batch_sizes:
+            inputs = torch.randn(batch_size, slices, args.crop_size, args.crop_size)
+            forward, backward = measure_latency(model, inputs, args.repeat)
+            result['batch_%d' % batch_size] = {'activation_bytes': get_activation_bytes(model, inputs), 'forward_s': forward, 'backward_s': backward}
+    except RuntimeError as e:
+        # valid convolutions shrink the maps, a deep unpadded net does not fit the crop
+        result['error'] = str(e).split('\n')[0]
+        return result
+
+    # the labels are cropped to the input size, only padded variants predict all of it
+    if train_data is not None and padding:
+        train_args, labeled_loader, val_loader = train_data
+        train_args.slices = slices
+        result['dice'], result['class_dice'] = train_and_validate(args, model, train_args, labeled_loader, val_loader)
+    return result
+
+def print_table(args, results):
+    header = '%5s %3s %3s %3s %-8s %6s %10s %8s' % ('depth', 'wf', 'pad', 'bn', 'up_mode', 'slices', 'params', 'GFLOPs')
+    for batch_size in args.batch_sizes:
+        header += ' %14s' % ('b%d act MB' % batch_size) + ' %15s' % ('b%d fwd/bwd ms' % batch_size)
+    if args.train_steps > 0:
+        header += ' %6s' % 'dice'
+    print(header)
+
+    for result in results:
+        row = '%5d %3d %3d %3d %-8s %6d %10d' % (result['depth'], result['wf'], result['padding'], result['batch_norm'],
+                                                 result['up_mode'], result['slices'], result['params'])
+        if 'error' in result:
+            print(row + '  ' + result['error'])
+            continue
+        row += ' %8.3f' % (result['flops'] / 1e9)
+        for batch_size in args.batch_sizes:
+            item = result['batch_%d' % batch_size]
+            row += ' %14.1f' % (item['activation_bytes'] / 2 ** 20) + ' %15s' % ('%.1f/%.1f' % (item['forward_s'] * 1e3, item['backward_s'] * 1e3))
+        if 'dice' in result:
+            row += ' %6.4f' % result['dice']
+        print(row)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    torch.manual_seed(0)
+
+    train_data = get_train_data(args) if args.train_steps > 0 else None
+    settings = itertools.product(args.depth_list, args.wf_list, args.padding_list, args.batch_norm_list, args.up_mode_list, args.slices_list)
+    results = [profile_setting(args, setting, train_data) for setting in settings]
+
+    print_table(args, results)
+    with open(args.output, 'w') as f:
+        json.dump({'crop_size': args.crop_size, 'n_classes': args.n_classes, 'num_threads': torch.get_num_threads(), 'results': results}, f, indent=1)
+    print('Saved %s' % args.output)
@@ -0,0 +1,113 @@
+"""Per-branch plaque burden of predicted or annotated masks.
+
+For every case/branch folder under --data_dir holding a mask, computes for calcified and soft
+plaque the voxel count and volume, the slice extent, the max area over the slices and the
+longest run of consecutive plaque slices along the centerline. Annotations use the annotation
+coding (1 artery, 2 calcified, 3 soft, anchors above 3). The argmax masks of the network, as
+saved from runtime.py, server.py or branch_inference.py, use the network coding (0 artery,
+1 calcified, 2 soft, 3 background) and are read with --label_coding network. Branches are spread
+over a process pool and the report is keyed by case_id and branch_id as in plaque_info.csv.
+"""
+import os
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from dataset import get_mask_path, get_branch_key
+
+PLAQUE_LABELS = {'calcified': 2, 'soft': 3}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Quantify')
+    parser.add_argument('--data_dir', type=str, default='/Users/gaoyibo/Datasets/plaques/all_subset_v3', help='folder of the case/branch masks')
+    parser.add_argument('--mask_name', type=str, default=None, help='file name of the predicted masks [default: the most refined annotation]')
+    parser.add_argument('--label_coding', type=str, default='annotation', help='coding of the masks: annotation, or network for saved predictions')
+    parser.add_argument('--output', type=str, default='./plaque_quantification.csv', help='report path, .csv or .parquet')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='processes computing the branches')
+    return parser.parse_args()
+
+
+def find_branches(data_dir, mask_name):
+    # (branch folder, mask path) of every case/branch holding a mask, in case and branch order
+    branches = []
+    for case_id in sorted(os.listdir(data_dir), key=lambda item: (not item.isdigit(), int(item) if item.isdigit() else item)):
+        case_path = os.path.join(data_dir, case_id)
+        if not os.path.isdir(case_path):
+            continue
+        for branch_id in sorted(os.listdir(case_path), key=lambda item: (not item.isdigit(), int(item) if item.isdigit() else item)):
+            file_path = os.path.join(case_path, branch_id)
+            mask_path = os.path.join(file_path, mask_name) if mask_name else get_mask_path(file_path)
+            if os.path.exists(mask_path):
+                branches.append((file_path, mask_path))
+    return branches
+
+def get_longest_run(present):
+    # length of the longest run of True in a 1D boolean array
+    edges = np.diff(np.concatenate([[0], present.astype(np.int8), [0]]))
+    starts, ends = np.nonzero(edges == 1)[0], np.nonzero(edges == -1)[0]
+    return int((ends - starts).max()) if len(starts) else 0
+
+def to_annotation_coding(mask_vol):
+    # network coding (0 artery, 1 calcified, 2 soft, 3 background) to the annotation coding
+    annotation = mask_vol.astype(np.int16) + 1
+    annotation[mask_vol == 3] = 0
+    return annotation
+
+def quantify_volume(mask_vol, spacing):
+    """Plaque statistics of a (slices, H, W) mask, spacing in mm as (slice, row, column)."""
+    voxel_volume = float(np.prod(spacing))
+    pixel_area = float(spacing[1] * spacing[2])
+    mask_vol = mask_vol.reshape(mask_vol.shape[0], -1)
+
+    result = {'num_slices': mask_vol.shape[0]}
+    for name, label in PLAQUE_LABELS.items():
+        areas = np.count_nonzero(mask_vol == label, axis=1)
+        present = areas > 0
+        slice_ids = np.nonzero(present)[0]
+        voxels = int(areas.sum())
+
+        result[name + '_voxels'] = voxels
+        result[name + '_volume_mm3'] = voxels * voxel_volume
+        result[name + '_slices'] = len(slice_ids)
+        result[name + '_first_slice'] = int(slice_ids[0]) if len(slice_ids) else -1
+        result[name + '_last_slice'] = int(slice_ids[-1]) if len(slice_ids) else -1
+        result[name + '_max_area_pixels'] = int(areas.max()) if len(areas) else 0
+        result[name + '_max_area_mm2'] = result[name + '_max_area_pixels'] * pixel_area
+        result[name + '_max_area_slice'] = int(areas.argmax()) if len(slice_ids) else -1
+        result[name + '_longest_run'] = get_longest_run(present)
+    return result
+
+def quantify_branch(branch):
+    import SimpleITK as sitk
+
+    file_path, mask_path, label_coding = branch
+    mask_itk = sitk.ReadImage(mask_path)
+    mask_vol = sitk.GetArrayFromImage(mask_itk)
+    if label_coding == 'network':
+        mask_vol = to_annotation_coding(mask_vol)
+    elif label_coding != 'annotation':
+        raise NotImplementedError(label_coding)
+
+    case_id, branch_id = get_branch_key(file_path)
+    # sitk spacing is (x, y, z), the array is (z, y, x)
+    result = {'case_id': case_id, 'branch_id': branch_id}
+    result.update(quantify_volume(mask_vol, tuple(reversed(mask_itk.GetSpacing()))))
+    return result
+
+
+if __name__ == "__main__":
+    import pandas as pd
+
+    args = parse_args()
+    branches = [branch + (args.label_coding,) for branch in find_branches(args.data_dir, args.mask_name)]
+    print('Quantifying %d branches with %d processes' % (len(branches), args.num_workers))
+
+    with ProcessPoolExecutor(args.num_workers) as executor:
+        results = list(executor.map(quantify_branch, branches, chunksize=max(1, len(branches) // (4 * args.num_workers))))
+
+    df = pd.DataFrame(results)
+    if args.output.endswith('.parquet'):
+        df.to_parquet(args.output, index=False)
+    else:
+        df.to_csv(args.output, index=False)
+    print('Saved %s' % args.output)
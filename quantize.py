@@ -0,0 +1,195 @@
+import os
+import copy
+import time
+import torch
+from torch import nn
+import torch.nn.functional as F
+from torch.utils.data import DataLoader
+from main import get_parser, make_dir_log, set_seed
+from dataset import split_dataset, Probe_Dataset
+from initialization import get_in_channels, load_inference_model
+from learning import validate
+from losses import FocalLoss
+
+
+def crop_to(layer, target):
+    # center crop layer to the spatial size of target, kept as a single node when traced
+    _, _, layer_height, layer_width = layer.size()
+    target_height, target_width = target.size()[2:]
+    diff_y = (layer_height - target_height) // 2
+    diff_x = (layer_width - target_width) // 2
+    return layer[:, :, diff_y: (diff_y + target_height), diff_x: (diff_x + target_width)]
+
+torch.fx.wrap('crop_to')
+
+
+class ShiftPad(nn.Module):
+    """Zero padding in the space of a folded BatchNorm output.
+
+    Padding x with the per-channel value -b/a is the same as zero padding a*x + b, which keeps a
+    BatchNorm folded into the following padded convolution exact at the borders.
+    """
+    def __init__(self, value, padding):
+        super(ShiftPad, self).__init__()
+        self.register_buffer('value', value.view(1, -1, 1, 1))
+        self.padding = padding
+
+    def forward(self, x):
+        return F.pad(x - self.value, [self.padding] * 4) + self.value
+
+
+def fold_block(conv_block):
+    """Fold the BatchNorm of a UNetConvBlock into the following convolution.
+
+    The block runs Conv -> ReLU -> BN -> Conv -> ReLU, so the BatchNorm comes after a ReLU and
+    can not go into the preceding convolution. Being affine per channel, it goes into the input
+    channels of the next one instead, with a ShiftPad keeping the zero padding exact.
+    """
+    layers = [copy.deepcopy(layer) for layer in conv_block.block]
+    if not any([isinstance(layer, nn.BatchNorm2d) for layer in layers]):
+        return nn.Sequential(*layers)
+
+    conv1, relu1, bn, conv2, relu2 = layers
+    with torch.no_grad():
+        scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+        shift = bn.bias - bn.running_mean * scale
+    if (scale == 0).any():  # the padding value -b/a would be infinite
+        return nn.Sequential(*layers)
+
+    padding = conv2.padding[0]
+    folded = nn.Conv2d(conv2.in_channels, conv2.out_channels, kernel_size=conv2.kernel_size, padding=0)
+    with torch.no_grad():
+        folded.weight.copy_(conv2.weight * scale.view(1, -1, 1, 1))
+        folded.bias.copy_(conv2.bias + (conv2.weight * shift.view(1, -1, 1, 1)).sum((1, 2, 3)))
+
+    if padding > 0:
+        return nn.Sequential(conv1, relu1, ShiftPad(-shift / scale, padding), folded, relu2)
+    return nn.Sequential(conv1, relu1, folded, relu2)
+
+
+class FoldedUpBlock(nn.Module):
+    def __init__(self, up_block):
+        super(FoldedUpBlock, self).__init__()
+        self.up = copy.deepcopy(up_block.up)
+        self.conv_block = fold_block(up_block.conv_block)
+
+    def forward(self, x, bridge):
+        up = self.up(x)
+        out = torch.cat([up, crop_to(bridge, up)], 1)
+        return self.conv_block(out)
+
+
+class FoldedModule(nn.Module):
+    # get_module with every BatchNorm folded, traceable for FX quantization
+    def __init__(self, model):
+        super(FoldedModule, self).__init__()
+        self.down_path = nn.ModuleList([fold_block(down) for down in model.down_path])
+        self.up_path = nn.ModuleList([FoldedUpBlock(up) for up in model.up_path])
+        self.last = copy.deepcopy(model.last)
+
+    def forward(self, x):
+        blocks = []
+        for i, down in enumerate(self.down_path):
+            x = down(x)
+            if i != len(self.down_path) - 1:
+                blocks.append(x)
+                x = F.max_pool2d(x, 2)
+
+        for i, up in enumerate(self.up_path):
+            x = up(x, blocks[-i - 1])
+
+        return self.last(x)
+
+
+def get_inputs(data):
+    return data['img'].permute(0, 3, 1, 2).float()
+
+def quantize_static(model, loader, num_batches, backend):
+    """Static int8 quantization of a FoldedModule, calibrated on num_batches of loader.
+
+    ShiftPad stays in float: its input is dequantized and its output quantized again.
+    """
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+    from torch.ao.quantization.fx.custom_config import PrepareCustomConfig
+
+    torch.backends.quantized.engine = backend
+    qconfig_mapping = get_default_qconfig_mapping(backend).set_object_type(ShiftPad, None)
+    prepare_custom_config = PrepareCustomConfig().set_non_traceable_module_classes([ShiftPad])
+
+    example = get_inputs(next(iter(loader)))
+    prepared = prepare_fx(copy.deepcopy(model).eval(), qconfig_mapping, (example,), prepare_custom_config=prepare_custom_config)
+    with torch.no_grad():
+        for i, data in enumerate(loader):
+            if i >= num_batches:
+                break
+            prepared(get_inputs(data))
+
+    return convert_fx(prepared)
+
+def measure_latency(model, batch_size, in_channels, crop_size, repeat):
+    inputs = torch.randn(batch_size, in_channels, crop_size, crop_size)
+    with torch.no_grad():
+        model(inputs)  # warm up
+        start = time.perf_counter()
+        for _ in range(repeat):
+            model(inputs)
+    return (time.perf_counter() - start) / repeat
+
+
+if __name__ == "__main__":
+    parser = get_parser()
+    parser.add_argument('--checkpoint', type=str, default=None, help='checkpoint to export [default: best_model.pth of the experiment]')
+    parser.add_argument('--weights', type=str, default='teacher', help='weights of the checkpoint: student or teacher')
+    parser.add_argument('--calib_batches', type=int, default=20, help='labeled batches used to calibrate the int8 model')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[1, 8, 32, 64], help='batch sizes of the latency table')
+    parser.add_argument('--backend', type=str, default='x86', help='quantized engine: x86, fbgemm or qnnpack')
+    parser.add_argument('--num_threads', type=int, default=None, help='cpu threads used for inference')
+    parser.add_argument('--repeat', type=int, default=20, help='timed repetitions per batch size')
+    args = parser.parse_args()
+
+    set_seed(args)
+    make_dir_log(args)
+    args.device = torch.device('cpu')
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    checkpoint_path = args.checkpoint if args.checkpoint else os.path.join(str(args.log_dir), 'best_model.pth')
+
+    _, labeled_dir, val_dir = split_dataset(args)
+    labeled_set = Probe_Dataset(labeled_dir, args)
+    val_set = Probe_Dataset(val_dir, args)
+    args.n_weights = torch.tensor(labeled_set.labelweights).float()
+    calib_loader = DataLoader(labeled_set, batch_size=args.batch_size, shuffle=True, num_workers=args.num_workers)
+    val_loader = DataLoader(val_set, batch_size=args.batch_size, shuffle=False, num_workers=args.num_workers)
+
+    float_model = load_inference_model(args, checkpoint_path, args.weights)
+    folded_model = FoldedModule(float_model).eval()
+
+    # folding is exact up to float rounding
+    with torch.no_grad():
+        example = get_inputs(next(iter(val_loader)))
+        args.log_string('Max abs difference of the folded model: %e' % (float_model(example) - folded_model(example)).abs().max().item())
+
+    int8_model = quantize_static(folded_model, calib_loader, args.calib_batches, args.backend)
+
+    from tensorboardX import SummaryWriter
+    writer = SummaryWriter(os.path.join(str(args.log_dir), 'quantize'))
+    criterion = FocalLoss(args.ignore_index)
+    models = [('float32', float_model), ('folded float32', folded_model), ('int8', int8_model)]
+
+    args.log_string('Validation result -----------------------------------------------')
+    for name, model in models:
+        mean_dice, class_dice, mean_loss = validate(args, 0, val_loader, model, None, criterion, writer, is_ema=False)
+        args.log_string('%-16s mean dice %f, class dice %s' % (name, mean_dice, class_dice))
+
+    args.log_string('Latency (ms per batch) and throughput (slices/s) -------------------')
+    args.log_string('%-16s' % 'batch size' + ''.join(['%22d' % batch_size for batch_size in args.batch_sizes]))
+    for name, model in models:
+        row = []
+        for batch_size in args.batch_sizes:
+            seconds = measure_latency(model, batch_size, get_in_channels(args), args.crop_size, args.repeat)
+            row.append('%10.2f / %9.1f' % (seconds * 1e3, batch_size / seconds))
+        args.log_string('%-16s' % name + ''.join(['%22s' % item for item in row]))
+
+    with torch.no_grad():
+        torch.jit.save(torch.jit.trace(int8_model, example), os.path.join(str(args.log_dir), 'model_int8.pt'))
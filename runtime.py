@@ -0,0 +1,80 @@
+"""Standalone inference runtime for models written by export.py.
+
+Only numpy and torch (TorchScript) or onnxruntime (ONNX) are needed: nothing of the training
+stack is imported, so this module can be copied into an inference service on its own.
+"""
+import os
+import json
+import numpy as np
+
+
+def get_stack_index(pt_idx, length, slices):
+    # same channel order as dataset.get_stack_index, repeated here to stay free of the training code
+    stack_index = [pt_idx]
+    step = int((slices - 1) / 2)
+    for i in range(step):
+        s_idx = max(pt_idx - sum([i for i in range(i+1)]), 0)
+        e_idx = min(pt_idx + sum([i for i in range(i+1)]), length - 1)
+        stack_index.insert(0, s_idx)
+        stack_index.insert(-1, e_idx)
+    return stack_index
+
+
+class SegmentationRuntime(object):
+    def __init__(self, model_path, num_threads=None):
+        self.model_path = model_path
+        if model_path.endswith('.onnx'):
+            import onnxruntime as ort
+
+            options = ort.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = ort.InferenceSession(model_path, options, providers=['CPUExecutionProvider'])
+            with open(os.path.splitext(model_path)[0] + '.json') as f:
+                self.metadata = json.load(f)
+        else:
+            import torch
+
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            extra_files = {'metadata.json': ''}
+            self.module = torch.jit.load(model_path, map_location='cpu', _extra_files=extra_files)
+            self.module.eval()
+            self.metadata = json.loads(extra_files['metadata.json'])
+
+        self.slices = self.metadata['slices']
+        self.crop_size = self.metadata['crop_size']
+
+    def crop(self, volume):
+        # center crop the in-plane dimensions of a (depth, H, W) volume, as the datasets do
+        _, width, height = volume.shape
+        gap_w, gap_h = int((width - self.crop_size) / 2), int((height - self.crop_size) / 2)
+        return volume[:, gap_w:gap_w + self.crop_size, gap_h:gap_h + self.crop_size]
+
+    def make_stacks(self, volume, slice_ids):
+        # (len(slice_ids), slices, crop_size, crop_size) float32 stacks of a branch volume
+        volume = self.crop(volume)
+        return np.stack([volume[get_stack_index(pt_idx, len(volume), self.slices)] for pt_idx in slice_ids]).astype(np.float32)
+
+    def forward(self, stacks):
+        # logits of a batch of stacks
+        if hasattr(self, 'session'):
+            return self.session.run(None, {'img': np.ascontiguousarray(stacks, dtype=np.float32)})[0]
+
+        import torch
+
+        with torch.no_grad():
+            return self.module(torch.from_numpy(np.ascontiguousarray(stacks, dtype=np.float32))).numpy()
+
+    def predict(self, stacks):
+        return np.argmax(self.forward(stacks), axis=1).astype(np.uint8)
+
+    def segment_branch(self, volume, slice_ids=None, batch_size=64):
+        # masks of the given slices of a (depth, H, W) branch volume, every slice by default
+        if slice_ids is None:
+            slice_ids = list(range(len(volume)))
+
+        masks = []
+        for start in range(0, len(slice_ids), batch_size):
+            masks.append(self.predict(self.make_stacks(volume, slice_ids[start:start + batch_size])))
+        return np.concatenate(masks) if masks else np.zeros((0, self.crop_size, self.crop_size), dtype=np.uint8)
@@ -0,0 +1,139 @@
+import numpy as np
+from torch.utils.data import Dataset, Sampler
+
+
+def get_sample_keys(dataset):
+    # (dataset_id, pt_idx, env_idx) of every sample, ConcatDataset included
+    if hasattr(dataset, 'datasets'):
+        datasets = dataset.datasets
+    else:
+        datasets = [dataset]
+
+    sample_keys = []
+    for dataset_id, item in enumerate(datasets):
+        sample_keys += [(dataset_id, pt_idx, env_idx) for pt_idx, env_idx in item.idx_list]
+    return sample_keys
+
+
+class IndexedDataset(Dataset):
+    # add the index of every sample to its dict so that the sampler can be fed back
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        sample = self.dataset[idx]
+        sample['idx'] = idx
+        return sample
+
+
+class HardSliceSampler(Sampler):
+    """Draw slices with a probability that rises with their running training loss.
+
+    The running loss is kept per (pt_idx, env_idx) entry of idx_list, so the copies made by
+    over-sampling share it. Slices that were never seen get the highest recorded loss.
+    A fraction floor of the probability mass is spread uniformly, so no slice is starved.
+    """
+    def __init__(self, dataset, epoch_length=None, momentum=0.9, floor=0.1):
+        sample_keys = get_sample_keys(dataset)
+        key_index = {}
+        self.sample_key = np.array([key_index.setdefault(key, len(key_index)) for key in sample_keys])
+        self.losses = np.full(len(key_index), np.nan)
+
+        self.epoch_length = epoch_length if epoch_length is not None else len(sample_keys)
+        self.momentum = momentum
+        self.floor = floor
+
+    def __len__(self):
+        return self.epoch_length
+
+    def update(self, indices, losses):
+        for key, loss in zip(self.sample_key[np.asarray(indices)], np.asarray(losses)):
+            if np.isnan(self.losses[key]):
+                self.losses[key] = loss
+            else:
+                self.losses[key] = self.momentum * self.losses[key] + (1 - self.momentum) * loss
+
+    def get_probabilities(self):
+        losses = self.losses[self.sample_key]
+        seen = ~np.isnan(losses)
+        if not seen.any():
+            return np.full(len(losses), 1.0 / len(losses))
+
+        losses = np.where(seen, losses, np.max(losses[seen]))
+        losses = np.maximum(losses, 0)
+        if losses.sum() == 0:
+            return np.full(len(losses), 1.0 / len(losses))
+
+        probabilities = (1 - self.floor) * losses / losses.sum() + self.floor / len(losses)
+        return probabilities / probabilities.sum()
+
+    def __iter__(self):
+        probabilities = self.get_probabilities()
+        return iter(np.random.choice(len(probabilities), self.epoch_length, replace=True, p=probabilities).tolist())
+
+
+class ReplaySampler(Sampler):
+    """Draw a fixed share of every epoch from the changed slices and replay old ones for the rest.
+
+    changed is a boolean array over the dataset. Each group is drawn without replacement as long
+    as it lasts, so a changed slice is seen about changed_fraction * epoch_length / changed.sum()
+    times per epoch. When nothing is left to replay the whole epoch comes from the changed slices.
+    """
+    def __init__(self, changed, epoch_length=None, changed_fraction=0.5):
+        changed = np.asarray(changed, dtype=bool)
+        self.changed = np.nonzero(changed)[0]
+        self.replay = np.nonzero(~changed)[0]
+        assert len(self.changed) > 0, 'no changed slice to fine-tune on'
+
+        if epoch_length is None:
+            epoch_length = int(round(len(self.changed) / changed_fraction))
+        self.epoch_length = epoch_length
+        self.changed_num = epoch_length if len(self.replay) == 0 else int(round(epoch_length * changed_fraction))
+
+    def __len__(self):
+        return self.epoch_length
+
+    def draw(self, group, num):
+        return np.random.choice(group, num, replace=num > len(group))
+
+    def __iter__(self):
+        indices = np.concatenate([self.draw(self.changed, self.changed_num), self.draw(self.replay, self.epoch_length - self.changed_num)])
+        np.random.shuffle(indices)
+        return iter(indices.tolist())
+
+
+def get_dataset_roi_sizes(dataset, crop_size):
+    # roi size of every sample, ConcatDataset included; datasets without ROIs give crop_size
+    if hasattr(dataset, 'datasets'):
+        return sum([get_dataset_roi_sizes(item, crop_size) for item in dataset.datasets], [])
+    roi_sizes = getattr(dataset, 'roi_sizes', None)
+    return list(roi_sizes) if roi_sizes is not None else [crop_size] * len(dataset)
+
+
+class BucketBatchSampler(Sampler):
+    """Batches of samples sharing a ROI size, for the per-sample crops of --adaptive_crop.
+
+    The samples of each bucket are shuffled and cut into batches, and the order of the batches of
+    all buckets is shuffled, so every sample is drawn once per epoch as with shuffle=True.
+    """
+    def __init__(self, roi_sizes, batch_size, shuffle=True):
+        roi_sizes = np.asarray(roi_sizes)
+        self.buckets = [np.nonzero(roi_sizes == size)[0] for size in np.unique(roi_sizes)]
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __len__(self):
+        return sum([int(np.ceil(len(bucket) / self.batch_size)) for bucket in self.buckets])
+
+    def __iter__(self):
+        batches = []
+        for bucket in self.buckets:
+            if self.shuffle:
+                bucket = np.random.permutation(bucket)
+            batches += [bucket[start:start + self.batch_size].tolist() for start in range(0, len(bucket), self.batch_size)]
+        if self.shuffle:
+            batches = [batches[i] for i in np.random.permutation(len(batches))]
+        return iter(batches)
@@ -0,0 +1,216 @@
+"""Local segmentation server with dynamic batching.
+
+Clients POST an .npy array of 2.5D stacks (N, slices, crop_size, crop_size) to /predict and get
+back the .npy uint8 masks (N, crop_size, crop_size). Requests are queued and merged into batches
+of at most --max_batch stacks, waiting at most --max_wait ms for a batch to fill. Each batch runs
+on a pool of --num_workers threads. GET /metrics returns the queue depth, the batch fill rate and
+the p50/p99 latency as json.
+"""
+import io
+import json
+import time
+import queue
+import argparse
+import threading
+import collections
+import numpy as np
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Server')
+    parser.add_argument('--model_path', type=str, default=None, help='model.pt or model.onnx written by export.py')
+    parser.add_argument('--checkpoint', type=str, default=None, help='checkpoint of get_module, used when no --model_path is given')
+    parser.add_argument('--weights', type=str, default='teacher', help='weights of the checkpoint: student or teacher')
+    parser.add_argument('--main_args', type=str, default='', help='main.py arguments describing the checkpoint model, e.g. "--slices 5"')
+    parser.add_argument('--host', type=str, default='127.0.0.1', help='address to listen on')
+    parser.add_argument('--port', type=int, default=8080, help='port to listen on')
+    parser.add_argument('--max_batch', type=int, default=64, help='max number of stacks in a batch')
+    parser.add_argument('--max_wait', type=float, default=5, help='max time in ms a batch waits to fill')
+    parser.add_argument('--num_workers', type=int, default=2, help='threads running the batched forward passes')
+    parser.add_argument('--num_threads', type=int, default=None, help='intra-op threads of each forward pass')
+    parser.add_argument('--latency_window', type=int, default=10000, help='number of recent requests in the latency percentiles')
+    return parser.parse_args()
+
+
+def load_predictor(args):
+    # (predict, contract) where predict maps float32 stacks to uint8 masks
+    if args.model_path is not None:
+        from runtime import SegmentationRuntime
+
+        runtime = SegmentationRuntime(args.model_path, args.num_threads)
+        return runtime.predict, {'slices': runtime.slices, 'crop_size': runtime.crop_size}
+
+    import torch
+    from main import get_parser
+    from initialization import get_in_channels, load_inference_model
+
+    model_args = get_parser().parse_args(args.main_args.split())
+    model = load_inference_model(model_args, args.checkpoint, args.weights)
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+
+    def predict(stacks):
+        with torch.no_grad():
+            return model(torch.from_numpy(stacks)).argmax(1).numpy().astype(np.uint8)
+
+    return predict, {'slices': get_in_channels(model_args), 'crop_size': model_args.crop_size}
+
+
+class Metrics(object):
+    def __init__(self, max_batch, latency_window):
+        self.lock = threading.Lock()
+        self.max_batch = max_batch
+        self.latencies = collections.deque(maxlen=latency_window)
+        self.queue_depth = 0  # stacks waiting for a batch
+        self.num_requests = 0
+        self.num_batches = 0
+        self.num_stacks = 0
+
+    def enqueue(self, num_stacks):
+        with self.lock:
+            self.queue_depth += num_stacks
+
+    def dequeue(self, num_stacks):
+        with self.lock:
+            self.queue_depth -= num_stacks
+            self.num_batches += 1
+            self.num_stacks += num_stacks
+
+    def done(self, latency):
+        with self.lock:
+            self.num_requests += 1
+            self.latencies.append(latency)
+
+    def summary(self):
+        with self.lock:
+            latencies = np.array(self.latencies) * 1e3
+            return {
+                'queue_depth': self.queue_depth,
+                'requests': self.num_requests,
+                'batches': self.num_batches,
+                'batch_fill_rate': self.num_stacks / (self.num_batches * self.max_batch) if self.num_batches else 0.0,
+                'mean_batch_size': self.num_stacks / self.num_batches if self.num_batches else 0.0,
+                'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else 0.0,
+                'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else 0.0,
+            }
+
+
+class BatchingQueue(object):
+    """Merge the stacks of queued requests into batches of at most max_batch stacks.
+
+    A collector thread takes the oldest request, then keeps adding requests until the batch is
+    full or max_wait seconds have passed since it started, and hands the batch to the worker
+    pool. Requests are never split: one larger than max_batch runs as a batch of its own.
+    """
+    def __init__(self, predict, max_batch, max_wait, num_workers, metrics):
+        self.predict = predict
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.metrics = metrics
+        self.requests = queue.Queue()
+        self.pool = ThreadPoolExecutor(num_workers)
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def submit(self, stacks):
+        future = Future()
+        self.metrics.enqueue(len(stacks))
+        self.requests.put((stacks, future, time.perf_counter()))
+        return future
+
+    def collect(self):
+        pending = None
+        while True:
+            batch = [pending if pending is not None else self.requests.get()]
+            pending = None
+            num_stacks = len(batch[0][0])
+            deadline = time.perf_counter() + self.max_wait
+            while num_stacks < self.max_batch:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self.requests.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if num_stacks + len(request[0]) > self.max_batch:
+                    pending = request  # starts the next batch
+                    break
+                batch.append(request)
+                num_stacks += len(request[0])
+
+            self.metrics.dequeue(num_stacks)
+            self.pool.submit(self.run, batch)
+
+    def run(self, batch):
+        try:
+            masks = self.predict(np.concatenate([stacks for stacks, _, _ in batch]).astype(np.float32))
+        except Exception as e:
+            for _, future, _ in batch:
+                future.set_exception(e)
+            return
+
+        start = 0
+        for stacks, future, enqueue_time in batch:
+            future.set_result(masks[start:start + len(stacks)])
+            start += len(stacks)
+            self.metrics.done(time.perf_counter() - enqueue_time)
+
+
+def make_handler(batching_queue, metrics, contract):
+    class Handler(BaseHTTPRequestHandler):
+        def send(self, code, body, content_type):
+            self.send_response(code)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path != '/metrics':
+                return self.send(404, b'not found', 'text/plain')
+            summary = dict(metrics.summary(), **contract)
+            self.send(200, json.dumps(summary).encode(), 'application/json')
+
+        def do_POST(self):
+            if self.path != '/predict':
+                return self.send(404, b'not found', 'text/plain')
+            if self.headers.get('Content-Length') is None:
+                return self.send(400, b'missing Content-Length', 'text/plain')
+            try:
+                stacks = np.load(io.BytesIO(self.rfile.read(int(self.headers['Content-Length']))), allow_pickle=False)
+                expected = (contract['slices'], contract['crop_size'], contract['crop_size'])
+                if stacks.ndim != 4 or stacks.shape[1:] != expected:
+                    raise ValueError('expected stacks of shape (N, %d, %d, %d), got %s' % (expected + (stacks.shape,)))
+            except (TypeError, ValueError, EOFError) as e:
+                return self.send(400, str(e).encode(), 'text/plain')
+
+            try:
+                masks = batching_queue.submit(stacks).result()
+            except Exception as e:
+                return self.send(500, str(e).encode(), 'text/plain')
+            body = io.BytesIO()
+            np.save(body, masks)
+            self.send(200, body.getvalue(), 'application/octet-stream')
+
+        def log_message(self, format, *args):
+            pass  # one line per request drowns the output under load
+
+    return Handler
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    assert args.model_path is not None or args.checkpoint is not None, 'a --model_path or a --checkpoint is needed'
+
+    predict, contract = load_predictor(args)
+    metrics = Metrics(args.max_batch, args.latency_window)
+    batching_queue = BatchingQueue(predict, args.max_batch, args.max_wait / 1e3, args.num_workers, metrics)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(batching_queue, metrics, contract))
+    print('Serving stacks of %d slices at %dx%d on http://%s:%d' % (contract['slices'], contract['crop_size'], contract['crop_size'], args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
@@ -0,0 +1,103 @@
+"""End-to-end check of server.py driven by the clients of loadgen.py.
+
+Serves a randomly initialized get_module through the BatchingQueue and the handler of server.py
+on an ephemeral local port. Concurrent loadgen clients then send their requests. The check
+compares served masks with a direct forward pass, checks /metrics against the requests sent and
+checks that malformed requests get a 400. It exits with an error at the first failed check.
+"""
+import io
+import argparse
+import threading
+import numpy as np
+import torch
+from http.client import HTTPConnection
+from http.server import ThreadingHTTPServer
+from Vnet import get_module
+from server import Metrics, BatchingQueue, make_handler
+from loadgen import client, get_metrics, send
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Server check')
+    parser.add_argument('--slices', type=int, default=7, help='slices of the 2.5D stacks')
+    parser.add_argument('--crop_size', type=int, default=32, help='size for square patch')
+    parser.add_argument('--concurrency', type=int, default=4, help='clients sending requests at the same time')
+    parser.add_argument('--requests', type=int, default=20, help='requests sent by each client')
+    parser.add_argument('--min_stacks', type=int, default=1, help='min number of stacks in a request')
+    parser.add_argument('--max_stacks', type=int, default=16, help='max number of stacks in a request')
+    parser.add_argument('--max_batch', type=int, default=32, help='max number of stacks in a batch')
+    parser.add_argument('--seed', type=int, default=1, help='random seed of the model and the requests')
+    return parser.parse_args()
+
+
+def post(url_port, body, headers):
+    # (status, body) of a raw POST to /predict, the headers are sent as given
+    connection = HTTPConnection('127.0.0.1', url_port)
+    connection.putrequest('POST', '/predict')
+    for key, value in headers.items():
+        connection.putheader(key, value)
+    connection.endheaders()
+    if body:
+        connection.send(body)
+    response = connection.getresponse()
+    result = response.status, response.read()
+    connection.close()
+    return result
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    torch.manual_seed(args.seed)
+    model = get_module(args.slices, 3, 3, 3, True, True).eval()
+
+    def predict(stacks):
+        with torch.no_grad():
+            return model(torch.from_numpy(stacks)).argmax(1).numpy().astype(np.uint8)
+
+    # serve on an ephemeral port -------------------------------------------------------
+    contract = {'slices': args.slices, 'crop_size': args.crop_size}
+    metrics = Metrics(args.max_batch, 1000)
+    batching_queue = BatchingQueue(predict, args.max_batch, 0.005, 2, metrics)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), make_handler(batching_queue, metrics, contract))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port = server.server_address[1]
+    args.url = 'http://127.0.0.1:%d' % port
+
+    # concurrent loadgen clients, each checks the shape of its masks -----------------------
+    served = get_metrics(args.url)
+    assert served['slices'] == args.slices and served['crop_size'] == args.crop_size, served
+    latencies, num_stacks = [], []
+    threads = [threading.Thread(target=client, args=(args, contract, args.seed + i, latencies, num_stacks)) for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(latencies) == args.concurrency * args.requests, 'a client failed'
+
+    # served masks match a direct forward pass ---------------------------------------------
+    stacks = np.random.RandomState(args.seed).randint(-1024, 1024, size=(5, args.slices, args.crop_size, args.crop_size)).astype(np.int16)
+    masks = send(args.url, stacks)
+    agreement = (masks == predict(stacks.astype(np.float32))).mean()
+    assert masks.dtype == np.uint8 and agreement > 0.999, 'served masks differ from the model: agreement %f' % agreement
+
+    # metrics account for every request and stack -------------------------------------------
+    summary = get_metrics(args.url)
+    total_stacks = sum(num_stacks) + len(stacks)
+    assert summary['requests'] == len(latencies) + 1, summary
+    assert summary['queue_depth'] == 0, summary
+    assert 0 < summary['batches'] <= summary['requests'], summary
+    assert abs(summary['mean_batch_size'] * summary['batches'] - total_stacks) < 1e-3, summary
+    assert 0 < summary['batch_fill_rate'] <= 1, summary
+
+    # malformed requests are refused -----------------------------------------------------
+    body = io.BytesIO()
+    np.save(body, stacks[:, :1])
+    for name, request_body, headers in (('missing Content-Length', b'', {}),
+                                        ('not an npy array', b'garbage', {'Content-Length': '7'}),
+                                        ('wrong shape', body.getvalue(), {'Content-Length': str(len(body.getvalue()))})):
+        status, _ = post(port, request_body, headers)
+        assert status == 400, '%s: status %d' % (name, status)
+
+    server.shutdown()
+    print('Server check passed: %d requests, %d stacks, %d batches, mean batch size %.1f, mask agreement %.4f' % (
+        summary['requests'], total_stacks, summary['batches'], summary['mean_batch_size'], agreement))
@@ -0,0 +1,115 @@
+import os
+import numpy as np
+import torch
+from transformations import center_crop_tensor
+from augmentation import augment_batch
+
+
+class TeacherCache(object):
+    """Float16 memory-mapped store of teacher probabilities for the unlabeled slices.
+
+    Probabilities are stored already brought back through the rot/flip/scale inversion, in the
+    frame of the student input, so reading them costs no transform. The affine augmentation of
+    an over-sampled slice is a function of its index (aug_seed), so its frame is the same at
+    every read. The refresh replays it as load_unlabeled_batch does. A slice is predicted again
+    once its entry is older than staleness iterations; the whole store can also be refreshed
+    in a separate pass over the unlabeled loader.
+
+    Every audit_interval iterations, the teacher also predicts the slices a lookup served from
+    the store. The per-class Dice between the argmax of the cached and of the fresh predictions
+    measures what the staleness costs in accuracy.
+    """
+    def __init__(self, path, num_samples, n_classes, staleness, audit_interval=0):
+        self.path = path
+        self.num_samples = num_samples
+        self.n_classes = n_classes
+        self.staleness = staleness
+        self.audit_interval = audit_interval
+        self.crop_size = None
+        self.store = None
+        self.stamp = np.full(num_samples, -1, dtype=np.int64)  # iteration of the last refresh
+        self.hits = 0
+        self.misses = 0
+        self.audit_inter = np.zeros(n_classes)
+        self.audit_total = np.zeros(n_classes)
+
+    def reset(self, crop_size):
+        # entries of another crop size can not be reused
+        self.crop_size = crop_size
+        self.store = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.float16,
+                                               shape=(self.num_samples, self.n_classes, crop_size, crop_size))
+        self.stamp[:] = -1
+
+    def get_stale(self, indices, iter_num):
+        stamp = self.stamp[indices]
+        return (stamp < 0) | (iter_num - stamp > self.staleness)
+
+    def write(self, indices, probs, iter_num):
+        self.store[indices] = probs.cpu().numpy().astype(np.float16)
+        self.stamp[indices] = iter_num
+
+    def read(self, indices, device):
+        return torch.from_numpy(self.store[indices].astype(np.float32)).to(device)
+
+    def lookup(self, indices, inputs, predict, iter_num):
+        # teacher logits of a batch, predicting again only the stale slices
+        if self.crop_size != inputs.shape[-1]:
+            self.reset(inputs.shape[-1])
+
+        indices = np.asarray(indices)
+        stale = self.get_stale(indices, iter_num)
+        self.misses += int(stale.sum())
+        self.hits += int((~stale).sum())
+
+        if stale.any():
+            with torch.no_grad():
+                probs = torch.softmax(predict(inputs[torch.from_numpy(stale).to(inputs.device)]), dim=1)
+            self.write(indices[stale], probs, iter_num)
+
+        # the log of the probabilities acts as logits for the consistency criterion
+        outputs = torch.log(self.read(indices, inputs.device).clamp(min=1e-6))
+        if self.audit_interval > 0 and iter_num % self.audit_interval == 0 and not stale.all():
+            hit = torch.from_numpy(~stale).to(inputs.device)
+            with torch.no_grad():
+                self.audit(outputs[hit], predict(inputs[hit]))
+        return outputs
+
+    def audit(self, cached, fresh):
+        # per-class overlap of the argmax of cached and fresh teacher predictions
+        cached, fresh = cached.argmax(1), fresh.argmax(1)
+        for l in range(self.n_classes):
+            self.audit_inter[l] += ((cached == l) & (fresh == l)).sum().item()
+            self.audit_total[l] += (cached == l).sum().item() + (fresh == l).sum().item()
+
+    def refresh(self, loader, predict, iter_num, device, crop_size, seed):
+        if self.crop_size != crop_size:
+            self.reset(crop_size)
+
+        with torch.no_grad():
+            for data in loader:
+                inputs = data['img'].permute(0, 3, 1, 2).to(device).float()
+                if 'aug_seed' in data:  # --augmentation device, the training inputs are augmented on the device
+                    inputs, _ = augment_batch(inputs, None, data['aug_seed'].numpy(), seed)
+                inputs = center_crop_tensor(inputs, min(crop_size, inputs.shape[-1]))
+                self.write(np.asarray(data['idx']), torch.softmax(predict(inputs), dim=1), iter_num)
+
+    def reset_counts(self):
+        self.hits = 0
+        self.misses = 0
+        self.audit_inter[:] = 0
+        self.audit_total[:] = 0
+
+    def get_hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total > 0 else 0.0
+
+    def get_audit_dice(self):
+        # per-class Dice of the cached against the fresh predictions, None before any audit
+        if self.audit_total.sum() == 0:
+            return None
+        return np.where(self.audit_total > 0, 2 * self.audit_inter / np.maximum(self.audit_total, 1), 1.0)
+
+    def close(self):
+        self.store = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
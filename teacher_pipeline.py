@@ -0,0 +1,58 @@
+import time
+import torch
+from concurrent.futures import ThreadPoolExecutor
+
+
+class TeacherPipeline(object):
+    """Teacher predictions computed on a background thread while the student step runs.
+
+    submit() starts predict on the next unlabeled batch and returns at once. result() waits for
+    it. With cuda, the prediction is queued on a side stream that first waits for the inputs
+    to be ready on the current stream, and result() makes the current stream wait for the
+    side stream. Autocast is thread local, so the autocast context of the caller is entered
+    again on the thread.
+
+    The caller must take result() before it updates the teacher weights, so the prediction never
+    reads a half-updated teacher. In train_mean_teacher the teacher of batch i+1 therefore sees
+    the EMA weights after update i-1, one update older than in the sequential loop.
+    """
+    def __init__(self, predict, device, autocast):
+        self.predict = predict
+        self.autocast = autocast
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        self.device = device
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.future = None
+        self.wait_time = 0.0
+
+    def run(self, inputs, ready):
+        if self.stream is None:
+            with self.autocast():
+                return self.predict(inputs)
+
+        with torch.cuda.stream(self.stream):
+            self.stream.wait_event(ready)
+            with self.autocast():
+                return self.predict(inputs)
+
+    def submit(self, inputs):
+        assert self.future is None, 'the previous prediction was not taken'
+        ready = None
+        if self.stream is not None:
+            ready = torch.cuda.Event()
+            ready.record(torch.cuda.current_stream(self.device))
+            inputs.record_stream(self.stream)
+        self.future = self.executor.submit(self.run, inputs, ready)
+
+    def result(self):
+        start = time.perf_counter()
+        outputs, self.future = self.future.result(), None
+        if self.stream is not None:
+            current = torch.cuda.current_stream(self.device)
+            current.wait_stream(self.stream)
+            outputs.record_stream(current)
+        self.wait_time += time.perf_counter() - start
+        return outputs
+
+    def close(self):
+        self.executor.shutdown(wait=True)
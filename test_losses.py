@@ -0,0 +1,88 @@
+"""Equivalence of the fused losses of losses.py with the modules they replace.
+
+FocalDiceLoss is checked against FocalLoss and DiceLossMulticlass_CW, and ConsistencyLoss
+against the per-pixel references of benchmark.py.
+
+Run with python -m pytest test_losses.py. The timings of the same cases are in benchmark.py.
+"""
+import pytest
+import torch
+from losses import FocalLoss, DiceLossMulticlass_CW, FocalDiceLoss, ConsistencyLoss
+from benchmark import naive_consistency
+
+N_CLASSES = 3
+IGNORE_INDEX = 3
+WEIGHTS = torch.tensor([1.0000, 4.9928, 9.7400])
+
+
+def loss_and_grad(loss_fn, logits):
+    logits.grad = None
+    loss = loss_fn()
+    loss.backward()
+    return loss.detach(), logits.grad.clone()
+
+
+@pytest.mark.parametrize('weights', [WEIGHTS, None], ids=['weighted', 'unweighted'])
+@pytest.mark.parametrize('name', ['focal', 'dice', 'focal + dice'])
+def test_focal_dice_loss(name, weights):
+    torch.manual_seed(0)
+    n_pixels = 16 * 16
+    logits = torch.randn(8, N_CLASSES, n_pixels, requires_grad=True)
+    # the focal target contains ignored background, the reference dice can only take in-range labels
+    focal_target = torch.randint(0, N_CLASSES + 1, (8, 1, n_pixels))
+    dice_target = torch.randint(0, N_CLASSES, (8, 1, n_pixels))
+
+    focal, dice = FocalLoss(IGNORE_INDEX), DiceLossMulticlass_CW()
+    if name == 'focal':
+        reference, fused, target = (lambda: focal(logits, focal_target, N_CLASSES, weights),
+                                    FocalDiceLoss(IGNORE_INDEX), focal_target)
+    elif name == 'dice':
+        reference, fused, target = (lambda: dice(logits, dice_target, N_CLASSES, weights),
+                                    FocalDiceLoss(IGNORE_INDEX, focal_weight=0.0, dice_weight=1.0), dice_target)
+    else:
+        reference, fused, target = (lambda: focal(logits, dice_target, N_CLASSES, weights) + dice(logits, dice_target, N_CLASSES, weights),
+                                    FocalDiceLoss(IGNORE_INDEX, dice_weight=1.0), dice_target)
+
+    ref_loss, ref_grad = loss_and_grad(reference, logits)
+    fused_loss, fused_grad = loss_and_grad(lambda: fused(logits, target, N_CLASSES, weights), logits)
+    assert torch.allclose(ref_loss, fused_loss, rtol=1e-4, atol=1e-6), (ref_loss, fused_loss)
+    assert torch.allclose(ref_grad, fused_grad, rtol=1e-3, atol=1e-8), (ref_grad - fused_grad).abs().max()
+
+
+def test_dice_ignores_background():
+    # the weighted dice leaves the ignored pixels out of the probability sums
+    torch.manual_seed(0)
+    logits = torch.randn(4, N_CLASSES, 64, requires_grad=True)
+    target = torch.randint(0, N_CLASSES, (4, 1, 64))
+    ignored = target.clone()
+    ignored[..., 32:] = IGNORE_INDEX
+
+    fused = FocalDiceLoss(IGNORE_INDEX, focal_weight=0.0, dice_weight=1.0)
+    loss, grad = loss_and_grad(lambda: fused(logits, ignored, N_CLASSES, WEIGHTS), logits)
+    ref_loss, ref_grad = loss_and_grad(lambda: fused(logits[..., :32], target[..., :32], N_CLASSES, WEIGHTS), logits)
+    assert torch.allclose(loss, ref_loss, rtol=1e-5), (loss, ref_loss)
+    assert torch.allclose(grad, ref_grad, atol=1e-8)
+    assert grad[..., 32:].abs().max() == 0
+
+
+@pytest.mark.parametrize('consistency_type', ['mse', 'kl', 'masked_mse', 'masked_kl'])
+def test_consistency_loss(consistency_type):
+    torch.manual_seed(0)
+    shape = (8, N_CLASSES, 16, 16)
+    stu_logits = torch.randn(shape, requires_grad=True)
+    ema_logits = 3 * torch.randn(shape)
+
+    criterion = ConsistencyLoss(consistency_type, 0.8)
+    ref_loss, ref_grad = loss_and_grad(lambda: naive_consistency(consistency_type, 0.8, stu_logits, ema_logits), stu_logits)
+    loss, grad = loss_and_grad(lambda: criterion(stu_logits, ema_logits), stu_logits)
+    assert torch.allclose(ref_loss, loss, rtol=1e-4, atol=1e-7), (ref_loss, loss)
+    assert torch.allclose(ref_grad, grad, rtol=1e-3, atol=1e-9), (ref_grad - grad).abs().max()
+
+
+@pytest.mark.parametrize('consistency_type', ['masked_mse', 'masked_kl'])
+def test_masked_consistency_without_confident_pixels(consistency_type):
+    # no teacher pixel reaches the threshold: a zero loss that still backpropagates
+    stu_logits = torch.randn(2, N_CLASSES, 8, 8, requires_grad=True)
+    loss, grad = loss_and_grad(lambda: ConsistencyLoss(consistency_type, 0.8)(stu_logits, torch.zeros(2, N_CLASSES, 8, 8)), stu_logits)
+    assert loss.item() == 0
+    assert grad.abs().max() == 0
@@ -0,0 +1,29 @@
+"""Label codings of the plaque report of quantify.py.
+
+Run with python -m pytest test_quantify.py.
+"""
+import numpy as np
+from dataset import remap_mask
+from quantify import quantify_volume, to_annotation_coding
+
+SPACING = (0.5, 0.3, 0.3)
+
+
+def test_network_coding_matches_annotation():
+    # an annotation and its network-coded copy, as produced by remap_mask, give the same report
+    rng = np.random.RandomState(0)
+    annotation = rng.randint(0, 6, size=(12, 8, 8))  # anchors above 3 included
+    annotation[rng.rand(*annotation.shape) < 0.3] = 0
+    network = remap_mask(annotation.copy())
+    assert quantify_volume(to_annotation_coding(network), SPACING) == quantify_volume(annotation, SPACING)
+
+
+def test_plaque_runs():
+    mask_vol = np.ones((10, 4, 4), dtype=np.int16)
+    mask_vol[[1, 2, 3, 6], 0, 0] = 2
+    mask_vol[5, :2, :2] = 3
+    result = quantify_volume(mask_vol, SPACING)
+    assert result['calcified_voxels'] == 4 and result['calcified_slices'] == 4
+    assert (result['calcified_first_slice'], result['calcified_last_slice'], result['calcified_longest_run']) == (1, 6, 3)
+    assert result['soft_max_area_pixels'] == 4 and result['soft_max_area_slice'] == 5
+    assert np.isclose(result['soft_volume_mm3'], 4 * 0.5 * 0.3 * 0.3)
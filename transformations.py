@@ -1,5 +1,4 @@
 import numpy as np
-import cv2
 import torch
 
 
@@ -10,7 +9,25 @@ def transforms_for_noise(inputs_u2, std=3e-2):
 
     return inputs_u2_noise
 
-def transforms_for_scale(ema_inputs, image_size=64):
+def center_crop_tensor(inputs, crop_size):
+    # center crop a (batch_size, channel, H, W) tensor
+    height, width = inputs.shape[2:]
+    gap_h, gap_w = int((height - crop_size) / 2), int((width - crop_size) / 2)
+    return inputs[:, :, gap_h:gap_h + crop_size, gap_w:gap_w + crop_size]
+
+def paste_center_tensor(inputs, size, fill):
+    # put a (batch_size, channel, h, w) tensor back in the centre of a size x size canvas, the inverse of center_crop_tensor
+    height, width = inputs.shape[2:]
+    gap_h, gap_w = int((size - height) / 2), int((size - width) / 2)
+    outputs = inputs.new_full(tuple(inputs.shape[:2]) + (size, size), fill)
+    outputs[:, :, gap_h:gap_h + height, gap_w:gap_w + width] = inputs
+    return outputs
+
+def transforms_for_scale(ema_inputs, image_size=None):
+    import cv2
+
+    if image_size is None:
+        image_size = ema_inputs.shape[-1]
 
     scale_mask = np.random.uniform(low=0.9, high=1.1, size=ema_inputs.shape[0])
     scale_mask = scale_mask * image_size
@@ -36,7 +53,10 @@ def transforms_for_scale(ema_inputs, image_size=64):
 
     return ema_outputs.float(), scale_mask
 
-def transforms_back_scale(ema_inputs, scale_mask, image_size=64):
+def transforms_back_scale(ema_inputs, scale_mask, image_size=None):
+    import cv2
+    if image_size is None:
+        image_size = ema_inputs.shape[-1]
     half_size = int(image_size / 2)
     returned_img = np.zeros((ema_inputs.shape[0], image_size, image_size, ema_inputs.shape[1]))  # (16, 64, 64, 4)
     ema_outputs = torch.zeros_like(ema_inputs)  # (16, 4, 64, 64)
@@ -0,0 +1,239 @@
+"""Chunked, compressed store of the branch volumes for random slice reads.
+
+Every branch of data_dir/<case>/<branch> becomes store_dir/<case>/<branch> holding img.bin,
+mask.bin and index.json. Each array is cut along the centerline into chunks of chunk_slices
+slices that are compressed independently, with zstd or blosc when installed and zlib otherwise,
+and index.json records the byte offsets of the chunks. A range of slices is read by seeking to
+its chunks, nothing else of the file is read or decompressed.
+
+Probe_Dataset reads from a store given by --volume_store: the mask is decoded whole, the image
+only at the slices used by the stacks of the centerline slices, which are the only ones held in
+memory (see SliceVolume). index.json also records the shape
+and the class counts of the whole volume, so that the class weights and the meta cache of a store
+written with --crop_size match the ones of the .nii.gz files.
+"""
+import os
+import json
+import zlib
+import argparse
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from dataset import get_mpr_path, get_mask_path, get_branch_key, get_branch_paths, remap_mask, get_centerline_index, get_stack_index, crop_volume, compact_image
+
+
+def parse_args():
+    parser = argparse.ArgumentParser('Volume store')
+    parser.add_argument('--data_dir', default='/Users/gaoyibo/Datasets/plaques/all_subset_v3', help='folder of the case/branch volumes')
+    parser.add_argument('--store_dir', default='./volume_store', help='folder of the converted store')
+    parser.add_argument('--dataset_mode', type=str, default='all_branch', help='branches to convert: main_branch or all_branch')
+    parser.add_argument('--codec', type=str, default='auto', help='zstd, blosc, zlib, or auto for the first one installed')
+    parser.add_argument('--level', type=int, default=3, help='compression level')
+    parser.add_argument('--chunk_slices', type=int, default=1, help='slices per compressed chunk')
+    parser.add_argument('--crop_size', type=int, default=0, help='store only a centered crop of this size, 0 for the whole slices; keep the parity of the slice size so the training crop stays centered the same')
+    parser.add_argument('--overwrite', action='store_true', help='convert again the branches already in the store')
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count(), help='processes converting the branches')
+    return parser.parse_args()
+
+
+class Codec(object):
+    def __init__(self, name, level=3):
+        if name == 'auto':
+            name = 'zlib'
+            for candidate, module in (('zstd', 'zstandard'), ('blosc', 'blosc')):
+                try:
+                    __import__(module)
+                    name = candidate
+                    break
+                except ImportError:
+                    pass
+        self.name = name
+        self.level = level
+
+    def compress(self, data, itemsize):
+        if self.name == 'zstd':
+            import zstandard
+            return zstandard.ZstdCompressor(level=self.level).compress(data)
+        elif self.name == 'blosc':
+            import blosc
+            return blosc.compress(data, typesize=itemsize, clevel=self.level, shuffle=blosc.SHUFFLE, cname='zstd')
+        elif self.name == 'zlib':
+            return zlib.compress(data, self.level)
+        raise NotImplementedError(self.name)
+
+    def decompress(self, data):
+        if self.name == 'zstd':
+            import zstandard
+            return zstandard.ZstdDecompressor().decompress(data)
+        elif self.name == 'blosc':
+            import blosc
+            return blosc.decompress(data)
+        elif self.name == 'zlib':
+            return zlib.decompress(data)
+        raise NotImplementedError(self.name)
+
+
+def get_store_path(store_dir, file_path):
+    return os.path.join(store_dir, *get_branch_key(file_path))
+
+def write_chunks(path, vol, chunk_slices, codec):
+    # byte offsets of the chunks, the last one is the file size
+    offsets = [0]
+    with open(path, 'wb') as f:
+        for start in range(0, len(vol), chunk_slices):
+            data = codec.compress(np.ascontiguousarray(vol[start:start + chunk_slices]).tobytes(), vol.itemsize)
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+    return offsets
+
+def convert_branch(file_path, store_dir, codec, chunk_slices, crop_size):
+    # returns the (raw, stored) bytes of the branch
+    import SimpleITK as sitk
+
+    mask_path = get_mask_path(file_path)
+    mpr_itk = sitk.ReadImage(get_mpr_path(file_path))
+    mpr_vol = sitk.GetArrayFromImage(mpr_itk)
+    mask_vol = sitk.GetArrayFromImage(sitk.ReadImage(mask_path))
+    assert mpr_vol.shape == mask_vol.shape, 'Wrong shape of %s' % file_path
+
+    # class counts of the whole volume, so that a cropped store weights the classes as the .nii.gz files
+    unique, counts = np.unique(remap_mask(mask_vol.copy()), return_counts=True)
+    label_counts = np.zeros(4, dtype=np.int64)
+    label_counts[unique] = counts
+
+    full_shape = mpr_vol.shape
+    if crop_size > 0:
+        mpr_vol, mask_vol = crop_volume(mpr_vol, crop_size), crop_volume(mask_vol, crop_size)
+    mpr_vol = compact_image(mpr_vol)
+    if mask_vol.min() >= 0 and mask_vol.max() < 256:
+        mask_vol = mask_vol.astype(np.uint8)
+
+    branch_dir = get_store_path(store_dir, file_path)
+    os.makedirs(branch_dir, exist_ok=True)
+    index = {
+        'full_shape': [int(item) for item in full_shape],
+        'shape': [int(item) for item in mpr_vol.shape],
+        'label_counts': label_counts.tolist(),
+        'spacing': list(mpr_itk.GetSpacing()),
+        'mask_name': os.path.basename(mask_path),
+        'codec': codec.name,
+        'chunk_slices': chunk_slices,
+        'arrays': {},
+    }
+    for name, vol in (('img', mpr_vol), ('mask', mask_vol)):
+        offsets = write_chunks(os.path.join(branch_dir, name + '.bin'), vol, chunk_slices, codec)
+        index['arrays'][name] = {'dtype': vol.dtype.str, 'offsets': offsets}
+
+    # the index is written last, a branch without it is not in the store
+    with open(os.path.join(branch_dir, 'index.json'), 'w') as f:
+        json.dump(index, f)
+    return mpr_vol.nbytes + mask_vol.nbytes, sum([item['offsets'][-1] for item in index['arrays'].values()])
+
+
+class BranchReader(object):
+    def __init__(self, branch_dir):
+        self.branch_dir = branch_dir
+        with open(os.path.join(branch_dir, 'index.json')) as f:
+            self.index = json.load(f)
+        self.codec = Codec(self.index['codec'])
+        self.chunk_slices = self.index['chunk_slices']
+        self.shape = tuple(self.index['shape'])
+
+    def read_chunks(self, name, chunk_ids):
+        # {chunk_id: (slices, H, W) array} of the given chunks, each read and decompressed once
+        array = self.index['arrays'][name]
+        offsets, dtype = array['offsets'], np.dtype(array['dtype'])
+        chunks = {}
+        with open(os.path.join(self.branch_dir, name + '.bin'), 'rb') as f:
+            for chunk_id in sorted(set(chunk_ids)):
+                f.seek(offsets[chunk_id])
+                data = self.codec.decompress(f.read(offsets[chunk_id + 1] - offsets[chunk_id]))
+                chunks[chunk_id] = np.frombuffer(data, dtype=dtype).reshape((-1,) + self.shape[1:])
+        return chunks
+
+    def read(self, name, start=0, stop=None):
+        # slices [start, stop) of an array
+        stop = self.shape[0] if stop is None else min(stop, self.shape[0])
+        if stop <= start:
+            return np.zeros((0,) + self.shape[1:], dtype=np.dtype(self.index['arrays'][name]['dtype']))
+        first, last = start // self.chunk_slices, (stop - 1) // self.chunk_slices
+        chunks = self.read_chunks(name, range(first, last + 1))
+        vol = np.concatenate([chunks[chunk_id] for chunk_id in range(first, last + 1)])
+        return vol[start - first * self.chunk_slices:stop - first * self.chunk_slices]
+
+    def read_slices(self, name, slice_ids):
+        # SliceVolume of the given slices, only they are allocated
+        slice_ids = sorted(set(slice_ids))
+        data = np.empty((len(slice_ids),) + self.shape[1:], dtype=np.dtype(self.index['arrays'][name]['dtype']))
+        chunks = self.read_chunks(name, [slice_id // self.chunk_slices for slice_id in slice_ids])
+        for i, slice_id in enumerate(slice_ids):
+            data[i] = chunks[slice_id // self.chunk_slices][slice_id % self.chunk_slices]
+        return SliceVolume(slice_ids, data, self.shape[0])
+
+
+class SliceVolume(object):
+    """Some slices of a (depth, H, W) volume, indexed by their slice id in the whole volume.
+
+    Only the slices read are held, in data. Indexing with a slice id or an integer array of
+    slice ids returns them as the full array would, and a slice that was not read raises an
+    IndexError. len() and shape are the ones of the whole volume.
+    """
+    def __init__(self, slice_ids, data, depth):
+        self.slice_ids = list(slice_ids)
+        self.data = data
+        self.depth = depth
+        self.position = np.full(depth, -1, dtype=np.int32)
+        self.position[self.slice_ids] = np.arange(len(self.slice_ids))
+
+    @property
+    def shape(self):
+        return (self.depth,) + self.data.shape[1:]
+
+    @property
+    def itemsize(self):
+        return self.data.itemsize
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.position.nbytes
+
+    def __len__(self):
+        return self.depth
+
+    def __getitem__(self, slice_ids):
+        position = self.position[slice_ids]
+        if np.any(position < 0):
+            raise IndexError('slices %s were not read' % np.asarray(slice_ids)[position < 0])
+        return self.data[position]
+
+    def apply(self, fn):
+        # SliceVolume of the same slices with fn applied to their (slices, H, W) array
+        return SliceVolume(self.slice_ids, fn(self.data), self.depth)
+
+def read_store_branch(store_dir, file_path, slices):
+    # (mpr_vol, mask_vol, mask_path, index) for prepare_data, the image only where the stacks need it;
+    # the full_shape and label_counts of the index describe the whole volume, even in a cropped store
+    reader = BranchReader(get_store_path(store_dir, file_path))
+    assert 'label_counts' in reader.index, 'the store of %s predates the label counts, convert it again with --overwrite' % file_path
+    mask_vol = reader.read('mask')
+    centerline_index = get_centerline_index(remap_mask(mask_vol.copy()))
+    needed = sorted(set([i for pt_idx in centerline_index for i in get_stack_index(pt_idx, len(mask_vol), slices)]))
+    mpr_vol = reader.read_slices('img', needed)
+    return mpr_vol, mask_vol.copy(), os.path.join(file_path, reader.index['mask_name']), reader.index
+
+def convert_task(task):
+    file_path, args = task
+    if not args.overwrite and os.path.exists(os.path.join(get_store_path(args.store_dir, file_path), 'index.json')):
+        return 0, 0
+    return convert_branch(file_path, args.store_dir, Codec(args.codec, args.level), args.chunk_slices, args.crop_size)
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    branches = get_branch_paths(args, [os.path.join(args.data_dir, str(i)) for i in range(150)])
+    print('Converting %d branches with %s' % (len(branches), Codec(args.codec).name))
+
+    with ProcessPoolExecutor(args.num_workers) as executor:
+        sizes = list(executor.map(convert_task, [(file_path, args) for file_path in branches]))
+
+    raw_bytes, stored_bytes = sum([item[0] for item in sizes]), sum([item[1] for item in sizes])
+    print('Stored %.1f MB of volumes in %.1f MB (x%.2f)' % (raw_bytes / 2 ** 20, stored_bytes / 2 ** 20, raw_bytes / max(stored_bytes, 1)))